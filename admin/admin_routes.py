@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from sqlalchemy.orm import Session
 
 from database import get_db
-from models import Usuario
-from auth import get_current_user
+from models import AcessoEfetivo, DbSnapshot, SyncCabeca, Usuario
+import assinatura_service
+import auth
+import revogacao
+from auth import UsuarioLogado, get_current_user
+import sync_routes
+import telemetria_login
+from limite_login import limitador_de_login
 
 # -------------------------------------------------
 # Router ADMIN
@@ -16,7 +22,7 @@ router = APIRouter(
 # -------------------------------------------------
 # DEPENDÊNCIA: SOMENTE ADMIN
 # -------------------------------------------------
-def admin_required(user: Usuario = Depends(get_current_user)):
+def admin_required(user: UsuarioLogado = Depends(get_current_user)):
     if not user.is_admin:
         raise HTTPException(
             status_code=403,
@@ -30,7 +36,7 @@ def admin_required(user: Usuario = Depends(get_current_user)):
 @router.get("/usuarios")
 def listar_usuarios(
     db: Session = Depends(get_db),
-    _: Usuario = Depends(admin_required)
+    _: UsuarioLogado = Depends(admin_required)
 ):
     usuarios = db.query(Usuario).all()
 
@@ -54,7 +60,7 @@ def alterar_status(
     user_id: int,
     novo_status: str,
     db: Session = Depends(get_db),
-    _: Usuario = Depends(admin_required)
+    _: UsuarioLogado = Depends(admin_required)
 ):
     usuario = db.query(Usuario).filter(Usuario.id == user_id).first()
 
@@ -72,8 +78,113 @@ def alterar_status(
 
     usuario.status = novo_status
     db.commit()
+    assinatura_service.acesso_mudou(db, user_id, "admin")
+    if novo_status != "ativo":
+        auth.revogar_tokens_do_usuario(db, user_id)
 
     return {
         "success": True,
         "message": f"Status alterado para {novo_status}"
     }
+
+# -------------------------------------------------
+# MÉTRICAS (filas internas do servidor)
+# -------------------------------------------------
+@router.get("/metricas")
+def metricas(_: UsuarioLogado = Depends(admin_required)):
+    return {
+        "senhas": auth.pool_de_senhas.estatisticas(),
+        "lote_dispositivos": sync_routes.atividade_dispositivos.estatisticas(),
+        "lote_login": telemetria_login.telemetria_login.estatisticas(),
+        "cache_usuarios": auth.estatisticas_cache_usuarios(),
+        "cache_tokens": auth.estatisticas_cache_tokens(),
+        "revogacao": revogacao.estatisticas(),
+        "login": limitador_de_login.estatisticas(),
+    }
+
+# -------------------------------------------------
+# ACESSO EFETIVO (decisão atual + histórico de mudanças)
+# -------------------------------------------------
+@router.get("/usuarios/{user_id}/acesso")
+def acesso_do_usuario(
+    user_id: int,
+    db: Session = Depends(get_db),
+    _: UsuarioLogado = Depends(admin_required)
+):
+    atual = db.get(AcessoEfetivo, user_id)
+    return {
+        "atual": atual and {
+            "liberado": bool(atual.liberado),
+            "motivo": atual.motivo,
+            "valido_ate": atual.valido_ate,
+            "atualizado_em": atual.atualizado_em,
+        },
+        "historico": [
+            {
+                "liberado": bool(h.liberado),
+                "motivo": h.motivo,
+                "valido_ate": h.valido_ate,
+                "origem": h.origem,
+                "criado_em": h.criado_em,
+            }
+            for h in assinatura_service.historico_de_acesso(db, user_id)
+        ],
+    }
+
+# -------------------------------------------------
+# HISTÓRICO DE CÓPIAS DO BANCO (e restauração)
+# -------------------------------------------------
+def _camada(snap):
+    if snap.blob_ref or snap.em_blocos:
+        return "quente"
+    if snap.frio_ref:
+        return "fria"
+    return "banco"   # legado: ainda dentro do Postgres
+
+
+@router.get("/usuarios/{user_id}/copias")
+def listar_copias(
+    user_id: int,
+    db: Session = Depends(get_db),
+    _: UsuarioLogado = Depends(admin_required)
+):
+    cabeca = db.get(SyncCabeca, user_id)
+    atual_id = cabeca.snapshot_id if cabeca else None
+    copias = (
+        db.query(DbSnapshot)
+        .filter(DbSnapshot.user_id == user_id)
+        .order_by(DbSnapshot.version.desc())
+        .all()
+    )
+    return [
+        {
+            "version": c.version,
+            "tamanho_bytes": c.tamanho_bytes,
+            "device_id": c.device_id,
+            "criado_em": c.criado_em,
+            "camada": _camada(c),
+            "atual": c.id == atual_id,
+        }
+        for c in copias
+    ]
+
+
+@router.post("/usuarios/{user_id}/copias/{version}/restaurar")
+def restaurar_copia(
+    user_id: int,
+    version: int,
+    tarefas: BackgroundTasks,
+    db: Session = Depends(get_db),
+    _: UsuarioLogado = Depends(admin_required)
+):
+    if not db.query(Usuario.id).filter(Usuario.id == user_id).first():
+        raise HTTPException(
+            status_code=404,
+            detail="Usuário não encontrado"
+        )
+    snap = sync_routes.restaurar_versao(db, user_id, version, tarefas)
+    return {
+        "success": True,
+        "version": snap.version,
+        "message": f"Versão {version} restaurada como versão {snap.version}"
+    }
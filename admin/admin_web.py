@@ -4,17 +4,27 @@ import csv
 import secrets
 from urllib.parse import quote
 from fastapi import APIRouter, Request, Form, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
 from database import SessionLocal
-from models import Usuario, DbSnapshot, DeviceAtividade, AceiteTermos, Plano, Assinatura, AsaasEvento
-from auth import verify_password, hash_password
+from models import (
+    AcessoEfetivo, AcessoHistorico, AceiteTermos, AsaasEvento, Assinatura, DeviceAtividade,
+    Plano, RefreshToken, Usuario,
+)
+from auth import (
+    esquecer_usuario, hash_password, hash_password_async, precisa_refazer,
+    revogar_tokens_do_usuario, verify_password_async,
+)
 from email_service import enviar_confirmacao, enviar_link_assinatura, enviar_link_nova_senha
 from termos_config import TERMOS_VERSAO, POLITICA_VERSAO
 from asaas.asaas_client import AsaasError
 import assinatura_service
+import chunk_store
+from limite_login import ip_do_cliente, limitador_de_login
+from sync_routes import apagar_copias_do_usuario, apagar_blobs, atividade_dispositivos
 from datetime import date, datetime, timedelta
 
 # -------------------------------------------------
@@ -133,18 +143,29 @@ def login_page(request: Request):
 
 
 # -------------------------------------------------
-# LOGIN (POST)
+# LOGIN (POST) — async: o bcrypt roda no pool de senhas (auth.py)
 # -------------------------------------------------
 @router.post("/login")
-def login_action(
+async def login_action(
     request: Request,
     email: str = Form(...),
     senha: str = Form(...),
     db: Session = Depends(get_db)
 ):
-    user = db.query(Usuario).filter(Usuario.email == email).first()
+    ip = ip_do_cliente(request)
+    if await limitador_de_login.conferir_async(ip, email):
+        return templates.TemplateResponse(
+            request,
+            "login.html",
+            {"error": "Muitas tentativas. Aguarde alguns minutos e tente de novo."},
+            status_code=429,
+        )
 
-    if not user or not verify_password(senha, user.senha_hash):
+    user = await run_in_threadpool(
+        lambda: db.query(Usuario).filter(Usuario.email == email).first()
+    )
+
+    if not user or not await verify_password_async(senha, user.senha_hash):
         return templates.TemplateResponse(
             request,
             "login.html",
@@ -158,6 +179,11 @@ def login_action(
             {"error": "Acesso restrito ao administrador"}
         )
 
+    await run_in_threadpool(limitador_de_login.sucesso, ip, email)
+    if precisa_refazer(user.senha_hash):
+        user.senha_hash = await hash_password_async(senha)
+        await run_in_threadpool(db.commit)
+
     request.session["admin_id"] = user.id
 
     return RedirectResponse("/admin/dashboard", status_code=302)
@@ -452,6 +478,9 @@ def alterar_status_usuario(
 
     usuario.status = novo_status
     db.commit()
+    assinatura_service.acesso_mudou(db, user_id, "admin")
+    if novo_status != "ativo":
+        revogar_tokens_do_usuario(db, user_id)
 
     return RedirectResponse("/admin/usuarios", status_code=302)
 
@@ -506,12 +535,21 @@ def excluir_usuario_action(
 
     # Apaga primeiro as cópias do banco na nuvem e os registros de aparelho
     # deste usuário (senão o banco recusa excluir por causa dos vínculos).
-    db.query(DbSnapshot).filter(DbSnapshot.user_id == usuario.id).delete()
+    blobs = apagar_copias_do_usuario(db, usuario.id)
+    atividade_dispositivos.esquecer(lambda chave: chave[0] == usuario.id)
     db.query(DeviceAtividade).filter(DeviceAtividade.user_id == usuario.id).delete()
     db.query(AceiteTermos).filter(AceiteTermos.user_id == usuario.id).delete()
     db.query(Assinatura).filter(Assinatura.user_id == usuario.id).delete()
+    db.query(RefreshToken).filter(RefreshToken.user_id == usuario.id).delete()
+    db.query(AcessoEfetivo).filter(AcessoEfetivo.user_id == usuario.id).delete()
+    # O histórico de acesso fica (auditoria), com a exclusão registrada.
+    db.add(AcessoHistorico(user_id=usuario.id, liberado=0, motivo="conta_excluida", origem="admin"))
     db.delete(usuario)
     db.commit()
+    esquecer_usuario(user_id)
+    revogar_tokens_do_usuario(db, user_id)
+    apagar_blobs(blobs)
+    chunk_store.coletar_lixo(db)
     return RedirectResponse("/admin/usuarios?ok=excluido", status_code=302)
 
 
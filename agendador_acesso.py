@@ -0,0 +1,68 @@
+# ===============================================================
+# PRAZOS DO ACESSO EFETIVO (liberação manual com data para acabar)
+# ---------------------------------------------------------------
+# Uma liberação manual com prazo (definir_controle(..., dias=N)) vira
+# acesso_efetivo com 'valido_ate'. Quando o prazo passa, a decisão
+# precisa voltar ao automático (Asaas) — sem esperar o cliente logar.
+# Este trabalho, a cada ACESSO_AGENDADOR_MIN minutos, recalcula as
+# contas com o prazo vencido (origem "prazo" no histórico).
+#
+# O login também confere o prazo na hora (acesso_vigente), então o
+# agendador só mantém a tabela e o histórico em dia para quem lê.
+#
+# Rodar uma rodada na mão:  python agendador_acesso.py
+# ===============================================================
+import os
+import threading
+import time
+from datetime import datetime
+
+from database import SessionLocal
+from models import AcessoEfetivo
+import assinatura_service
+
+ACESSO_AGENDADOR = os.getenv("ACESSO_AGENDADOR", "1") == "1"
+ACESSO_AGENDADOR_MIN = float(os.getenv("ACESSO_AGENDADOR_MIN", "5"))
+
+_thread = None
+
+
+def rodada() -> int:
+    """Recalcula as contas com o prazo vencido. Devolve quantas."""
+    db = SessionLocal()
+    try:
+        vencidos = [
+            user_id for (user_id,) in db.query(AcessoEfetivo.user_id).filter(
+                AcessoEfetivo.valido_ate.isnot(None),
+                AcessoEfetivo.valido_ate <= datetime.utcnow(),
+            ).all()
+        ]
+        for user_id in vencidos:
+            assinatura_service.acesso_mudou(db, user_id, "prazo")
+        if vencidos:
+            print(f"[acesso] {len(vencidos)} prazo(s) vencido(s) recalculado(s).")
+        return len(vencidos)
+    finally:
+        db.close()
+
+
+def _rodar():
+    while True:
+        try:
+            rodada()
+        except Exception as e:
+            print("[acesso] erro na rodada:", e)
+        time.sleep(ACESSO_AGENDADOR_MIN * 60)
+
+
+def iniciar():
+    """Liga o agendador (ACESSO_AGENDADOR=1). Chamado uma vez na subida."""
+    global _thread
+    if not ACESSO_AGENDADOR or _thread is not None:
+        return
+    _thread = threading.Thread(target=_rodar, name="acesso-prazos", daemon=True)
+    _thread.start()
+
+
+if __name__ == "__main__":
+    print(f"✅ {rodada()} conta(s) recalculada(s).")
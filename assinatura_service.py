@@ -8,8 +8,11 @@
 import json
 from datetime import datetime, date, timedelta
 
+from sqlalchemy.exc import IntegrityError
+
 from asaas.asaas_client import AsaasClient, AsaasError
-from models import Assinatura, Plano, AsaasEvento, Usuario
+from auth import esquecer_usuario
+from models import AcessoEfetivo, AcessoHistorico, Assinatura, Plano, AsaasEvento, Usuario
 
 
 def get_plano(db, codigo):
@@ -49,6 +52,7 @@ def get_or_create_assinatura(db, user):
         a = Assinatura(user_id=user.id, status="pending_payment", controle="automatico")
         db.add(a)
         db.commit()
+        acesso_mudou(db, user.id, "assinatura")
         db.refresh(a)
     return a
 
@@ -157,6 +161,7 @@ def criar_assinatura_completa(db, user, cartao, titular, remote_ip):
     user.token_expira = None
 
     db.commit()
+    acesso_mudou(db, user.id, "assinatura")
     return a
 
 
@@ -190,6 +195,7 @@ def alterar_plano(db, assinatura, codigo):
     assinatura.valor = float(plano.valor)
     assinatura.atualizado_em = datetime.utcnow()
     db.commit()
+    acesso_mudou(db, assinatura.user_id, "admin")
     return assinatura
 
 
@@ -224,6 +230,7 @@ def cancelar(db, assinatura):
     assinatura.cancelado_em = datetime.utcnow()
     assinatura.atualizado_em = datetime.utcnow()
     db.commit()
+    acesso_mudou(db, assinatura.user_id, "cancelamento")
     return assinatura
 
 
@@ -247,6 +254,7 @@ def definir_controle(db, assinatura, controle, dias=None):
 
     assinatura.atualizado_em = datetime.utcnow()
     db.commit()
+    acesso_mudou(db, assinatura.user_id, "admin")
     return assinatura
 
 
@@ -291,6 +299,7 @@ def desvincular_asaas(db, user_id):
     for a in assinaturas:
         db.delete(a)
     db.commit()
+    acesso_mudou(db, user_id, "admin")
     return len(assinaturas)
 
 
@@ -368,6 +377,7 @@ def sincronizar(db, assinatura):
     assinatura.last_sync = datetime.utcnow()
     assinatura.atualizado_em = datetime.utcnow()
     db.commit()
+    acesso_mudou(db, assinatura.user_id, "sincronizar")
     return assinatura
 
 
@@ -477,13 +487,14 @@ def acesso_liberado(db, user):
     automático (Asaas). Cliente SEM assinatura = grandfathered (cliente antigo)."""
     if user.status == "bloqueado":
         return False, "bloqueado_admin"
+    return decidir_acesso(user, assinatura_do_usuario(db, user.id))
 
-    a = (
-        db.query(Assinatura)
-        .filter(Assinatura.user_id == user.id)
-        .order_by(Assinatura.id.desc())
-        .first()
-    )
+
+def decidir_acesso(user, a):
+    """O mesmo que acesso_liberado, com a assinatura mais recente (ou None)
+    já carregada — o login busca tudo numa query só."""
+    if user.status == "bloqueado":
+        return False, "bloqueado_admin"
     if not a:
         # cliente antigo (criado antes das assinaturas) -> segue o status do usuário
         return (user.status == "ativo"), "sem_assinatura"
@@ -502,6 +513,90 @@ def acesso_liberado(db, user):
     return False, (a.status or "pending_payment")
 
 
+# ===============================================================
+# ACESSO EFETIVO (decisão materializada — ver models.AcessoEfetivo)
+# ---------------------------------------------------------------
+# Quem muda status, assinatura ou override chama acesso_mudou() depois
+# do commit: recalcula a linha da conta, registra a mudança no
+# histórico e avisa o cache do get_current_user.
+# ===============================================================
+def recalcular_acesso(db, user_id, origem):
+    """Recalcula e grava a decisão de acesso da conta. Se mudou, entra uma
+    linha em acesso_historico. Devolve a linha (None se a conta não existe)."""
+    for tentativa in range(2):
+        try:
+            return _recalcular_acesso(db, user_id, origem)
+        except IntegrityError:
+            # Dois primeiros acessos ao mesmo tempo: o outro criou a linha
+            # antes. De novo, agora sobre ela (travada pelo FOR UPDATE).
+            db.rollback()
+            if tentativa:
+                raise
+
+
+def _recalcular_acesso(db, user_id, origem):
+    atual = (
+        db.query(AcessoEfetivo)
+        .filter(AcessoEfetivo.user_id == user_id)
+        .with_for_update()
+        .first()
+    )
+    user = db.get(Usuario, user_id)
+    if user is None:
+        if atual is not None:
+            db.delete(atual)
+            db.commit()
+        return None
+
+    a = assinatura_do_usuario(db, user_id)
+    liberado, motivo = decidir_acesso(user, a)
+    valido_ate = a.controle_ate if motivo == "liberado_manual" else None
+    agora = datetime.utcnow()
+    if atual is None:
+        atual = AcessoEfetivo(user_id=user_id)
+        db.add(atual)
+        mudou = True
+    else:
+        mudou = (bool(atual.liberado), atual.motivo, atual.valido_ate) != (liberado, motivo, valido_ate)
+    atual.liberado = 1 if liberado else 0
+    atual.motivo = motivo
+    atual.valido_ate = valido_ate
+    atual.atualizado_em = agora
+    if mudou:
+        db.add(AcessoHistorico(
+            user_id=user_id, liberado=atual.liberado, motivo=motivo,
+            valido_ate=valido_ate, origem=origem, criado_em=agora,
+        ))
+    db.commit()
+    return atual
+
+
+def acesso_mudou(db, user_id, origem):
+    """Chamado depois de qualquer mudança que possa afetar o acesso."""
+    recalcular_acesso(db, user_id, origem)
+    esquecer_usuario(user_id)
+
+
+def acesso_vigente(db, user, efetivo=None):
+    """(liberado, motivo) pela linha materializada — 'efetivo' se já veio
+    junto na query. Sem linha, ou com o prazo vencido, recalcula."""
+    if efetivo is None:
+        efetivo = db.get(AcessoEfetivo, user.id)
+    if efetivo is None or (efetivo.valido_ate and efetivo.valido_ate < datetime.utcnow()):
+        efetivo = recalcular_acesso(db, user.id, "prazo" if efetivo else "leitura")
+    return bool(efetivo.liberado), efetivo.motivo
+
+
+def historico_de_acesso(db, user_id, limite=50):
+    return (
+        db.query(AcessoHistorico)
+        .filter(AcessoHistorico.user_id == user_id)
+        .order_by(AcessoHistorico.id.desc())
+        .limit(limite)
+        .all()
+    )
+
+
 # ===============================================================
 # WEBHOOK (idempotente + histórico)
 # ===============================================================
@@ -565,3 +660,5 @@ def processar_webhook(db, payload):
         ev.processado = 1
 
     db.commit()
+    if assinatura:
+        acesso_mudou(db, assinatura.user_id, "webhook")
@@ -1,20 +1,39 @@
+import asyncio
+import hashlib
 import os
+import secrets
+import threading
+import time
+import uuid
 import bcrypt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from typing import Optional
 from jose import jwt, JWTError
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 
 from database import SessionLocal
-from models import Usuario
+from models import Assinatura, Plano, RefreshToken, Usuario
+import chaves_jwt
+import notificacoes
+import revogacao
 
 # =====================================================
 # 🔐 CONFIGURAÇÕES DO TOKEN
 # =====================================================
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "PROJETAGRO_SUPER_SECRET_KEY_123")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_DAYS = 7  
+# HS256 (segredo compartilhado) ou RS256 (chaves em chaves_jwt.py, conferível
+# por outros serviços pelo /.well-known/jwks.json).
+ALGORITHM = os.getenv("JWT_ALGORITMO", "HS256").strip().upper()
+# Na troca para RS256, os tokens HS256 já emitidos seguem valendo até vencer.
+JWT_ACEITAR_HS256 = os.getenv("JWT_ACEITAR_HS256", "1") == "1"
+ACCESS_TOKEN_EXPIRE_DAYS = 7    # apps antigos (não renovam): token de 7 dias
+ACCESS_TOKEN_MINUTOS = int(os.getenv("ACCESS_TOKEN_MINUTOS", "15"))
+REFRESH_TOKEN_DIAS = int(os.getenv("REFRESH_TOKEN_DIAS", "30"))
 
 security = HTTPBearer()
 
@@ -29,27 +48,241 @@ def get_db():
         db.close()
 
 # =====================================================
-# 🔐 SENHA
+# 🔐 SENHA — algoritmos plugáveis (bcrypt / Argon2id)
+# -----------------------------------------------------
+# Senhas NOVAS usam SENHA_ALGORITMO com os custos configurados:
+#   bcrypt   -> BCRYPT_ROUNDS (padrão 12)
+#   argon2id -> ARGON2_TEMPO, ARGON2_MEMORIA_KB, ARGON2_PARALELISMO
+#               (precisa do pacote 'argon2-cffi'; sem ele, fica bcrypt)
+# Cada hash guarda o próprio algoritmo e custo ($2b$12$..., $argon2id$
+# v=19$m=...), então senhas antigas continuam valendo. No login certo,
+# se o hash foi feito com outro algoritmo ou custo (precisa_refazer),
+# a senha é refeita na hora com os parâmetros atuais.
+# Para escolher os custos nesta máquina: python calibrar_senha.py
 # =====================================================
+try:
+    import argon2
+except ImportError:  # opcional
+    argon2 = None
+
+SENHA_ALGORITMO = os.getenv("SENHA_ALGORITMO", "bcrypt").strip().lower()
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+ARGON2_TEMPO = int(os.getenv("ARGON2_TEMPO", "3"))
+ARGON2_MEMORIA_KB = int(os.getenv("ARGON2_MEMORIA_KB", "65536"))
+ARGON2_PARALELISMO = int(os.getenv("ARGON2_PARALELISMO", "4"))
+
+
+class HasherBcrypt:
+    nome = "bcrypt"
+
+    def __init__(self, rounds: int = BCRYPT_ROUNDS):
+        self.rounds = rounds
+
+    def reconhece(self, hashed: str) -> bool:
+        return hashed.startswith(("$2a$", "$2b$", "$2y$"))
+
+    def gerar(self, password: str) -> str:
+        return bcrypt.hashpw(
+            password.encode("utf-8"),
+            bcrypt.gensalt(self.rounds)
+        ).decode("utf-8")
+
+    def conferir(self, password: str, hashed: str) -> bool:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+    def desatualizado(self, hashed: str) -> bool:
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+class HasherArgon2id:
+    nome = "argon2id"
+
+    def __init__(self, tempo: int = ARGON2_TEMPO, memoria_kb: int = ARGON2_MEMORIA_KB,
+                 paralelismo: int = ARGON2_PARALELISMO):
+        self._ph = argon2.PasswordHasher(
+            time_cost=tempo, memory_cost=memoria_kb, parallelism=paralelismo,
+            type=argon2.Type.ID,
+        )
+
+    def reconhece(self, hashed: str) -> bool:
+        return hashed.startswith("$argon2id$")
+
+    def gerar(self, password: str) -> str:
+        return self._ph.hash(password)
+
+    def conferir(self, password: str, hashed: str) -> bool:
+        try:
+            return self._ph.verify(hashed, password)
+        except argon2.exceptions.VerificationError:
+            return False
+        except argon2.exceptions.InvalidHashError:
+            return False
+
+    def desatualizado(self, hashed: str) -> bool:
+        return self._ph.check_needs_rehash(hashed)
+
+
+_hashers = {}
+
+
+def registrar_hasher(hasher):
+    """Registra (ou troca) um algoritmo de senha pelo nome dele."""
+    _hashers[hasher.nome] = hasher
+
+
+registrar_hasher(HasherBcrypt())
+if argon2 is not None:
+    registrar_hasher(HasherArgon2id())
+
+
+def hasher_atual():
+    """O algoritmo das senhas novas (SENHA_ALGORITMO)."""
+    hasher = _hashers.get(SENHA_ALGORITMO)
+    if hasher is None:
+        return _hashers["bcrypt"]
+    return hasher
+
+
+if SENHA_ALGORITMO not in _hashers:
+    print(f"[senha] SENHA_ALGORITMO={SENHA_ALGORITMO} indisponível "
+          "(instale 'argon2-cffi'?); usando bcrypt.")
+
+
+def _hasher_do(hashed: str):
+    for hasher in _hashers.values():
+        if hasher.reconhece(hashed or ""):
+            return hasher
+    return None
+
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(
-        password.encode("utf-8"),
-        bcrypt.gensalt()
-    ).decode("utf-8")
+    return hasher_atual().gerar(password)
 
 def verify_password(password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(
-        password.encode("utf-8"),
-        hashed_password.encode("utf-8")
-    )
+    hasher = _hasher_do(hashed_password)
+    if hasher is None:
+        # Ex.: hash argon2id num servidor sem 'argon2-cffi'.
+        return False
+    return hasher.conferir(password, hashed_password)
+
+def precisa_refazer(hashed_password: str) -> bool:
+    """O hash foi feito com outro algoritmo ou outro custo que os atuais?"""
+    atual = hasher_atual()
+    return not atual.reconhece(hashed_password) or atual.desatualizado(hashed_password)
+
+# =====================================================
+# 🧵 POOL DO BCRYPT (rotas async)
+# -----------------------------------------------------
+# O bcrypt é lento DE PROPÓSITO (~200 ms de CPU). Rodando direto nas
+# rotas síncronas, uma leva de logins ocupa o threadpool que também
+# atende o /api/sync e o webhook. As rotas de senha (login do app e do
+# admin, definir/nova senha) são async e mandam o bcrypt para ESTE
+# pool: poucas threads (SENHA_THREADS; o bcrypt solta o GIL) e uma fila
+# limitada (SENHA_FILA_MAX). Fila cheia -> 503 na hora, em vez de
+# empilhar pedidos que já vão chegar atrasados.
+# Métricas: GET /admin/metricas.
+# =====================================================
+SENHA_THREADS = int(os.getenv("SENHA_THREADS", "2"))
+SENHA_FILA_MAX = int(os.getenv("SENHA_FILA_MAX", "64"))
+
+
+class _PoolDeSenhas:
+    def __init__(self, threads: int, fila_max: int):
+        self.threads = threads
+        self.fila_max = fila_max
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="senha")
+        self._trava = threading.Lock()
+        self.na_fila = 0
+        self.rodando = 0
+        self.concluidos = 0
+        self.recusados = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+
+    async def rodar(self, funcao, *args):
+        with self._trava:
+            if self.na_fila >= self.fila_max:
+                self.recusados += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Muitos acessos ao mesmo tempo. Tente de novo em instantes.",
+                    headers={"Retry-After": "2"},
+                )
+            self.na_fila += 1
+        entrou = time.monotonic()
+
+        def tarefa():
+            espera = time.monotonic() - entrou
+            with self._trava:
+                self.na_fila -= 1
+                self.rodando += 1
+                self.espera_total += espera
+                self.espera_max = max(self.espera_max, espera)
+            try:
+                return funcao(*args)
+            finally:
+                with self._trava:
+                    self.rodando -= 1
+                    self.concluidos += 1
+
+        def saiu(futuro):
+            # Pedido cancelado ainda na fila (cliente desconectou, timeout):
+            # a tarefa nunca roda, então a vaga é devolvida aqui.
+            if futuro.cancelled():
+                with self._trava:
+                    self.na_fila -= 1
+
+        try:
+            futuro = self._executor.submit(tarefa)
+        except BaseException:
+            with self._trava:
+                self.na_fila -= 1
+            raise
+        futuro.add_done_callback(saiu)
+        return await asyncio.wrap_future(futuro)
+
+    def estatisticas(self) -> dict:
+        with self._trava:
+            return {
+                "threads": self.threads,
+                "fila_max": self.fila_max,
+                "na_fila": self.na_fila,
+                "rodando": self.rodando,
+                "concluidos": self.concluidos,
+                "recusados": self.recusados,
+                "espera_media_ms": round(self.espera_total / self.concluidos * 1000, 1)
+                if self.concluidos else 0.0,
+                "espera_max_ms": round(self.espera_max * 1000, 1),
+            }
+
+
+pool_de_senhas = _PoolDeSenhas(SENHA_THREADS, SENHA_FILA_MAX)
+
+
+async def hash_password_async(password: str) -> str:
+    return await pool_de_senhas.rodar(hash_password, password)
+
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    return await pool_de_senhas.rodar(verify_password, password, hashed_password)
 
 # =====================================================
 # 🔑 TOKEN JWT
 # =====================================================
-def create_access_token(data: dict) -> str:
+def create_access_token(data: dict, validade: timedelta = None) -> str:
+    """Token de acesso. Sem 'validade', o de 7 dias dos apps antigos. Todo
+    token leva 'jti' e 'iat' (com fração de segundo) para poder ser
+    revogado (revogacao.py)."""
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire})
+    expire = datetime.utcnow() + (validade or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
+    to_encode.update({"exp": expire, "iat": time.time(), "jti": uuid.uuid4().hex})
+
+    if ALGORITHM == "RS256":
+        kid, chave = chaves_jwt.chave_de_assinatura()
+        return jwt.encode(to_encode, chave, algorithm="RS256", headers={"kid": kid})
 
     return jwt.encode(
         to_encode,
@@ -57,18 +290,310 @@ def create_access_token(data: dict) -> str:
         algorithm=ALGORITHM
     )
 
+def _conferir_jwt(token: str) -> dict:
+    """jwt.decode com a chave certa para o cabeçalho do token: RS256 pela
+    chave pública do 'kid'; HS256 pelo segredo (se ainda aceito). O
+    algoritmo nunca é escolhido pela chave — só os dois permitidos."""
+    cabecalho = jwt.get_unverified_header(token)
+    alg = cabecalho.get("alg")
+    if alg == "RS256":
+        chave = chaves_jwt.chave_publica(cabecalho.get("kid"))
+        if chave is None:
+            raise JWTError("kid desconhecido")
+        return jwt.decode(token, chave, algorithms=["RS256"])
+    if alg == "HS256" and (ALGORITHM == "HS256" or JWT_ACEITAR_HS256):
+        return jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+    raise JWTError("algoritmo não aceito")
+
+def create_short_access_token(data: dict) -> str:
+    """Token de acesso curto (ACCESS_TOKEN_MINUTOS), para o app que renova."""
+    return create_access_token(data, timedelta(minutes=ACCESS_TOKEN_MINUTOS))
+
+# =====================================================
+# 🔄 REFRESH TOKEN (rotativo)
+# -----------------------------------------------------
+# Opaco (não é JWT) e guardado só como SHA-256. Cada uso troca por um
+# novo na mesma família. Reusar um já trocado = alguém copiou o token:
+# caem todos os tokens da conta (acesso e refresh), não só a família.
+# =====================================================
+class RefreshInvalido(Exception):
+    pass
+
+
+def _hash_refresh(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def criar_refresh_token(db: Session, user_id: int, familia: str = None) -> str:
+    """Cria (sem commit) um refresh token para a conta; devolve o token."""
+    token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        user_id=user_id,
+        token_hash=_hash_refresh(token),
+        familia=familia or uuid.uuid4().hex,
+        expira_em=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_DIAS),
+    ))
+    return token
+
+
+def girar_refresh_token(db: Session, token: str):
+    """Consome o refresh e devolve (user_id, refresh novo), já gravado.
+    Levanta RefreshInvalido se ele não vale mais."""
+    agora = datetime.utcnow()
+    linha = db.query(RefreshToken).filter(
+        RefreshToken.token_hash == _hash_refresh(token)
+    ).first()
+    if not linha or linha.revogado_em or linha.expira_em < agora:
+        raise RefreshInvalido()
+    if linha.usado_em:
+        # Já foi trocado: alguém tem uma cópia — e pode ter um token de
+        # acesso tirado dela. Derruba tudo o que a conta tem.
+        revogar_tokens_do_usuario(db, linha.user_id)
+        print(f"[tokens] reuso de refresh token: tokens da conta revogados (user={linha.user_id})")
+        raise RefreshInvalido()
+
+    # Compare-and-set: de duas trocas ao mesmo tempo, só uma vale.
+    trocou = db.query(RefreshToken).filter(
+        RefreshToken.id == linha.id, RefreshToken.usado_em.is_(None)
+    ).update({"usado_em": agora}, synchronize_session=False)
+    if trocou != 1:
+        db.rollback()
+        raise RefreshInvalido()
+    novo = criar_refresh_token(db, linha.user_id, linha.familia)
+    db.commit()
+    return linha.user_id, novo
+
+
+def revogar_tokens_do_usuario(db: Session, user_id: int):
+    """Corta todos os tokens (acesso e refresh) já emitidos para a conta:
+    bloqueio, exclusão, senha nova, refresh reusado."""
+    revogacao.revogar_usuario(db, user_id, timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
+    esquecer_tokens_do_usuario(user_id)
+
+
+def encerrar_sessao(db: Session, token: str, refresh_token: str = None):
+    """Logout: o token de acesso apresentado e a família do refresh token
+    (a sessão daquele aparelho) deixam de valer. Os outros aparelhos seguem."""
+    try:
+        payload = decodificar_token(token)
+    except JWTError:
+        payload = None   # já inválido: nada a revogar
+    if payload:
+        revogacao.revogar_token(db, payload)
+        esquecer_token(token)
+    if refresh_token:
+        linha = db.query(RefreshToken).filter(
+            RefreshToken.token_hash == _hash_refresh(refresh_token)
+        ).first()
+        if linha and (not payload or linha.user_id == payload.get("user_id")):
+            db.query(RefreshToken).filter(
+                RefreshToken.familia == linha.familia, RefreshToken.revogado_em.is_(None)
+            ).update({"revogado_em": datetime.utcnow()}, synchronize_session=False)
+            db.commit()
+
+# =====================================================
+# ⚡ CACHE DE TOKENS JÁ CONFERIDOS
+# -----------------------------------------------------
+# O app manda o MESMO token (7 dias) milhares de vezes. Conferido uma
+# vez (assinatura + claims), o conteúdo fica num LRU de até
+# TOKEN_CACHE_MAX tokens (0 = desligado), até o 'exp' do próprio token.
+# A chave é o SHA-256 do token — o token em si não fica em memória.
+#
+# Token revogado: esquecer_token(token) ou esquecer_tokens_do_usuario(id)
+# tira do cache (neste worker e, com a ponte, nos outros — canal
+# "tokens"); a próxima conferência completa decide. Chamados por
+# revogar_tokens_do_usuario (senha nova, bloqueio, exclusão, refresh
+# reusado) e encerrar_sessao (logout).
+# =====================================================
+TOKEN_CACHE_MAX = int(os.getenv("TOKEN_CACHE_MAX", "10000"))
+
+_trava_tokens = threading.Lock()
+_tokens = OrderedDict()   # sha256 do token -> (exp, payload)
+_tokens_acertos = 0
+_tokens_faltas = 0
+
+
+def _digest_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def decodificar_token(token: str) -> dict:
+    """_conferir_jwt com cache (ver acima). Levanta JWTError como ele."""
+    global _tokens_acertos, _tokens_faltas
+    if TOKEN_CACHE_MAX <= 0:
+        return _conferir_jwt(token)
+
+    chave = _digest_token(token)
+    agora = time.time()
+    with _trava_tokens:
+        item = _tokens.get(chave)
+        if item and item[0] > agora:
+            _tokens.move_to_end(chave)
+            _tokens_acertos += 1
+            return dict(item[1])
+        _tokens_faltas += 1
+        if item:
+            del _tokens[chave]
+
+    payload = _conferir_jwt(token)
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        with _trava_tokens:
+            _tokens[chave] = (exp, payload)
+            _tokens.move_to_end(chave)
+            while len(_tokens) > TOKEN_CACHE_MAX:
+                _tokens.popitem(last=False)
+    return dict(payload)
+
+
+def _descartar_tokens(chave, dados=None):
+    dados = dados or {}
+    with _trava_tokens:
+        if dados.get("user_id") is not None:
+            for k in [k for k, (_, p) in _tokens.items()
+                      if p.get("user_id") == dados["user_id"]]:
+                del _tokens[k]
+        else:
+            _tokens.pop(chave, None)
+
+
+def esquecer_token(token: str):
+    """O token foi revogado: a próxima requisição com ele é conferida
+    do zero (em todos os workers)."""
+    notificacoes.publicar("tokens", _digest_token(token))
+
+
+def esquecer_tokens_do_usuario(user_id: int):
+    """Todos os tokens do usuário saem do cache (ex.: troca de senha)."""
+    notificacoes.publicar("tokens", "*", {"user_id": user_id})
+
+
+notificacoes.ouvir("tokens", _descartar_tokens)
+
+
+def estatisticas_cache_tokens() -> dict:
+    with _trava_tokens:
+        return {
+            "max": TOKEN_CACHE_MAX,
+            "em_cache": len(_tokens),
+            "acertos": _tokens_acertos,
+            "faltas": _tokens_faltas,
+        }
+
+
+# =====================================================
+# ⚡ CACHE DO ESTADO DOS USUÁRIOS (get_current_user)
+# -----------------------------------------------------
+# Toda rota autenticada (/api/sync/*, /api/admin/*) só precisa saber
+# se a conta está "ativo", se é admin e a cota do sync (da conta ou do
+# plano). Esse estado (UsuarioLogado) fica em memória por
+# USUARIO_CACHE_SEG segundos (0 = desligado): o polling do sync
+# autentica sem ir ao banco, e o upload já sabe a cota.
+#
+# Quem muda status, conta ou assinatura chama esquecer_usuario(id) —
+# vale na hora, sem esperar o prazo. O aviso vai pelo canal "usuarios"
+# de notificacoes.py; com NOTIFY_POSTGRES=1, chega aos outros workers.
+# =====================================================
+USUARIO_CACHE_SEG = float(os.getenv("USUARIO_CACHE_SEG", "30"))
+
+_trava_estados = threading.Lock()
+_estados = {}      # user_id -> (expira_em, UsuarioLogado)
+_geracao = 0       # sobe a cada esquecer: leitura antiga não volta ao cache
+_acertos = 0
+_faltas = 0
+
+
+def _descartar_estado(chave, dados=None):
+    global _geracao
+    with _trava_estados:
+        _geracao += 1
+        if chave is None:
+            _estados.clear()
+        else:
+            _estados.pop(int(chave), None)
+
+
+def esquecer_usuario(user_id):
+    """O status/conta/assinatura do usuário mudou: o próximo request dele
+    relê do banco (neste worker e, com a ponte ligada, nos outros)."""
+    notificacoes.publicar("usuarios", user_id, {"evento": "mudou"})
+
+
+notificacoes.ouvir("usuarios", _descartar_estado)
+
+
+def _estado_do_cache(user_id):
+    global _acertos, _faltas
+    agora = time.monotonic()
+    with _trava_estados:
+        item = _estados.get(user_id)
+        if item and item[0] > agora:
+            _acertos += 1
+            return item
+        _faltas += 1
+        if item:
+            del _estados[user_id]
+    return None
+
+
+def estatisticas_cache_usuarios() -> dict:
+    with _trava_estados:
+        return {
+            "ttl_seg": USUARIO_CACHE_SEG,
+            "em_cache": len(_estados),
+            "acertos": _acertos,
+            "faltas": _faltas,
+        }
+
+
+@dataclass(frozen=True)
+class UsuarioLogado:
+    """O que get_current_user devolve: só o estado que as rotas autenticadas
+    usam (e que fica no cache). Precisa de outra coluna? db.get(Usuario, user.id)."""
+    id: int
+    status: str
+    is_admin: bool
+    cota_mb: Optional[int]          # cota da própria conta (usuarios.cota_mb)
+    cota_plano_mb: Optional[int]    # cota do plano da assinatura mais recente
+
+
+def _ler_estado(db: Session, user_id) -> Optional[UsuarioLogado]:
+    """Estado da conta numa query só (a cota do plano vem numa subquery)."""
+    cota_plano = (
+        db.query(Plano.cota_mb)
+        .join(Assinatura, Assinatura.plano == Plano.codigo)
+        .filter(Assinatura.user_id == Usuario.id)
+        .order_by(Assinatura.id.desc())
+        .limit(1)
+        .correlate(Usuario)
+        .scalar_subquery()
+    )
+    linha = (
+        db.query(Usuario.id, Usuario.status, Usuario.is_admin, Usuario.cota_mb,
+                 cota_plano.label("cota_plano_mb"))
+        .filter(Usuario.id == user_id)
+        .first()
+    )
+    if linha is None:
+        return None
+    return UsuarioLogado(
+        id=linha.id, status=linha.status, is_admin=bool(linha.is_admin),
+        cota_mb=linha.cota_mb, cota_plano_mb=linha.cota_plano_mb,
+    )
+
+
 # =====================================================
 # 👤 USUÁRIO LOGADO (BASE DO ADMIN)
 # =====================================================
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
-) -> Usuario:
+) -> UsuarioLogado:
 
     token = credentials.credentials
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decodificar_token(token)
         user_id = payload.get("user_id")
 
         if user_id is None:
@@ -83,7 +608,22 @@ def get_current_user(
             detail="Token inválido ou expirado"
         )
 
-    user = db.query(Usuario).filter(Usuario.id == user_id).first()
+    if revogacao.esta_revogado(payload):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token revogado"
+        )
+
+    item = _estado_do_cache(user_id) if USUARIO_CACHE_SEG > 0 else None
+    if item is not None:
+        user = item[1]
+    else:
+        geracao = _geracao
+        user = _ler_estado(db, user_id)
+        if user and USUARIO_CACHE_SEG > 0:
+            with _trava_estados:
+                if geracao == _geracao:
+                    _estados[user_id] = (time.monotonic() + USUARIO_CACHE_SEG, user)
 
     if not user:
         raise HTTPException(
@@ -100,7 +640,7 @@ def get_current_user(
     return user
 
 def admin_required(
-    user: Usuario = Depends(get_current_user)
+    user: UsuarioLogado = Depends(get_current_user)
 ):
     if not user.is_admin:
         raise HTTPException(
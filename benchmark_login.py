@@ -0,0 +1,206 @@
+# ===============================================================
+# BENCHMARK DO LOGIN DO APP (/api/login)
+# ---------------------------------------------------------------
+# Mede a latência do login e quantas idas ao banco ele faz (queries
+# e commits). Num banco na mesma máquina cada ida custa microssegundos;
+# no Railway, vários milissegundos — --latencia-ms soma esse atraso a
+# cada query/commit, para o número ficar parecido com o de produção.
+#
+# As contas do teste têm assinatura ativa e aceite dos termos atuais,
+# e o login confere o aceite (EXIGIR_ACEITE_LOGIN=1): passa por todas
+# as consultas do caminho feliz. O bcrypt usa --bcrypt-rounds (padrão
+# 4, bem barato) para o tempo medido ser o do banco, não o da senha.
+# A telemetria do login vai em lote (telemetria_login.py): o lote é
+# gravado no fim da medição e as idas dele entram na conta por login.
+#
+# COMO USAR:
+#   python benchmark_login.py                       -> 200 logins, 3 ms por ida
+#   python benchmark_login.py --saida novo.json --comparar antigo.json
+#
+# Para comparar dois commits: rode em cada um com --saida e use
+# --comparar no segundo (sai com erro se algo piorou além da tolerância).
+# ===============================================================
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+PASTA = os.path.dirname(os.path.abspath(__file__))
+SENHA = "benchmark-123"
+
+# (métrica, maior é melhor?)
+_METRICAS = [
+    ("p50_ms", False), ("p99_ms", False),
+    ("queries_por_login", False), ("commits_por_login", False),
+]
+
+
+def _criar_contas(n: int) -> list:
+    from auth import hash_password
+    from database import SessionLocal
+    from models import AceiteTermos, Assinatura, Usuario
+    from termos_config import POLITICA_VERSAO, TERMOS_VERSAO
+
+    senha_hash = hash_password(SENHA)
+    emails = [f"login-{i}@bench.agrivia" for i in range(n)]
+    db = SessionLocal()
+    try:
+        for email in emails:
+            u = Usuario(nome="Benchmark", email=email, senha_hash=senha_hash,
+                        status="ativo", email_verificado=1)
+            db.add(u)
+            db.flush()
+            db.add(Assinatura(user_id=u.id, plano="mensal", status="active"))
+            db.add(AceiteTermos(user_id=u.id, email=email, termos_versao=TERMOS_VERSAO,
+                                politica_versao=POLITICA_VERSAO))
+        db.commit()
+    finally:
+        db.close()
+    return emails
+
+
+class _Idas:
+    """Conta (e atrasa, para simular a rede) as queries e commits."""
+
+    def __init__(self, engine, latencia: float):
+        from sqlalchemy import event
+
+        self.queries = 0
+        self.commits = 0
+        self.latencia = latencia
+        event.listen(engine, "before_cursor_execute", self._query)
+        event.listen(engine, "commit", self._commit)
+
+    def _query(self, *args):
+        self.queries += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+
+    def _commit(self, *args):
+        self.commits += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+
+
+def medir(app, engine, emails: list, logins: int, latencia: float) -> dict:
+    from fastapi.testclient import TestClient
+    from benchmark_sync import percentil
+    import escrita_em_lote
+
+    idas = _Idas(engine, latencia)
+    latencias, erros = [], 0
+    with TestClient(app) as cliente:
+        # Aquecimento (imports preguiçosos, caches do SQLAlchemy).
+        cliente.post("/api/login", json={"email": emails[0], "senha": SENHA})
+        escrita_em_lote.descarregar_todos()
+        idas.queries = idas.commits = 0
+        for i in range(logins):
+            t0 = time.perf_counter()
+            r = cliente.post("/api/login", json={"email": emails[i % len(emails)],
+                                                 "senha": SENHA})
+            latencias.append(time.perf_counter() - t0)
+            erros += r.status_code != 200
+        # O que foi adiado (telemetria em lote) também conta.
+        escrita_em_lote.descarregar_todos()
+    return {
+        "logins": logins,
+        "erros": erros,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 2),
+        "p99_ms": round(percentil(latencias, 99) * 1000, 2),
+        "queries_por_login": round(idas.queries / logins, 2),
+        "commits_por_login": round(idas.commits / logins, 2),
+    }
+
+
+def comparar(novo: dict, antigo: dict, tolerancia: float) -> list:
+    """Imprime a diferença métrica a métrica. Devolve as pioras acima da
+    tolerância (em %)."""
+    print(f"\n[bench] comparando com {antigo.get('commit') or '?'}:")
+    pioras = []
+    for metrica, maior_melhor in _METRICAS:
+        v_novo = novo["resultado"].get(metrica)
+        v_antigo = antigo.get("resultado", {}).get(metrica)
+        if not v_novo or not v_antigo:
+            continue
+        variacao = (v_novo - v_antigo) / v_antigo * 100
+        piorou = -variacao if maior_melhor else variacao
+        marca = "  <-- PIOROU" if piorou > tolerancia else ""
+        print(f"  {metrica:<18} {v_antigo:>8} -> {v_novo:>8} ({variacao:+.1f}%){marca}")
+        if marca:
+            pioras.append((metrica, round(variacao, 1)))
+    return pioras
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark do login do app.")
+    p.add_argument("--logins", type=int, default=200)
+    p.add_argument("--contas", type=int, default=20)
+    p.add_argument("--latencia-ms", type=float, default=3.0,
+                   help="atraso somado a cada query/commit (rede até o banco)")
+    p.add_argument("--bcrypt-rounds", type=int, default=4)
+    p.add_argument("--saida", default=None, help="arquivo JSON do resultado")
+    p.add_argument("--comparar", default=None, help="JSON de outro commit para comparar")
+    p.add_argument("--tolerancia", type=float, default=20.0,
+                   help="piora máxima aceita (%%) no --comparar")
+    args = p.parse_args()
+
+    temp = tempfile.mkdtemp(prefix="agrivia-bench-login-")
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(temp, 'bench.db')}",
+        SNAPSHOT_DIR=os.path.join(temp, "snapshots"),
+        SNAPSHOT_CAMADAS_JOB="0",
+        NOTIFY_POSTGRES="0",
+        EXIGIR_ACEITE_LOGIN="1",
+        LOGIN_LIMITE="0",
+        BCRYPT_ROUNDS=str(args.bcrypt_rounds),
+    )
+    sys.path.insert(0, PASTA)
+    try:
+        import main as app_main   # aplica as migrações no banco do teste
+        from benchmark_sync import _commit
+        from database import engine
+
+        emails = _criar_contas(args.contas)
+        print(f"[bench] {args.logins} logins, {args.latencia_ms} ms por ida ao banco...")
+        resultado = medir(app_main.app, engine, emails, args.logins, args.latencia_ms / 1000)
+    finally:
+        import escrita_em_lote
+        escrita_em_lote.descarregar_todos()
+        shutil.rmtree(temp, ignore_errors=True)
+
+    commit = _commit()
+    saida = {
+        "commit": commit,
+        "quando": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "latencia_ms": args.latencia_ms,
+        "bcrypt_rounds": args.bcrypt_rounds,
+        "resultado": resultado,
+    }
+    caminho = args.saida or os.path.join(PASTA, "dados", "bench", f"login-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(saida, f, indent=2, ensure_ascii=False)
+
+    r = resultado
+    print(f"\n  login p50 {r['p50_ms']} ms p99 {r['p99_ms']} ms | "
+          f"{r['queries_por_login']} queries e {r['commits_por_login']} commits por login"
+          + (f" | erros {r['erros']}" if r["erros"] else ""))
+    print(f"✅ Resultado em {caminho}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            pioras = comparar(saida, json.load(f), args.tolerancia)
+        if pioras:
+            print(f"❌ {len(pioras)} métrica(s) pioraram mais de {args.tolerancia}%.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
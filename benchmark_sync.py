@@ -0,0 +1,540 @@
+# ===============================================================
+# BENCHMARK DO SYNC (upload / download de cópias do banco)
+# ---------------------------------------------------------------
+# Mede como /api/sync/upload e /api/sync/download se comportam quando
+# o banco do cliente cresce. Para cada tamanho:
+#
+#   1) gera (uma vez, com semente fixa) um SQLite sintético parecido
+#      com o do AGRIVIA: animais, lotes, pesagens, movimentações.
+#      Dois arquivos por tamanho (A e B, diferem numa linha) para os
+#      uploads seguidos não caírem no "upload igual";
+#   2) modo "processo": as rotas no mesmo processo (TestClient), um
+#      cliente só, uploads e downloads em sequência;
+#   3) modo "concorrente": servidor uvicorn num processo à parte e N
+#      clientes HTTP ao mesmo tempo (cada um com a sua conta).
+#
+# Relata, por tamanho e modo: vazão (MB/s de arquivo compactado),
+# latência p50/p99 por requisição e o PICO DE MEMÓRIA (RSS) do
+# processo que roda o servidor. No modo "processo" o RSS inclui o
+# cliente de teste (que junta o corpo da requisição na memória) e a
+# latência do upload inclui a tarefa de fundo (blocos), que o
+# TestClient espera terminar.
+#
+# O resultado vai para um JSON; --comparar mostra a diferença para um
+# JSON de outro commit e sai com erro se algo piorou além da tolerância.
+#
+# COMO USAR:
+#   python benchmark_sync.py                          -> 1, 10 e 100 MB
+#   python benchmark_sync.py --tamanhos 1,10,100,1024 --clientes 8
+#   python benchmark_sync.py --saida novo.json --comparar antigo.json
+#
+# Roda num banco e numa pasta de cópias TEMPORÁRIOS (SQLite). Para
+# medir no Postgres: --banco-url postgresql://... (use um banco de teste!)
+# ===============================================================
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+PASTA = os.path.dirname(os.path.abspath(__file__))
+MB = 1024 * 1024
+SEMENTE = 20240601
+SENHA = "benchmark-123"
+
+# Linhas por INSERT em lote na geração dos bancos sintéticos.
+_LOTE_GERACAO = 20000
+
+
+# ---------------------------------------------------------------
+# BANCOS SINTÉTICOS
+# ---------------------------------------------------------------
+_ESQUEMA = """
+CREATE TABLE lotes (
+    id INTEGER PRIMARY KEY, nome TEXT, pasto TEXT, area_ha REAL, criado_em TEXT
+);
+CREATE TABLE animais (
+    id INTEGER PRIMARY KEY, brinco TEXT, raca TEXT, sexo TEXT, nascimento TEXT,
+    lote_id INTEGER REFERENCES lotes(id), peso_entrada REAL, situacao TEXT, obs TEXT
+);
+CREATE TABLE pesagens (
+    id INTEGER PRIMARY KEY, animal_id INTEGER REFERENCES animais(id),
+    data TEXT, peso REAL, gmd REAL
+);
+CREATE TABLE movimentacoes (
+    id INTEGER PRIMARY KEY, tipo TEXT, data TEXT, valor REAL, descricao TEXT,
+    animal_id INTEGER, lote_id INTEGER
+);
+CREATE INDEX ix_pesagens_animal ON pesagens (animal_id, data);
+CREATE INDEX ix_animais_lote ON animais (lote_id);
+"""
+
+_RACAS = ["Nelore", "Angus", "Brahman", "Girolando", "Senepol", "Tabapuã", "Cruzado"]
+_TIPOS = ["compra", "venda", "vacina", "vermifugo", "racao", "frete", "sal mineral"]
+_PALAVRAS = ("pasto seco cocho agua vacina lote entrada saida manejo curral "
+             "brinco desmama engorda recria suplemento chuva").split()
+
+
+def _texto(rnd, n):
+    return " ".join(rnd.choice(_PALAVRAS) for _ in range(n))
+
+
+def gerar_banco(caminho: str, tamanho_mb: int):
+    """Cria um SQLite com ~tamanho_mb MB (sempre igual para o mesmo tamanho)."""
+    rnd = random.Random(SEMENTE + tamanho_mb)
+    alvo = tamanho_mb * MB
+    con = sqlite3.connect(caminho)
+    try:
+        con.executescript(_ESQUEMA)
+        inicio = date(2019, 1, 1)
+        con.executemany("INSERT INTO lotes VALUES (?, ?, ?, ?, ?)", [
+            (i, f"Lote {i}", f"Pasto {rnd.randint(1, 40)}", round(rnd.uniform(5, 300), 1),
+             str(inicio + timedelta(days=rnd.randint(0, 2000))))
+            for i in range(1, 201)
+        ])
+        animal = pesagem = mov = 0
+        while os.path.getsize(caminho) < alvo:
+            animais, pesagens, movs = [], [], []
+            for _ in range(_LOTE_GERACAO // 10):
+                animal += 1
+                nasc = inicio + timedelta(days=rnd.randint(0, 2000))
+                animais.append((
+                    animal, f"BR{animal:08d}", rnd.choice(_RACAS), rnd.choice("MF"),
+                    str(nasc), rnd.randint(1, 200), round(rnd.uniform(150, 400), 1),
+                    rnd.choice(["ativo", "vendido", "morto"]), _texto(rnd, rnd.randint(0, 12)),
+                ))
+                peso = rnd.uniform(150, 400)
+                for k in range(8):
+                    pesagem += 1
+                    ganho = rnd.uniform(0.2, 1.4)
+                    peso += ganho * 30
+                    pesagens.append((pesagem, animal, str(nasc + timedelta(days=30 * k)),
+                                     round(peso, 1), round(ganho, 3)))
+                mov += 1
+                movs.append((mov, rnd.choice(_TIPOS), str(nasc), round(rnd.uniform(10, 9000), 2),
+                             _texto(rnd, rnd.randint(3, 20)), animal, rnd.randint(1, 200)))
+            con.executemany("INSERT INTO animais VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", animais)
+            con.executemany("INSERT INTO pesagens VALUES (?, ?, ?, ?, ?)", pesagens)
+            con.executemany("INSERT INTO movimentacoes VALUES (?, ?, ?, ?, ?, ?, ?)", movs)
+            con.commit()
+    finally:
+        con.close()
+
+
+def _compactar(origem: str, destino: str):
+    with open(origem, "rb") as f, gzip.open(destino, "wb", compresslevel=6) as g:
+        shutil.copyfileobj(f, g, MB)
+
+
+def preparar(cache: str, tamanho_mb: int) -> dict:
+    """Gera (ou reaproveita do cache) os arquivos A e B de um tamanho."""
+    os.makedirs(cache, exist_ok=True)
+    banco_a = os.path.join(cache, f"agrivia-{tamanho_mb}mb-a.db")
+    banco_b = os.path.join(cache, f"agrivia-{tamanho_mb}mb-b.db")
+    if not os.path.exists(banco_a + ".gz"):
+        print(f"[bench] gerando banco de {tamanho_mb} MB...")
+        parcial = banco_a + ".parcial"
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        gerar_banco(parcial, tamanho_mb)
+        os.replace(parcial, banco_a)
+        shutil.copyfile(banco_a, banco_b)
+        con = sqlite3.connect(banco_b)
+        con.execute("UPDATE animais SET obs = 'editado no benchmark' WHERE id = 1")
+        con.commit()
+        con.close()
+        _compactar(banco_a, banco_a + ".gz")
+        _compactar(banco_b, banco_b + ".gz")
+        os.remove(banco_a)
+        os.remove(banco_b)
+    return {
+        "arquivos": [banco_a + ".gz", banco_b + ".gz"],
+        "gzip_bytes": os.path.getsize(banco_a + ".gz"),
+    }
+
+
+# ---------------------------------------------------------------
+# MEDIÇÃO
+# ---------------------------------------------------------------
+def _rss_bytes(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class PicoRss:
+    """Acompanha o RSS de um processo (Linux: /proc) enquanto o bloco
+    'with' roda e guarda o maior valor visto. Fora do Linux fica None."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.pico = None
+        self._parar = threading.Event()
+
+    def _amostrar(self):
+        while True:
+            rss = _rss_bytes(self.pid)
+            if rss is not None and (self.pico is None or rss > self.pico):
+                self.pico = rss
+            if self._parar.wait(0.01):
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._amostrar, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._thread.join()
+
+
+def percentil(valores: list, p: float):
+    """Percentil pelo método do posto mais próximo (sem interpolar)."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    k = max(0, min(len(ordenados) - 1, -(-len(ordenados) * p // 100) - 1))
+    return ordenados[int(k)]
+
+
+def _resumo(latencias: list, erros: int, bytes_total: int, parede: float) -> dict:
+    return {
+        "requisicoes": len(latencias),
+        "erros": erros,
+        "mb_s": round(bytes_total / MB / parede, 2) if parede > 0 and bytes_total else None,
+        "p50_ms": round(percentil(latencias, 50) * 1000, 1) if latencias else None,
+        "p99_ms": round(percentil(latencias, 99) * 1000, 1) if latencias else None,
+    }
+
+
+def _multipart(limite: str, base_version: int, device_id: str, caminho: str):
+    """Corpo multipart do upload, lido do disco aos pedaços (o benchmark
+    não guarda o arquivo inteiro na memória do cliente)."""
+    yield (f"--{limite}\r\nContent-Disposition: form-data; name=\"base_version\"\r\n\r\n"
+           f"{base_version}\r\n--{limite}\r\nContent-Disposition: form-data; "
+           f"name=\"device_id\"\r\n\r\n{device_id}\r\n--{limite}\r\nContent-Disposition: "
+           f"form-data; name=\"arquivo\"; filename=\"banco.db.gz\"\r\n"
+           f"Content-Type: application/gzip\r\n\r\n").encode()
+    with open(caminho, "rb") as f:
+        while True:
+            bloco = f.read(MB)
+            if not bloco:
+                break
+            yield bloco
+    yield f"\r\n--{limite}--\r\n".encode()
+
+
+class _Cliente:
+    """Um aparelho: sobe A, B, A, B... (sempre na versão atual) e baixa."""
+
+    def __init__(self, http, url: str, token: str, arquivos: list, nome: str):
+        self.http = http
+        self.url = url
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.arquivos = arquivos
+        self.nome = nome
+        self.versao = 0
+        self.vez = 0
+
+    def upload(self):
+        limite = uuid.uuid4().hex
+        caminho = self.arquivos[self.vez % 2]
+        self.vez += 1
+        corpo = _multipart(limite, self.versao, self.nome, caminho)
+        headers = dict(self.headers, **{
+            "Content-Type": f"multipart/form-data; boundary={limite}"})
+        inicio = time.perf_counter()
+        if hasattr(self.http, "app"):
+            r = self.http.post(self.url + "/api/sync/upload", content=corpo, headers=headers)
+        else:
+            r = self.http.post(self.url + "/api/sync/upload", data=corpo, headers=headers)
+        gasto = time.perf_counter() - inicio
+        if r.status_code != 200:
+            return gasto, 0
+        self.versao = r.json()["version"]
+        return gasto, os.path.getsize(caminho)
+
+    def download(self):
+        inicio = time.perf_counter()
+        total = 0
+        if hasattr(self.http, "app"):
+            with self.http.stream("GET", self.url + "/api/sync/download",
+                                  headers=self.headers) as r:
+                ok = r.status_code == 200
+                for bloco in r.iter_bytes(MB):
+                    total += len(bloco)
+        else:
+            with self.http.get(self.url + "/api/sync/download", headers=self.headers,
+                               stream=True) as r:
+                ok = r.status_code == 200
+                for bloco in r.iter_content(MB):
+                    total += len(bloco)
+        return time.perf_counter() - inicio, total if ok else 0
+
+
+def _fase(clientes: list, repeticoes: int, operacao: str) -> dict:
+    """Roda 'repeticoes' vezes a operação em cada cliente, todos ao mesmo tempo."""
+    def rodar(cliente):
+        return [getattr(cliente, operacao)() for _ in range(repeticoes)]
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(len(clientes)) as ex:
+        medidas = [m for lista in ex.map(rodar, clientes) for m in lista]
+    parede = time.perf_counter() - inicio
+    latencias = [g for g, n in medidas if n]
+    return _resumo(latencias, sum(1 for _, n in medidas if not n),
+                   sum(n for _, n in medidas), parede)
+
+
+def _criar_contas(prefixo: str, n: int) -> list:
+    from auth import hash_password
+    from database import SessionLocal
+    from models import Usuario
+
+    senha_hash = hash_password(SENHA)
+    emails = [f"{prefixo}-{i}@bench.agrivia" for i in range(n)]
+    db = SessionLocal()
+    try:
+        for email in emails:
+            db.add(Usuario(nome="Benchmark", email=email, senha_hash=senha_hash,
+                           status="ativo", email_verificado=1))
+        db.commit()
+    finally:
+        db.close()
+    return emails
+
+
+def _token(http, url: str, email: str) -> str:
+    r = http.post(url + "/api/login", json={"email": email, "senha": SENHA})
+    r.raise_for_status()
+    return r.json()["token"]
+
+
+# ---------------------------------------------------------------
+# MODOS
+# ---------------------------------------------------------------
+def medir_em_processo(app, arquivos: list, repeticoes: int, rotulo: str) -> dict:
+    from fastapi.testclient import TestClient
+
+    http = TestClient(app)
+    email = _criar_contas(f"proc-{rotulo}", 1)[0]
+    cliente = _Cliente(http, "", _token(http, "", email), arquivos, "bench-proc")
+    with PicoRss(os.getpid()) as rss:
+        upload = _fase([cliente], repeticoes, "upload")
+        download = _fase([cliente], repeticoes, "download")
+    return {"upload": upload, "download": download, "pico_rss_mb": _mb(rss.pico)}
+
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def iniciar_servidor(env: dict):
+    """Sobe o app num uvicorn à parte (um worker). Devolve (processo, url)."""
+    porta = _porta_livre()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+         "--port", str(porta), "--log-level", "warning"],
+        cwd=PASTA, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{porta}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError("o servidor do benchmark não subiu")
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.1).close()
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("o servidor do benchmark não respondeu")
+
+
+def medir_concorrente(proc, url: str, arquivos: list, clientes: int,
+                      repeticoes: int, rotulo: str) -> dict:
+    import requests
+
+    emails = _criar_contas(f"conc-{rotulo}", clientes)
+    lista = []
+    for i, email in enumerate(emails):
+        http = requests.Session()
+        lista.append(_Cliente(http, url, _token(http, url, email), arquivos, f"bench-{i}"))
+    with PicoRss(proc.pid) as rss:
+        upload = _fase(lista, repeticoes, "upload")
+        download = _fase(lista, repeticoes, "download")
+    return {"upload": upload, "download": download, "pico_rss_mb": _mb(rss.pico)}
+
+
+def _mb(n):
+    return round(n / MB, 1) if n else None
+
+
+# ---------------------------------------------------------------
+# COMPARAÇÃO ENTRE COMMITS
+# ---------------------------------------------------------------
+# (métrica, maior é melhor?)
+_METRICAS = [
+    ("upload.mb_s", True), ("upload.p50_ms", False), ("upload.p99_ms", False),
+    ("download.mb_s", True), ("download.p50_ms", False), ("download.p99_ms", False),
+    ("pico_rss_mb", False),
+]
+
+
+def _valor(item: dict, caminho: str):
+    for parte in caminho.split("."):
+        item = (item or {}).get(parte)
+    return item
+
+
+def comparar(novo: dict, antigo: dict, tolerancia: float) -> list:
+    """Imprime a diferença métrica a métrica. Devolve as pioras acima da
+    tolerância (em %)."""
+    anteriores = {(r["modo"], r["tamanho_mb"]): r for r in antigo.get("resultados", [])}
+    pioras = []
+    print(f"\n[bench] comparando com {antigo.get('commit') or '?'}:")
+    for r in novo["resultados"]:
+        a = anteriores.get((r["modo"], r["tamanho_mb"]))
+        if not a:
+            continue
+        for metrica, maior_melhor in _METRICAS:
+            v_novo, v_antigo = _valor(r, metrica), _valor(a, metrica)
+            if not v_novo or not v_antigo:
+                continue
+            variacao = (v_novo - v_antigo) / v_antigo * 100
+            piorou = -variacao if maior_melhor else variacao
+            marca = "  <-- PIOROU" if piorou > tolerancia else ""
+            print(f"  {r['modo']:>11} {r['tamanho_mb']:>5} MB {metrica:<16} "
+                  f"{v_antigo:>10} -> {v_novo:>10} ({variacao:+.1f}%){marca}")
+            if marca:
+                pioras.append((r["modo"], r["tamanho_mb"], metrica, round(variacao, 1)))
+    return pioras
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PASTA,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# ---------------------------------------------------------------
+# PRINCIPAL
+# ---------------------------------------------------------------
+def main():
+    p = argparse.ArgumentParser(description="Benchmark do upload/download do sync.")
+    p.add_argument("--tamanhos", default="1,10,100",
+                   help="tamanhos dos bancos em MB, separados por vírgula (até 1024)")
+    p.add_argument("--clientes", type=int, default=4, help="clientes no modo concorrente")
+    p.add_argument("--repeticoes", type=int, default=5, help="uploads/downloads por cliente")
+    p.add_argument("--modos", default="processo,concorrente")
+    p.add_argument("--cache", default=os.path.join(PASTA, "dados", "bench"),
+                   help="onde guardar os bancos sintéticos gerados")
+    p.add_argument("--banco-url", default=None,
+                   help="DATABASE_URL do teste (padrão: SQLite temporário)")
+    p.add_argument("--saida", default=None, help="arquivo JSON do resultado")
+    p.add_argument("--comparar", default=None, help="JSON de outro commit para comparar")
+    p.add_argument("--tolerancia", type=float, default=20.0,
+                   help="piora máxima aceita (%%) no --comparar")
+    args = p.parse_args()
+
+    tamanhos = [int(t) for t in args.tamanhos.split(",") if t.strip()]
+    modos = [m.strip() for m in args.modos.split(",") if m.strip()]
+    temp = tempfile.mkdtemp(prefix="agrivia-bench-")
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.banco_url or f"sqlite:///{os.path.join(temp, 'bench.db')}",
+        SNAPSHOT_DIR=os.path.join(temp, "snapshots"),
+        SNAPSHOT_CAMADAS_JOB="0",
+        NOTIFY_POSTGRES="0",
+    )
+    os.environ.update(env)
+    sys.path.insert(0, PASTA)
+    import main as app_main   # aplica as migrações no banco do teste
+
+    servidor = None
+    resultados = []
+    try:
+        if "concorrente" in modos:
+            servidor, url = iniciar_servidor(env)
+        for tamanho in tamanhos:
+            dados = preparar(args.cache, tamanho)
+            base = {"tamanho_mb": tamanho, "gzip_bytes": dados["gzip_bytes"]}
+            if "processo" in modos:
+                print(f"[bench] {tamanho} MB em processo...")
+                r = medir_em_processo(app_main.app, dados["arquivos"], args.repeticoes,
+                                      str(tamanho))
+                resultados.append(dict(base, modo="processo", clientes=1,
+                                       repeticoes=args.repeticoes, **r))
+            if servidor is not None:
+                print(f"[bench] {tamanho} MB com {args.clientes} clientes...")
+                r = medir_concorrente(servidor, url, dados["arquivos"], args.clientes,
+                                      args.repeticoes, str(tamanho))
+                resultados.append(dict(base, modo="concorrente", clientes=args.clientes,
+                                       repeticoes=args.repeticoes, **r))
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait()
+        # Grava o que ficou em memória ANTES de apagar o banco temporário.
+        import escrita_em_lote
+        escrita_em_lote.descarregar_todos()
+        shutil.rmtree(temp, ignore_errors=True)
+
+    commit = _commit()
+    saida = {
+        "commit": commit,
+        "quando": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "banco": "postgresql" if args.banco_url else "sqlite",
+        "resultados": resultados,
+    }
+    caminho = args.saida or os.path.join(args.cache, f"sync-{commit or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    with open(caminho, "w", encoding="utf-8") as f:
+        json.dump(saida, f, indent=2, ensure_ascii=False)
+
+    print()
+    for r in resultados:
+        print(f"  {r['modo']:>11} {r['tamanho_mb']:>5} MB  "
+              f"up {r['upload']['mb_s']} MB/s p50 {r['upload']['p50_ms']} ms "
+              f"p99 {r['upload']['p99_ms']} ms | "
+              f"down {r['download']['mb_s']} MB/s p50 {r['download']['p50_ms']} ms "
+              f"p99 {r['download']['p99_ms']} ms | pico RSS {r['pico_rss_mb']} MB"
+              + (f" | erros {r['upload']['erros'] + r['download']['erros']}"
+                 if r['upload']['erros'] or r['download']['erros'] else ""))
+    print(f"✅ Resultado em {caminho}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            pioras = comparar(saida, json.load(f), args.tolerancia)
+        if pioras:
+            print(f"❌ {len(pioras)} métrica(s) pioraram mais de {args.tolerancia}%.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# ===============================================================
+# CALIBRAÇÃO DO CUSTO DAS SENHAS (auth.py)
+# ---------------------------------------------------------------
+# Mede, NESTA máquina, quanto um hash de senha leva com cada custo e
+# sugere o maior custo que ainda cabe no tempo-alvo por login:
+#
+#   bcrypt   -> BCRYPT_ROUNDS (cada +1 dobra o tempo)
+#   argon2id -> ARGON2_MEMORIA_KB e ARGON2_TEMPO, com o paralelismo
+#               fixo (--paralelismo); prefere mais memória a mais
+#               passadas, como recomenda a RFC 9106
+#
+# O tempo-alvo é por hash, numa thread. Lembre que o pool de senhas
+# (SENHA_THREADS) roda alguns ao mesmo tempo: com argon2id, a memória
+# de pico é SENHA_THREADS x ARGON2_MEMORIA_KB.
+#
+# COMO USAR (rode na máquina do servidor, sem carga):
+#   python calibrar_senha.py                    -> alvo de 250 ms
+#   python calibrar_senha.py --alvo-ms 500 --repeticoes 5
+#
+# Copie as linhas sugeridas para o .env. Senhas antigas continuam
+# valendo e são refeitas com o custo novo no próximo login.
+# ===============================================================
+import argparse
+import statistics
+import time
+
+import bcrypt
+
+try:
+    import argon2
+except ImportError:  # opcional
+    argon2 = None
+
+SENHA_TESTE = "calibracao-Agrivia-123"
+
+
+def _medir(gerar, repeticoes: int) -> float:
+    """Mediana, em ms, de 'repeticoes' hashes (depois de um aquecimento)."""
+    gerar()
+    tempos = []
+    for _ in range(repeticoes):
+        t0 = time.perf_counter()
+        gerar()
+        tempos.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(tempos)
+
+
+def calibrar_bcrypt(alvo_ms: float, repeticoes: int) -> dict:
+    senha = SENHA_TESTE.encode("utf-8")
+    escolhido = None
+    for rounds in range(10, 18):
+        ms = _medir(lambda: bcrypt.hashpw(senha, bcrypt.gensalt(rounds)), repeticoes)
+        print(f"[calibrar] bcrypt rounds={rounds:<2} {ms:8.1f} ms")
+        if ms > alvo_ms:
+            break
+        escolhido = {"BCRYPT_ROUNDS": rounds, "ms": round(ms, 1)}
+    return escolhido or {"BCRYPT_ROUNDS": 10, "ms": None}
+
+
+def calibrar_argon2(alvo_ms: float, repeticoes: int, paralelismo: int,
+                    memoria_max_kb: int) -> dict:
+    def medir(tempo, memoria_kb):
+        ph = argon2.PasswordHasher(
+            time_cost=tempo, memory_cost=memoria_kb, parallelism=paralelismo,
+            type=argon2.Type.ID,
+        )
+        ms = _medir(lambda: ph.hash(SENHA_TESTE), repeticoes)
+        print(f"[calibrar] argon2id t={tempo} m={memoria_kb // 1024:>4} MB "
+              f"p={paralelismo} {ms:8.1f} ms")
+        return ms
+
+    # 1) Memória: dobra (com t=1) até passar do alvo ou do teto.
+    escolhido = None
+    memoria_kb = 8 * 1024
+    while memoria_kb <= memoria_max_kb:
+        ms = medir(1, memoria_kb)
+        if ms > alvo_ms:
+            break
+        escolhido = {"ARGON2_TEMPO": 1, "ARGON2_MEMORIA_KB": memoria_kb, "ms": ms}
+        memoria_kb *= 2
+    if escolhido is None:
+        return {"ARGON2_TEMPO": 1, "ARGON2_MEMORIA_KB": 8 * 1024,
+                "ARGON2_PARALELISMO": paralelismo, "ms": None}
+
+    # 2) Passadas: com a memória escolhida, sobe t enquanto couber.
+    tempo = 2
+    while True:
+        ms = medir(tempo, escolhido["ARGON2_MEMORIA_KB"])
+        if ms > alvo_ms:
+            break
+        escolhido.update(ARGON2_TEMPO=tempo, ms=ms)
+        tempo += 1
+    escolhido["ARGON2_PARALELISMO"] = paralelismo
+    escolhido["ms"] = round(escolhido["ms"], 1)
+    return escolhido
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Escolhe o custo das senhas para um tempo-alvo.")
+    ap.add_argument("--alvo-ms", type=float, default=250, help="tempo máximo por hash (ms)")
+    ap.add_argument("--repeticoes", type=int, default=3)
+    ap.add_argument("--paralelismo", type=int, default=4, help="argon2id: lanes")
+    ap.add_argument("--memoria-max-mb", type=int, default=256, help="argon2id: teto de memória")
+    args = ap.parse_args()
+
+    print(f"[calibrar] alvo: {args.alvo_ms:.0f} ms por hash")
+    sugestao = {}
+    b = calibrar_bcrypt(args.alvo_ms, args.repeticoes)
+    sugestao.update(BCRYPT_ROUNDS=b["BCRYPT_ROUNDS"])
+
+    algoritmo = "bcrypt"
+    if argon2 is None:
+        print("[calibrar] 'argon2-cffi' não instalado: só bcrypt.")
+    else:
+        a = calibrar_argon2(args.alvo_ms, args.repeticoes, args.paralelismo,
+                            args.memoria_max_mb * 1024)
+        if a["ms"] is not None:
+            algoritmo = "argon2id"
+            sugestao.update({k: v for k, v in a.items() if k != "ms"})
+        print(f"[calibrar] argon2id escolhido: {a}")
+    print(f"[calibrar] bcrypt escolhido: {b}")
+
+    print("\n# Sugestão para o .env:")
+    print(f"SENHA_ALGORITMO={algoritmo}")
+    for k, v in sugestao.items():
+        print(f"{k}={v}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# ===============================================================
+# FASE 2 — CAMADAS DAS CÓPIAS (quente / fria)
+# ---------------------------------------------------------------
+# O histórico de cada cliente (até SYNC_MAX_HISTORICO versões) não
+# precisa ficar todo no armazenamento "quente". Um trabalho em
+# segundo plano move, aos poucos:
+#
+#  - versões ANTIGAS (não são a atual e têm mais de
+#    SNAPSHOT_FRIO_APOS_HORAS) -> camada fria (SNAPSHOT_FRIO_STORE:
+#    outra pasta/disco mais barato; S3 entra pela mesma interface).
+#    A cópia vira UM arquivo compactado lá (frio_ref) e solta os
+#    blocos deduplicados dela (chunk_store) — menos linhas e menos
+#    arquivos no armazenamento quente.
+#  - cópias LEGADAS (o arquivo dentro do Postgres, coluna 'conteudo')
+#    -> saem do banco: as antigas vão para a camada fria (se ligada);
+#    a atual, ou todas com a camada fria desligada, para o blob store.
+#
+# A versão atual NUNCA vai para a camada fria (o download é dela).
+#
+# LER DE VOLTA: sync_routes._abrir_copia() sabe ler da camada fria,
+# então a restauração pelo admin (restaurar_versao) é transparente: a
+# cópia fria vira uma versão nova, de novo no armazenamento quente.
+#
+# RITMO: no máximo SNAPSHOT_FRIO_MB_S MB/s copiados e SNAPSHOT_FRIO_LOTE
+# cópias por rodada, uma rodada a cada SNAPSHOT_FRIO_INTERVALO_MIN —
+# para não disputar disco/rede com os uploads. Com vários workers no
+# Postgres, só um faz a rodada por vez (advisory lock).
+#
+# Cada troca é um compare-and-set na linha da cópia: se ela foi podada
+# ou mudou no meio, o arquivo copiado é apagado e nada se perde.
+#
+# Rodar uma rodada na mão:  python camadas.py [quantas]
+# ===============================================================
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, text, update
+
+from database import SessionLocal, engine
+from models import DbSnapshot, SyncCabeca
+import chunk_store
+import compressao
+import snapshot_store
+import sync_routes
+
+SNAPSHOT_CAMADAS_JOB = os.getenv("SNAPSHOT_CAMADAS_JOB", "1") == "1"
+SNAPSHOT_FRIO_APOS_HORAS = float(os.getenv("SNAPSHOT_FRIO_APOS_HORAS", "24"))
+SNAPSHOT_FRIO_MB_S = float(os.getenv("SNAPSHOT_FRIO_MB_S", "10"))
+SNAPSHOT_FRIO_LOTE = int(os.getenv("SNAPSHOT_FRIO_LOTE", "50"))
+SNAPSHOT_FRIO_INTERVALO_MIN = float(os.getenv("SNAPSHOT_FRIO_INTERVALO_MIN", "30"))
+
+# Chave do advisory lock do Postgres (um worker por rodada).
+_TRAVA_PG = 0x61677269
+
+_thread = None
+
+
+class Limitador:
+    """Segura o ritmo de uma rodada em no máximo 'bytes_por_seg'
+    (0 = sem limite): depois de cada bloco, dorme o que adiantou."""
+
+    def __init__(self, bytes_por_seg: float):
+        self.bytes_por_seg = bytes_por_seg
+        self.total = 0
+        self._inicio = time.monotonic()
+
+    def consumir(self, n: int):
+        self.total += n
+        if not self.bytes_por_seg:
+            return
+        adiantado = self.total / self.bytes_por_seg - (time.monotonic() - self._inicio)
+        if adiantado > 0:
+            time.sleep(adiantado)
+
+
+def _legado():
+    """Cópias cujo arquivo ainda está dentro do banco (coluna 'conteudo')."""
+    return and_(
+        DbSnapshot.blob_ref.is_(None),
+        DbSnapshot.frio_ref.is_(None),
+        or_(DbSnapshot.em_blocos.is_(None), DbSnapshot.em_blocos == 0),
+        DbSnapshot.conteudo.isnot(None),
+    )
+
+
+def pendentes(db, limite: int = None) -> list:
+    """Ids das cópias que a próxima rodada deve mover, as mais antigas primeiro."""
+    condicoes = [_legado()]
+    if snapshot_store.frio_ligado():
+        corte = datetime.utcnow() - timedelta(hours=SNAPSHOT_FRIO_APOS_HORAS)
+        condicoes.append(and_(
+            DbSnapshot.frio_ref.is_(None),
+            DbSnapshot.criado_em < corte,
+            ~DbSnapshot.id.in_(
+                db.query(SyncCabeca.snapshot_id).filter(SyncCabeca.snapshot_id.isnot(None))
+            ),
+        ))
+    q = db.query(DbSnapshot.id).filter(or_(*condicoes)).order_by(DbSnapshot.id)
+    if limite:
+        q = q.limit(limite)
+    return [i for (i,) in q.all()]
+
+
+def mover_versao(snapshot_id: int, limitador: Limitador = None) -> int:
+    """Move UMA cópia para a camada certa (ver o cabeçalho). Confere o
+    conteúdo (db_sha256) antes de trocar. Devolve os bytes gravados
+    (0 se não havia o que mover ou se desistiu)."""
+    limitador = limitador or Limitador(0)
+    db = SessionLocal()
+    try:
+        snap = db.get(DbSnapshot, snapshot_id)
+        if not snap or snap.frio_ref:
+            return 0
+        atual = (
+            db.query(SyncCabeca.snapshot_id)
+            .filter(SyncCabeca.user_id == snap.user_id)
+            .scalar()
+        )
+        legado = not snap.blob_ref and not snap.em_blocos
+        para_frio = snapshot_store.frio_ligado() and snap.id != atual
+        if not legado and not para_frio:
+            return 0
+        codificacao = sync_routes._codificacao(snap)
+        if not compressao.aceita(*codificacao):
+            return 0   # zstd sem o dicionário neste servidor: fica onde está
+
+        store = snapshot_store.get_store_frio() if para_frio else snapshot_store.get_store()
+        escrita = store.nova_escrita(snap.user_id, codificacao=codificacao[0])
+        hash_banco = snapshot_store.HashDoBanco(compressao.descompactador(*codificacao))
+        try:
+            with sync_routes._abrir_copia(db, snap) as f:
+                for bloco in snapshot_store.ler_em_blocos(f):
+                    hash_banco.atualizar(bloco)
+                    escrita.escrever(bloco)
+                    limitador.consumir(len(bloco))
+            db_sha256 = hash_banco.hexdigest()
+            if db_sha256 is None or (snap.db_sha256 and db_sha256 != snap.db_sha256):
+                raise ValueError("conteúdo da cópia não confere")
+            ref = escrita.concluir()
+        except Exception as e:
+            escrita.descartar()
+            print(f"[camadas] ERRO ao mover snapshot={snapshot_id}:", e)
+            return 0
+
+        antiga, lateral = snap.blob_ref, snap.zstd_ref
+        valores = dict(conteudo=None, db_sha256=db_sha256)
+        if para_frio:
+            valores.update(
+                frio_ref=ref, blob_ref=None, em_blocos=0,
+                zstd_ref=None, zstd_dicionario=None, zstd_tamanho=None,
+                codificacao=codificacao[0], dicionario=codificacao[1],
+                sha256=escrita.sha256, tamanho_bytes=escrita.tamanho,
+            )
+        else:
+            valores.update(blob_ref=ref)
+        res = db.execute(
+            update(DbSnapshot)
+            .where(
+                DbSnapshot.id == snapshot_id,
+                DbSnapshot.frio_ref.is_(None),
+                DbSnapshot.blob_ref == antiga if antiga else DbSnapshot.blob_ref.is_(None),
+            )
+            .values(**valores)
+            .execution_options(synchronize_session=False)
+        )
+        if res.rowcount != 1:
+            db.rollback()
+            store.apagar(ref)
+            return 0
+        if para_frio:
+            chunk_store.liberar_blocos(db, [snapshot_id])
+        db.commit()
+        if antiga:
+            snapshot_store.get_store().apagar(antiga)
+        if para_frio and lateral:
+            snapshot_store.get_store().apagar(lateral)
+        print(f"[camadas] snapshot={snapshot_id} -> "
+              f"{'fria' if para_frio else 'blob store'} ({escrita.tamanho} bytes)")
+        return escrita.tamanho
+    finally:
+        db.close()
+
+
+def rodada(limite: int = None) -> int:
+    """Uma rodada do trabalho: move até 'limite' cópias no ritmo
+    configurado. Devolve quantas moveu."""
+    limite = limite or SNAPSHOT_FRIO_LOTE
+    with engine.connect() as conn:
+        postgres = engine.dialect.name == "postgresql"
+        if postgres and not conn.execute(
+            text("SELECT pg_try_advisory_lock(:k)"), {"k": _TRAVA_PG}
+        ).scalar():
+            return 0   # outro worker já está rodando
+        try:
+            db = SessionLocal()
+            try:
+                ids = pendentes(db, limite)
+            finally:
+                db.close()
+            limitador = Limitador(SNAPSHOT_FRIO_MB_S * 1024 * 1024)
+            movidas = sum(1 for i in ids if mover_versao(i, limitador))
+            if movidas:
+                db = SessionLocal()
+                try:
+                    chunk_store.coletar_lixo(db)
+                finally:
+                    db.close()
+                print(f"[camadas] rodada: {movidas} cópia(s), "
+                      f"{limitador.total} bytes lidos")
+            return movidas
+        finally:
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _TRAVA_PG})
+                conn.commit()
+
+
+def _rodar():
+    while True:
+        try:
+            rodada()
+        except Exception as e:
+            print("[camadas] erro na rodada:", e)
+        time.sleep(SNAPSHOT_FRIO_INTERVALO_MIN * 60)
+
+
+def iniciar():
+    """Liga o trabalho em segundo plano (SNAPSHOT_CAMADAS_JOB=1). Chamado
+    uma vez na subida."""
+    global _thread
+    if not SNAPSHOT_CAMADAS_JOB or _thread is not None:
+        return
+    _thread = threading.Thread(target=_rodar, name="camadas", daemon=True)
+    _thread.start()
+
+
+if __name__ == "__main__":
+    n = rodada(int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    print(f"✅ {n} cópia(s) movida(s).")
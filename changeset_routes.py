@@ -0,0 +1,581 @@
+# ===============================================================
+# FASE 2 — SYNC POR CHANGESET (só as linhas que mudaram)
+# ---------------------------------------------------------------
+# Ao lado da cópia inteira (sync_routes.py), o app pode mandar só as
+# LINHAS que mudaram desde a versão em que se baseou:
+#   POST /api/sync/changesets          -> sobe um changeset (JSON em gzip)
+#   GET  /api/sync/changesets?since=N  -> changesets depois da versão N
+#
+# FORMATO (JSON, compactado em gzip):
+#   {"alteracoes": [
+#     {"tabela": "lotes",  "op": "insert", "pk": {"id": 7}, "valores": {...}},
+#     {"tabela": "lotes",  "op": "update", "pk": {"id": 3}, "valores": {"peso": 12.5}},
+#     {"tabela": "vendas", "op": "delete", "pk": {"id": 9}}
+#   ]}
+#   Valor binário (BLOB) vai como {"$b64": "..."}. O sqlite3 do Python
+#   não expõe a extensão "session" do SQLite; este log por linha é o
+#   equivalente que o app consegue gerar e o servidor consegue aplicar.
+#
+# Cada changeset vira UMA versão nova, na mesma numeração das cópias
+# inteiras (sync_cabeca), com a mesma trava: compare-and-set na cabeça.
+#
+# MESCLA: se o app está atrás (base < atual) mas todas as versões do
+# meio são changesets e nenhuma mexeu nas mesmas linhas (tabela + pk),
+# o changeset entra por cima, sem 409. Se alguma tocou a mesma linha,
+# ou no meio houve uma cópia inteira, volta o 409 'conflito_versao'.
+#
+# COMPACTAÇÃO: com CHANGESET_COMPACTAR changesets depois da última
+# cópia, o servidor aplica todos nela (num arquivo SQLite temporário)
+# e grava uma cópia inteira nova em db_snapshots. Os changesets das
+# últimas CHANGESET_MANTER versões continuam guardados, para apps um
+# pouco atrás ainda puxarem só as linhas.
+#
+# ESQUEMA: no upload, tabelas e colunas são conferidas contra o esquema
+# da cópia inteira atual (lido uma vez por cópia e guardado em memória)
+# — nome desconhecido é 422 na hora, não um erro na compactação. Se um
+# changeset ainda assim não aplica (ex.: viola um NOT NULL), a
+# compactação marca esse changeset (coluna 'erro'), compacta só até a
+# versão anterior e não tenta de novo. A partir daí, quando chegariam
+# mais CHANGESET_COMPACTAR changesets, o upload responde 409
+# 'precisa_upload_inteiro': o app manda a cópia inteira e a fila anda.
+#
+# CÓPIA EM DIA: quem usa a cópia inteira (/download, o delta) precisa
+# dela NA versão da cabeça — senão um app que só baixa cópias se vê
+# sempre atrás, e um delta sobre S perderia os changesets. Com
+# changesets depois da cópia, copia_em_dia() compacta ali mesmo, antes
+# de responder; com um changeset que não aplica, 409
+# 'precisa_upload_inteiro'. O X-DB-Version do download é sempre a
+# versão da cabeça.
+#
+# PARA O APP: GET /changesets?since=N traz o que veio depois da versão
+# N. 410 = os changesets do meio não existem mais: baixe a cópia inteira.
+# ===============================================================
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from fastapi import APIRouter, BackgroundTasks, Depends, Form, UploadFile, File, HTTPException
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, undefer
+
+from database import SessionLocal, get_db
+from models import DbSnapshot, SyncCabeca, SyncChangeset
+from auth import UsuarioLogado, get_current_user
+import chunk_store
+import compressao
+import notificacoes
+import snapshot_store
+import sync_routes
+
+router = APIRouter(prefix="/api/sync/changesets", tags=["Sync"])
+
+# Tamanho máximo de UM changeset compactado (padrão 5 MB) e descompactado.
+# O JSON é lido de uma vez: o limite descompactado segura a memória de
+# um pedido (um gzip pequeno pode inflar centenas de MB).
+CHANGESET_MAX_BYTES = int(os.getenv("CHANGESET_MAX_KB", "5120")) * 1024
+_MAX_DESCOMPACTADO = 2 * CHANGESET_MAX_BYTES
+
+# Quantos changesets depois da última cópia disparam a compactação.
+CHANGESET_COMPACTAR = int(os.getenv("CHANGESET_COMPACTAR", "20"))
+
+# Por quantas versões manter os changesets já compactados.
+CHANGESET_MANTER = int(os.getenv("CHANGESET_MANTER", "100"))
+
+_NOME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_OPS = ("insert", "update", "delete")
+
+# Esquema (tabela -> colunas) por id de cópia inteira. A cópia não muda
+# depois de gravada e changesets não mexem no esquema.
+_ESQUEMAS_MAX = 256
+_esquemas = OrderedDict()
+_trava_esquemas = threading.Lock()
+
+
+class ChangesetInvalido(ValueError):
+    pass
+
+
+# ---------------------------------------------------------------
+# LEITURA / CONFERÊNCIA DO CHANGESET
+# ---------------------------------------------------------------
+def _nome_ok(nome) -> bool:
+    return isinstance(nome, str) and bool(_NOME.match(nome))
+
+
+def _valor_ok(v) -> bool:
+    if isinstance(v, dict):
+        return set(v) == {"$b64"} and isinstance(v["$b64"], str)
+    return v is None or isinstance(v, (str, int, float, bool))
+
+
+def _conferir(a):
+    if not isinstance(a, dict) or a.get("op") not in _OPS:
+        raise ChangesetInvalido("operação inválida")
+    tabela = a.get("tabela")
+    if not _nome_ok(tabela) or tabela.lower().startswith("sqlite_"):
+        raise ChangesetInvalido("nome de tabela inválido")
+    for campo in ("pk", "valores"):
+        if campo == "valores" and a["op"] == "delete":
+            continue
+        d = a.get(campo)
+        if not isinstance(d, dict) or (not d and (campo == "pk" or a["op"] == "update")):
+            raise ChangesetInvalido(f"'{campo}' ausente")
+        if not all(_nome_ok(c) and _valor_ok(v) for c, v in d.items()):
+            raise ChangesetInvalido(f"'{campo}' inválido")
+
+
+def _ler_changeset(arquivo) -> tuple:
+    """Lê e confere o changeset enviado. Devolve (gzip recebido, alterações)."""
+    gz = arquivo.read(CHANGESET_MAX_BYTES + 1)
+    if len(gz) > CHANGESET_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="changeset_grande_demais")
+    try:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        texto = d.decompress(gz, _MAX_DESCOMPACTADO)
+        if d.unconsumed_tail or not d.eof:
+            raise ChangesetInvalido("gzip incompleto ou grande demais")
+        dados = json.loads(texto)
+    except zlib.error:
+        raise ChangesetInvalido("gzip inválido")
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ChangesetInvalido("JSON inválido")
+    alteracoes = dados.get("alteracoes") if isinstance(dados, dict) else None
+    if not isinstance(alteracoes, list) or not alteracoes:
+        raise ChangesetInvalido("sem alterações")
+    for a in alteracoes:
+        _conferir(a)
+    return gz, alteracoes
+
+
+def _conferir_esquema(alteracoes: list, esquema: dict):
+    """Tabelas e colunas do changeset existem no banco do usuário?"""
+    for a in alteracoes:
+        colunas = esquema.get(a["tabela"])
+        if not colunas:
+            raise ChangesetInvalido(f"tabela desconhecida '{a['tabela']}'")
+        # 'rowid' vale como pk para tabelas sem chave primária declarada.
+        fora = (set(a["pk"]) - colunas - {"rowid"}) | (set(a.get("valores") or {}) - colunas)
+        if fora:
+            raise ChangesetInvalido(
+                f"coluna desconhecida em '{a['tabela']}': {', '.join(sorted(fora))}"
+            )
+
+
+def _ler_esquema(con) -> dict:
+    tabelas = [
+        r[0] for r in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+    return {
+        t: {r[1] for r in con.execute('PRAGMA table_info("%s")' % t.replace('"', '""'))}
+        for t in tabelas
+    }
+
+
+def _guardar_esquema(snapshot_id: int, esquema: dict):
+    with _trava_esquemas:
+        _esquemas[snapshot_id] = esquema
+        _esquemas.move_to_end(snapshot_id)
+        while len(_esquemas) > _ESQUEMAS_MAX:
+            _esquemas.popitem(last=False)
+
+
+def _esquema(db: Session, snap: DbSnapshot) -> dict:
+    """Esquema da cópia inteira (da memória; na 1ª vez, abre a cópia)."""
+    with _trava_esquemas:
+        esquema = _esquemas.get(snap.id)
+        if esquema is not None:
+            _esquemas.move_to_end(snap.id)
+            return esquema
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, "banco.db")
+        with open(caminho, "wb") as saida, sync_routes._abrir_banco(db, snap) as banco:
+            shutil.copyfileobj(banco, saida, snapshot_store.BLOCO_BYTES)
+        con = sqlite3.connect(caminho)
+        try:
+            esquema = _ler_esquema(con)
+        finally:
+            con.close()
+    _guardar_esquema(snap.id, esquema)
+    return esquema
+
+
+def _chave(a) -> str:
+    """Identifica a LINHA tocada (tabela + pk), para achar conflitos."""
+    return a["tabela"] + ":" + json.dumps(a["pk"], sort_keys=True)
+
+
+def _alteracoes(cs: SyncChangeset) -> list:
+    return json.loads(gzip.decompress(cs.conteudo))["alteracoes"]
+
+
+# ---------------------------------------------------------------
+# APLICAR NUM BANCO SQLITE (compactação)
+# ---------------------------------------------------------------
+def _valor(v):
+    if isinstance(v, dict):
+        return base64.b64decode(v["$b64"])
+    return v
+
+
+def _aplicar(con, alteracoes: list, colunas: dict):
+    """Aplica as alterações no banco aberto em 'con'. Tabelas e colunas são
+    conferidas contra o próprio banco (nada de nome vindo de fora sem checar)."""
+    for a in alteracoes:
+        t = a["tabela"]
+        if t not in colunas:
+            colunas[t] = {r[1] for r in con.execute(f'PRAGMA table_info("{t}")')}
+        pk = a["pk"]
+        valores = a.get("valores") or {}
+        _conferir_esquema([a], colunas)
+
+        onde = " AND ".join(f'"{c}" = ?' for c in pk)
+        args_pk = [_valor(v) for v in pk.values()]
+        if a["op"] == "insert":
+            linha = {**valores, **pk}
+            nomes = ", ".join(f'"{c}"' for c in linha)
+            marcas = ", ".join("?" for _ in linha)
+            con.execute(
+                f'INSERT OR REPLACE INTO "{t}" ({nomes}) VALUES ({marcas})',
+                [_valor(v) for v in linha.values()],
+            )
+        elif a["op"] == "update":
+            sets = ", ".join(f'"{c}" = ?' for c in valores)
+            con.execute(
+                f'UPDATE "{t}" SET {sets} WHERE {onde}',
+                [_valor(v) for v in valores.values()] + args_pk,
+            )
+        else:
+            con.execute(f'DELETE FROM "{t}" WHERE {onde}', args_pk)
+
+
+def _aplicar_ate_falhar(con, pendentes: list):
+    """Aplica os changesets em ordem, cada um inteiro ou nada (SAVEPOINT).
+    Devolve (quantos aplicaram, changeset que falhou, erro)."""
+    colunas = {}
+    con.isolation_level = None
+    con.execute("BEGIN")
+    for i, cs in enumerate(pendentes):
+        con.execute("SAVEPOINT cs")
+        try:
+            _aplicar(con, _alteracoes(cs), colunas)
+        except (ChangesetInvalido, sqlite3.Error, ValueError) as e:
+            con.execute("ROLLBACK TO cs")
+            con.execute("COMMIT")
+            return i, cs, e
+        con.execute("RELEASE cs")
+    con.execute("COMMIT")
+    return len(pendentes), None, None
+
+
+def compactar(user_id: int, arquivar: bool = True):
+    """Aplica os changesets feitos depois da última cópia e grava uma cópia
+    inteira nova (com a versão do último changeset). Devolve o id da cópia
+    nova, ou None. Se outra cópia entrar no meio, desiste sem mexer em
+    nada. Um changeset que não aplica é marcado e a cópia sai só até a
+    versão anterior a ele. arquivar=False: quem chamou agenda o
+    chunk_store.arquivar_versao (ex.: numa rota, depois da resposta)."""
+    db = SessionLocal()
+    try:
+        cabeca = db.get(SyncCabeca, user_id)
+        base = db.get(DbSnapshot, cabeca.snapshot_id) if cabeca and cabeca.snapshot_id else None
+        if not base:
+            return
+        pendentes = (
+            db.query(SyncChangeset)
+            .options(undefer(SyncChangeset.conteudo))
+            .filter(SyncChangeset.user_id == user_id, SyncChangeset.version > base.version)
+            .order_by(SyncChangeset.version)
+            .all()
+        )
+        if not pendentes or pendentes[0].erro:
+            return
+        pendentes = pendentes[:next(
+            (i for i, cs in enumerate(pendentes) if cs.erro), len(pendentes)
+        )]
+
+        store = snapshot_store.get_store()
+        escrita = store.nova_escrita(user_id, limite=snapshot_store.SNAPSHOT_MAX_BYTES)
+        hash_banco = hashlib.sha256()
+        try:
+            with tempfile.TemporaryDirectory() as pasta:
+                caminho = os.path.join(pasta, "banco.db")
+                with open(caminho, "wb") as saida, sync_routes._abrir_banco(db, base) as banco:
+                    shutil.copyfileobj(banco, saida, snapshot_store.BLOCO_BYTES)
+                con = sqlite3.connect(caminho)
+                try:
+                    aplicados, falhou, erro = _aplicar_ate_falhar(con, pendentes)
+                    esquema = _ler_esquema(con)
+                finally:
+                    con.close()
+                if falhou is not None:
+                    _marcar_falha(db, falhou, erro)
+                    if not aplicados:
+                        escrita.descartar()
+                        return
+                    pendentes = pendentes[:aplicados]
+                alvo = pendentes[-1]
+
+                comp = compressao.compactador(compressao.GZIP)
+                with open(caminho, "rb") as f:
+                    for bloco in snapshot_store.ler_em_blocos(f):
+                        hash_banco.update(bloco)
+                        dados = comp.compress(bloco)
+                        if dados:
+                            escrita.escrever(dados)
+                escrita.escrever(comp.flush())
+            ref = escrita.concluir()
+        except Exception as e:
+            escrita.descartar()
+            print(f"[changeset] ERRO ao compactar user={user_id}:", e)
+            return
+
+        snap = DbSnapshot(
+            user_id=user_id,
+            version=alvo.version,
+            blob_ref=ref,
+            sha256=escrita.sha256,
+            db_sha256=hash_banco.hexdigest(),
+            tamanho_bytes=escrita.tamanho,
+            device_id=alvo.device_id,
+            codificacao=compressao.GZIP,
+            criado_em=alvo.criado_em,
+        )
+        trocou = False
+        try:
+            db.add(snap)
+            db.flush()
+            # A cabeça só passa a apontar para a cópia nova se ainda apontava
+            # para a base (senão entrou uma cópia inteira no meio).
+            res = db.execute(
+                update(SyncCabeca)
+                .where(SyncCabeca.user_id == user_id, SyncCabeca.snapshot_id == base.id)
+                .values(snapshot_id=snap.id)
+                .execution_options(synchronize_session=False)
+            )
+            trocou = res.rowcount == 1
+            if trocou:
+                db.execute(
+                    update(SyncCabeca)
+                    .where(SyncCabeca.user_id == user_id, SyncCabeca.version == alvo.version)
+                    .values(sha256=snap.sha256, db_sha256=snap.db_sha256,
+                            tamanho_bytes=snap.tamanho_bytes)
+                    .execution_options(synchronize_session=False)
+                )
+                db.query(SyncChangeset).filter(
+                    SyncChangeset.user_id == user_id,
+                    SyncChangeset.version <= alvo.version - CHANGESET_MANTER,
+                ).delete(synchronize_session=False)
+                db.commit()
+        except IntegrityError:
+            trocou = False
+        if not trocou:
+            db.rollback()
+            store.apagar(ref)
+            return
+        snapshot_id = snap.id
+        _guardar_esquema(snapshot_id, esquema)
+        print(f"[changeset] compactado user={user_id} versao={alvo.version} "
+              f"changesets={len(pendentes)} tamanho={escrita.tamanho} bytes")
+
+        sync_routes._podar_historico(db, user_id)
+    finally:
+        db.close()
+
+    # Guarda a cópia nova em blocos e solta o arquivo inteiro da anterior.
+    if arquivar:
+        chunk_store.arquivar_versao(snapshot_id)
+    return snapshot_id
+
+
+def copia_em_dia(db: Session, user_id: int, tarefas: BackgroundTasks) -> tuple:
+    """(cabeça, cópia inteira) com a cópia na versão da cabeça: se há
+    changesets depois dela, compacta agora. (None, None) sem cópia.
+    Changeset que não aplica -> 409 'precisa_upload_inteiro'."""
+    for _ in range(3):
+        cabeca, snap = sync_routes._cabeca_e_copia(db, user_id)
+        if not snap or cabeca.version == snap.version:
+            return cabeca, snap
+        if _tem_falha(db, user_id, snap.version):
+            raise _precisa_upload_inteiro()
+        snapshot_id = compactar(user_id, arquivar=False)
+        if snapshot_id:
+            tarefas.add_task(chunk_store.arquivar_versao, snapshot_id)
+        db.expire_all()
+    # Changesets chegando mais rápido do que a compactação alcança.
+    raise HTTPException(status_code=503, detail="copia_em_compactacao",
+                        headers={"Retry-After": "1"})
+
+
+def _marcar_falha(db: Session, cs: SyncChangeset, erro: Exception):
+    """Marca o changeset que não aplica: a compactação não tenta de novo."""
+    print(f"[changeset] ERRO ao aplicar user={cs.user_id} versao={cs.version}:", erro)
+    db.query(SyncChangeset).filter(SyncChangeset.id == cs.id).update(
+        {"erro": str(erro)[:500] or type(erro).__name__}, synchronize_session=False
+    )
+    db.commit()
+
+
+# ---------------------------------------------------------------
+# ROTAS
+# ---------------------------------------------------------------
+def _checar_mescla(db: Session, user_id: int, base_version: int, atual: int,
+                   chaves: set):
+    """App atrás da versão atual: só passa se TODAS as versões do meio são
+    changesets e nenhuma tocou as mesmas linhas. Senão, 409."""
+    do_meio = (
+        db.query(SyncChangeset.chaves)
+        .filter(
+            SyncChangeset.user_id == user_id,
+            SyncChangeset.version > base_version,
+            SyncChangeset.version <= atual,
+        )
+        .all()
+    )
+    if len(do_meio) != atual - base_version:
+        raise sync_routes._conflito(db, user_id, base_version)
+    for (c,) in do_meio:
+        if chaves & set(json.loads(c or "[]")):
+            raise sync_routes._conflito(db, user_id, base_version)
+
+
+@router.post("")
+def subir_changeset(
+    tarefas: BackgroundTasks,
+    base_version: int = Form(...),
+    device_id: str = Form(None),
+    arquivo: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    cabeca = db.get(SyncCabeca, user.id)
+    base = db.get(DbSnapshot, cabeca.snapshot_id) if cabeca and cabeca.snapshot_id else None
+    if not base:
+        # A primeira versão sobe inteira (/api/sync/upload).
+        raise HTTPException(status_code=400, detail="sem_copia_base")
+    try:
+        gz, alteracoes = _ler_changeset(arquivo.file)
+        _conferir_esquema(alteracoes, _esquema(db, base))
+    except ChangesetInvalido as e:
+        raise HTTPException(status_code=422, detail=f"changeset_invalido: {e}")
+    chaves = sorted({_chave(a) for a in alteracoes})
+
+    atual = cabeca.version
+    if atual - base.version >= CHANGESET_COMPACTAR and _tem_falha(db, user.id, base.version):
+        # A fila não compacta (um changeset não aplica): só uma cópia
+        # inteira resolve — e segura o acúmulo de changesets.
+        raise _precisa_upload_inteiro()
+    if base_version > atual:
+        raise sync_routes._conflito(db, user.id, base_version)
+    mesclado = base_version < atual
+    if mesclado:
+        _checar_mescla(db, user.id, base_version, atual, set(chaves))
+
+    cs = SyncChangeset(
+        user_id=user.id,
+        version=atual + 1,
+        base_version=base_version,
+        conteudo=gz,
+        chaves=json.dumps(chaves),
+        alteracoes=len(alteracoes),
+        tamanho_bytes=len(gz),
+        device_id=device_id,
+        criado_em=datetime.utcnow(),
+    )
+    trocou = False
+    try:
+        db.add(cs)
+        db.flush()
+        res = db.execute(
+            update(SyncCabeca)
+            .where(SyncCabeca.user_id == user.id, SyncCabeca.version == atual)
+            .values(version=cs.version, db_sha256=None, device_id=device_id,
+                    criado_em=cs.criado_em)
+            .execution_options(synchronize_session=False)
+        )
+        trocou = res.rowcount == 1
+        if trocou:
+            db.commit()
+    except IntegrityError:
+        trocou = False
+    if not trocou:
+        # Outro upload chegou entre a leitura da cabeça e a gravação.
+        db.rollback()
+        raise sync_routes._conflito(db, user.id, base_version)
+
+    db.refresh(cabeca)
+    notificacoes.publicar("sync", user.id, sync_routes._status(cabeca))
+    sync_routes._registrar_dispositivo(user.id, device_id)
+
+    if cs.version - base.version >= CHANGESET_COMPACTAR and not _tem_falha(db, user.id, base.version):
+        tarefas.add_task(compactar, user.id)
+
+    print(f"[changeset] upload user={user.id} versao={cs.version} base={base_version} "
+          f"alteracoes={len(alteracoes)} tamanho={len(gz)} bytes"
+          + (" (mesclado)" if mesclado else ""))
+    return {"success": True, "version": cs.version, "merged": mesclado}
+
+
+def _precisa_upload_inteiro() -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={"erro": "precisa_upload_inteiro",
+                "mensagem": "Envie a cópia inteira do banco (/api/sync/upload)."},
+    )
+
+
+def _tem_falha(db: Session, user_id: int, depois_de: int) -> bool:
+    return db.query(
+        db.query(SyncChangeset.id).filter(
+            SyncChangeset.user_id == user_id,
+            SyncChangeset.version > depois_de,
+            SyncChangeset.erro.isnot(None),
+        ).exists()
+    ).scalar()
+
+
+@router.get("")
+def baixar_changesets(
+    since: int,
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    cabeca = db.get(SyncCabeca, user.id)
+    atual = cabeca.version if cabeca else 0
+    if since >= atual:
+        return {"current_version": atual, "changesets": []}
+    linhas = (
+        db.query(SyncChangeset)
+        .options(undefer(SyncChangeset.conteudo))
+        .filter(SyncChangeset.user_id == user.id, SyncChangeset.version > since)
+        .order_by(SyncChangeset.version)
+        .all()
+    )
+    if len(linhas) != atual - since:
+        # Há uma cópia inteira no meio (ou changesets já descartados).
+        raise HTTPException(status_code=410, detail="precisa_download")
+    return {
+        "current_version": atual,
+        "changesets": [
+            {
+                "version": cs.version,
+                "base_version": cs.base_version,
+                "device_id": cs.device_id,
+                "criado_em": cs.criado_em.isoformat() if cs.criado_em else None,
+                "alteracoes": _alteracoes(cs),
+            }
+            for cs in linhas
+        ],
+    }
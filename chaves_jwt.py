@@ -0,0 +1,150 @@
+# ===============================================================
+# CHAVES DE ASSINATURA DOS TOKENS (RS256 + rotação por 'kid')
+# ---------------------------------------------------------------
+# Com JWT_ALGORITMO=RS256 os tokens são assinados com uma chave RSA
+# PRIVADA que só este servidor tem. As chaves PÚBLICAS saem em
+# /.well-known/jwks.json: o app desktop e outros serviços conferem o
+# token sozinhos (verificar_jwt.py), sem perguntar a este servidor.
+#
+# Cada chave é um arquivo <kid>.pem em JWT_CHAVES_DIR (no Railway,
+# aponte para um VOLUME). A chave que ASSINA é a de JWT_KID_ATUAL, ou,
+# sem ele, a de kid mais recente (os kids começam pela data). Todas as
+# chaves da pasta continuam no JWKS e valem para conferir.
+#
+# ROTAÇÃO:
+#   python chaves_jwt.py nova              -> cria e passa a assinar
+#   python chaves_jwt.py listar
+#   python chaves_jwt.py aposentar <kid>   -> sai do JWKS; tokens dela
+#                                             deixam de valer
+# Aposente a antiga só depois que os tokens dela venceram (7 dias para
+# os apps antigos). Não precisa reiniciar os workers: um 'kid' que o
+# processo não conhece faz reler a pasta (no máximo a cada
+# _RELER_SEG — durante uma troca gradual, um worker que já assina com
+# a chave nova não derruba o login nos outros), e a pasta é relida de
+# qualquer jeito a cada _VALIDADE_SEG (a aposentada sai de todos).
+#
+# Chaves geradas com o pacote 'rsa' (vem com o python-jose). Instale
+# também 'cryptography' (python-jose[cryptography]): assinar fica
+# dezenas de vezes mais rápido.
+# ===============================================================
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+from jose import jwk
+
+JWT_CHAVES_DIR = os.getenv(
+    "JWT_CHAVES_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "jwt"),
+)
+JWT_KID_ATUAL = os.getenv("JWT_KID_ATUAL", "").strip()
+_ALGORITMO = "RS256"
+_BITS = 2048
+
+_RELER_SEG = 10        # kid desconhecido: releitura no máximo a cada N s
+_VALIDADE_SEG = 300    # releitura periódica da pasta
+
+_trava = threading.Lock()
+_chaves = None   # kid -> chave privada (jose Key)
+_lidas_em = 0.0
+
+
+def _carregar(idade_max: float = _VALIDADE_SEG) -> dict:
+    """As chaves da pasta; relê se a leitura tem mais de idade_max seg."""
+    global _chaves, _lidas_em
+    with _trava:
+        if _chaves is None or time.monotonic() - _lidas_em >= idade_max:
+            chaves = {}
+            if os.path.isdir(JWT_CHAVES_DIR):
+                for nome in sorted(os.listdir(JWT_CHAVES_DIR)):
+                    if nome.endswith(".pem"):
+                        with open(os.path.join(JWT_CHAVES_DIR, nome)) as f:
+                            chaves[nome[:-4]] = jwk.construct(f.read(), _ALGORITMO)
+            _chaves = chaves
+            _lidas_em = time.monotonic()
+        return _chaves
+
+
+def recarregar():
+    """Esquece as chaves lidas (a próxima chamada relê a pasta)."""
+    global _chaves
+    with _trava:
+        _chaves = None
+
+
+def chave_de_assinatura():
+    """(kid, chave privada) que assina os tokens novos."""
+    chaves = _carregar()
+    if not chaves:
+        raise RuntimeError(
+            f"JWT_ALGORITMO=RS256 sem chaves em {JWT_CHAVES_DIR}: "
+            "rode 'python chaves_jwt.py nova'."
+        )
+    kid = JWT_KID_ATUAL or max(chaves)
+    if kid not in chaves:
+        raise RuntimeError(f"JWT_KID_ATUAL={kid} não existe em {JWT_CHAVES_DIR}.")
+    return kid, chaves[kid]
+
+
+def chave_publica(kid: str):
+    """Chave pública do 'kid' (None se não existe / foi aposentada). Kid
+    desconhecido relê a pasta antes (chave criada por outro worker)."""
+    chave = _carregar().get(kid or "")
+    if chave is None and kid:
+        chave = _carregar(_RELER_SEG).get(kid)
+    return chave.public_key() if chave else None
+
+
+def jwks() -> dict:
+    """Conteúdo do /.well-known/jwks.json (só as partes públicas)."""
+    keys = []
+    for kid, chave in _carregar().items():
+        d = chave.public_key().to_dict()
+        d.update(kid=kid, use="sig")
+        keys.append(d)
+    return {"keys": keys}
+
+
+def nova_chave() -> str:
+    """Gera uma chave RSA nova na pasta; devolve o kid."""
+    import rsa
+
+    os.makedirs(JWT_CHAVES_DIR, exist_ok=True)
+    kid = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    _, privada = rsa.newkeys(_BITS)
+    caminho = os.path.join(JWT_CHAVES_DIR, f"{kid}.pem")
+    fd = os.open(caminho, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(privada.save_pkcs1())
+    recarregar()
+    return kid
+
+
+def aposentar(kid: str):
+    """Tira a chave do JWKS (o arquivo vai para aposentadas/)."""
+    origem = os.path.join(JWT_CHAVES_DIR, f"{kid}.pem")
+    destino = os.path.join(JWT_CHAVES_DIR, "aposentadas")
+    os.makedirs(destino, exist_ok=True)
+    os.replace(origem, os.path.join(destino, f"{kid}.pem"))
+    recarregar()
+
+
+if __name__ == "__main__":
+    comando = sys.argv[1] if len(sys.argv) > 1 else "listar"
+    if comando == "nova":
+        print(f"✅ chave nova: {nova_chave()} (em {JWT_CHAVES_DIR})")
+    elif comando == "aposentar" and len(sys.argv) > 2:
+        aposentar(sys.argv[2])
+        print(f"✅ chave {sys.argv[2]} aposentada.")
+    elif comando == "listar":
+        chaves = _carregar()
+        atual = chave_de_assinatura()[0] if chaves else None
+        for kid in chaves:
+            print(kid, "<- assina" if kid == atual else "")
+        if not chaves:
+            print(f"(nenhuma chave em {JWT_CHAVES_DIR})")
+    else:
+        print("uso: python chaves_jwt.py [nova | listar | aposentar <kid>]")
+        sys.exit(1)
@@ -0,0 +1,321 @@
+# ===============================================================
+# FASE 2 — HISTÓRICO DEDUPLICADO (blocos por conteúdo)
+# ---------------------------------------------------------------
+# Guardar MAX_HISTORICO cópias inteiras por cliente custa ~5x o
+# tamanho do banco dele, mas versões seguidas são quase iguais.
+# Aqui cada cópia é cortada em BLOCOS definidos pelo conteúdo e
+# cada bloco é guardado uma vez só (chave = SHA-256):
+#
+#  - CORTE: o banco descompactado é lido em unidades de 4 KB (o
+#    tamanho de página do SQLite, então uma página alterada mexe em
+#    um bloco só). Corta-se um bloco depois de uma unidade cujo hash
+#    "cai na máscara" (média ~16 unidades = 64 KB; mín. 4, máx. 64).
+#    Como o corte depende do CONTEÚDO, inserir páginas no meio não
+#    desloca os blocos seguintes.
+#  - Cada bloco novo vira um membro gzip no blob store (cas/ab/<hash>).
+#    Juntar os membros na ordem dá um .gz válido da cópia inteira.
+#  - refs conta quantas vezes o bloco é usado; a poda só decrementa
+#    e o GC apaga o que ficou com refs = 0.
+#
+# Os blocos são sempre gzip, seja qual for a codificação da cópia
+# (compressao.py): é o que permite remontar o .gz juntando membros.
+#
+# A cópia MAIS RECENTE continua também como arquivo inteiro (para o
+# download via sendfile). Quando chega uma versão nova, o arquivo
+# inteiro da anterior é apagado e ela passa a existir só em blocos.
+# ===============================================================
+import gzip
+import hashlib
+import io
+from collections import Counter
+
+from sqlalchemy import bindparam, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal
+from models import BlocoConteudo, DbSnapshot, SnapshotBloco, SyncCabeca
+import compressao
+import snapshot_store
+
+UNIDADE = 4096
+MIN_UNIDADES = 4
+MAX_UNIDADES = 64
+_MASCARA = 0x0F   # 1 em 16 -> blocos de ~64 KB em média
+
+# Quantos blocos processar por vez (limita a memória e junta as queries).
+_LOTE = 32
+
+# Tabela "crua" (Core) para os UPDATE em lote (executemany).
+_BLOCOS = BlocoConteudo.__table__
+
+
+def _chave(h: str) -> str:
+    return f"cas/{h[:2]}/{h}.gz"
+
+
+def fatiar(arquivo):
+    """Corta o conteúdo (descompactado) de 'arquivo' em blocos definidos
+    pelo conteúdo. Gera os blocos (bytes) na ordem."""
+    buf = bytearray()
+    n = 0
+    while True:
+        unidade = arquivo.read(UNIDADE)
+        if not unidade:
+            break
+        buf += unidade
+        n += 1
+        corte = hashlib.blake2b(unidade, digest_size=1).digest()[0] & _MASCARA == 0
+        if n >= MAX_UNIDADES or (n >= MIN_UNIDADES and corte):
+            yield bytes(buf)
+            buf.clear()
+            n = 0
+    if buf:
+        yield bytes(buf)
+
+
+# ---------------------------------------------------------------
+# GRAVAÇÃO
+# ---------------------------------------------------------------
+def _somar_refs(db, contagem: dict) -> set:
+    """refs += n para blocos que JÁ existem. Devolve os que sumiram no
+    meio do caminho (apagados pelo GC) e precisam ser gravados de novo."""
+    if not contagem:
+        return set()
+    res = db.execute(
+        update(_BLOCOS)
+        .where(_BLOCOS.c.hash == bindparam("_h"))
+        .values(refs=_BLOCOS.c.refs + bindparam("_n")),
+        [{"_h": h, "_n": n} for h, n in contagem.items()],
+    )
+    if res.rowcount == len(contagem):
+        return set()
+    ainda_existem = {
+        h for (h,) in db.query(BlocoConteudo.hash)
+        .filter(BlocoConteudo.hash.in_(list(contagem)))
+        .all()
+    }
+    return set(contagem) - ainda_existem
+
+
+def _gravar_lote(db, snapshot_id: int, inicio: int, lote: list) -> int:
+    """Registra um lote [(hash, dados), ...] da cópia: soma refs dos blocos
+    que já existem e grava os novos. Devolve os bytes novos gravados."""
+    store = snapshot_store.get_store()
+    contagem = Counter(h for h, _ in lote)
+    existentes = {
+        h for (h,) in db.query(BlocoConteudo.hash)
+        .filter(BlocoConteudo.hash.in_(list(contagem)))
+        .all()
+    }
+    sumiram = _somar_refs(db, {h: contagem[h] for h in existentes})
+
+    novos = {}
+    for h, dados in lote:
+        if (h not in existentes or h in sumiram) and h not in novos:
+            # O arquivo vai ANTES da linha: linha existente = bloco legível.
+            gz = gzip.compress(dados, compresslevel=6, mtime=0)
+            store.gravar(_chave(h), gz)
+            novos[h] = (len(dados), len(gz))
+    if novos:
+        db.execute(insert(BlocoConteudo), [
+            {"hash": h, "tamanho": t, "tamanho_gz": tg, "refs": contagem[h]}
+            for h, (t, tg) in novos.items()
+        ])
+    db.execute(insert(SnapshotBloco), [
+        {"snapshot_id": snapshot_id, "ordem": inicio + i, "hash": h}
+        for i, (h, _) in enumerate(lote)
+    ])
+    db.commit()
+    return sum(tg for _, tg in novos.values())
+
+
+def guardar_em_blocos(db, snap: DbSnapshot, banco) -> tuple:
+    """Corta a cópia (o banco já descompactado) em blocos e registra todos.
+    Devolve (quantidade de blocos, bytes novos gravados)."""
+    total = 0
+    novos = 0
+    lote = []
+
+    def gravar():
+        nonlocal novos
+        try:
+            novos += _gravar_lote(db, snap.id, total - len(lote), lote)
+        except IntegrityError:
+            # Outro upload gravou o mesmo bloco novo ao mesmo tempo:
+            # agora ele existe, basta repetir o lote uma vez.
+            db.rollback()
+            novos += _gravar_lote(db, snap.id, total - len(lote), lote)
+        lote.clear()
+
+    for dados in fatiar(banco):
+        lote.append((hashlib.sha256(dados).hexdigest(), dados))
+        total += 1
+        if len(lote) >= _LOTE:
+            gravar()
+    if lote:
+        gravar()
+    return total, novos
+
+
+def arquivar_versao(snapshot_id: int):
+    """Tarefa de fundo depois de cada upload: guarda a cópia nova em blocos
+    e apaga o arquivo inteiro das versões anteriores que já estão em blocos.
+    Se der errado, a cópia só fica como arquivo inteiro (nada se perde)."""
+    db = SessionLocal()
+    try:
+        snap = db.query(DbSnapshot).filter(DbSnapshot.id == snapshot_id).first()
+        if not snap or snap.em_blocos or not snap.blob_ref:
+            return
+        user_id = snap.user_id
+        try:
+            codificacao = (snap.codificacao or compressao.GZIP, snap.dicionario)
+            with snapshot_store.get_store().abrir(snap.blob_ref) as f, \
+                    compressao.descompactar(f, *codificacao) as banco:
+                n, novos = guardar_em_blocos(db, snap, banco)
+        except Exception as e:
+            db.rollback()
+            liberar_blocos(db, [snapshot_id])
+            db.commit()
+            print(f"[blocos] ERRO ao guardar snapshot={snapshot_id} em blocos:", e)
+            return
+
+        if not db.query(DbSnapshot.id).filter(DbSnapshot.id == snapshot_id).first():
+            # Foi podado enquanto era guardado: devolve as referências.
+            liberar_blocos(db, [snapshot_id])
+            db.commit()
+            coletar_lixo(db)
+            return
+        snap.em_blocos = 1
+        db.commit()
+        print(f"[blocos] snapshot={snapshot_id} blocos={n} novos={novos} bytes")
+
+        soltar_arquivos_antigos(db, user_id)
+    finally:
+        db.close()
+
+
+def soltar_arquivos_antigos(db, user_id: int):
+    """Apaga o arquivo inteiro (e a cópia zstd ao lado) das cópias que NÃO
+    são a mais recente e que já estão guardadas em blocos (o histórico
+    passa a viver só em blocos)."""
+    cabeca = (
+        db.query(SyncCabeca.snapshot_id)
+        .filter(SyncCabeca.user_id == user_id)
+        .scalar()
+    )
+    if cabeca is None:
+        return
+    antigas = (
+        db.query(DbSnapshot)
+        .filter(
+            DbSnapshot.user_id == user_id,
+            DbSnapshot.id != cabeca,
+            DbSnapshot.em_blocos == 1,
+            or_(DbSnapshot.blob_ref.isnot(None), DbSnapshot.zstd_ref.isnot(None)),
+        )
+        .all()
+    )
+    refs = [ref for a in antigas for ref in (a.blob_ref, a.zstd_ref) if ref]
+    for a in antigas:
+        a.blob_ref = None
+        a.zstd_ref = a.zstd_dicionario = a.zstd_tamanho = None
+    db.commit()
+    store = snapshot_store.get_store()
+    for ref in refs:
+        store.apagar(ref)
+
+
+# ---------------------------------------------------------------
+# LEITURA
+# ---------------------------------------------------------------
+class _LeitorBlocos(io.RawIOBase):
+    """Arquivo (só leitura, sequencial) com os membros gzip dos blocos de
+    uma cópia, um atrás do outro — ou seja, o .gz da cópia inteira."""
+
+    def __init__(self, hashes):
+        self._hashes = iter(hashes)
+        self._atual = None
+        self._store = snapshot_store.get_store()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            if self._atual is None:
+                h = next(self._hashes, None)
+                if h is None:
+                    return 0
+                self._atual = self._store.abrir(_chave(h))
+            n = self._atual.readinto(buf)
+            if n:
+                return n
+            self._atual.close()
+            self._atual = None
+
+    def close(self):
+        if self._atual is not None:
+            self._atual.close()
+            self._atual = None
+        super().close()
+
+
+def abrir_blocos(db, snapshot_id: int):
+    """Abre a cópia guardada em blocos como um arquivo .gz (multi-membro)."""
+    hashes = [
+        h for (h,) in db.query(SnapshotBloco.hash)
+        .filter(SnapshotBloco.snapshot_id == snapshot_id)
+        .order_by(SnapshotBloco.ordem)
+        .all()
+    ]
+    return io.BufferedReader(_LeitorBlocos(hashes), snapshot_store.BLOCO_BYTES)
+
+
+# ---------------------------------------------------------------
+# PODA / GC
+# ---------------------------------------------------------------
+def liberar_blocos(db, snapshot_ids: list):
+    """Tira as referências das cópias indicadas (refs -= usos). Não faz
+    commit; os blocos que zerarem são apagados depois por coletar_lixo()."""
+    if not snapshot_ids:
+        return
+    usos = (
+        db.query(SnapshotBloco.hash, SnapshotBloco.ordem)
+        .filter(SnapshotBloco.snapshot_id.in_(snapshot_ids))
+        .all()
+    )
+    contagem = Counter(h for h, _ in usos)
+    if contagem:
+        db.execute(
+            update(_BLOCOS)
+            .where(_BLOCOS.c.hash == bindparam("_h"))
+            .values(refs=_BLOCOS.c.refs - bindparam("_n")),
+            [{"_h": h, "_n": n} for h, n in contagem.items()],
+        )
+    db.query(SnapshotBloco).filter(
+        SnapshotBloco.snapshot_id.in_(snapshot_ids)
+    ).delete(synchronize_session=False)
+
+
+def coletar_lixo(db) -> int:
+    """Apaga os blocos que nenhuma cópia usa mais (refs <= 0). As linhas
+    ficam travadas (FOR UPDATE) enquanto os arquivos são apagados, para
+    um upload simultâneo não "ressuscitar" um bloco no meio do caminho.
+    Devolve quantos blocos foram apagados."""
+    lixo = [
+        h for (h,) in db.query(BlocoConteudo.hash)
+        .filter(BlocoConteudo.refs <= 0)
+        .with_for_update(skip_locked=True)
+        .all()
+    ]
+    if not lixo:
+        db.commit()
+        return 0
+    store = snapshot_store.get_store()
+    for h in lixo:
+        store.apagar(_chave(h))
+    db.query(BlocoConteudo).filter(
+        BlocoConteudo.hash.in_(lixo)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return len(lixo)
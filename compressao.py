@@ -0,0 +1,366 @@
+# ===============================================================
+# FASE 2 — COMPACTAÇÃO DAS CÓPIAS (gzip ou zstd com dicionário)
+# ---------------------------------------------------------------
+# Toda cópia do banco está em UMA destas codificações:
+#   gzip       -> o padrão (apps antigos só conhecem esta)
+#   zstd+dict  -> zstd com um dicionário treinado no esquema do
+#                 AGRIVIA (menor no disco e no download, e o app
+#                 descompacta bem mais rápido)
+#
+# NEGOCIAÇÃO (cabeçalhos HTTP do /api/sync):
+#   upload:   X-DB-Encoding: zstd+dict  +  X-DB-Dict: <versão>
+#   download: X-DB-Accept-Encoding: zstd+dict, gzip
+#             X-DB-Dicts: 2,3   (dicionários que o app já tem)
+#   resposta: X-DB-Encoding / X-DB-Dict dizem o que foi enviado.
+# Sem esses cabeçalhos, tudo continua em gzip como antes. Se a cópia
+# guardada está numa codificação que o app não aceita (upload em zstd,
+# download por app antigo), o servidor converte no caminho (sem Range).
+#
+# Os dicionários são versionados (tabela dicionarios_zstd) e baixados
+# pelo app em GET /api/sync/dicionarios/{versao}. Quem cria uma versão
+# nova é o script treinar_dicionario.py.
+#
+# RECOMPACTAÇÃO: recomprimir_versao() grava, em segundo plano, a cópia
+# atual de um usuário em zstd+dict com o dicionário atual. Se o arquivo
+# é gzip, ele FICA (apps antigos do mesmo usuário baixam direto dele) e
+# o zstd vai AO LADO (db_snapshots.zstd_ref), servido a quem aceita.
+# Só uma cópia que já chegou em zstd é trocada no lugar.
+#
+# A biblioteca 'zstandard' é opcional: sem ela (ou com SYNC_ZSTD=0)
+# o servidor só fala gzip.
+# ===============================================================
+import gzip
+import hashlib
+import os
+import time
+import zlib
+
+from sqlalchemy import func, or_, update
+
+from database import SessionLocal
+from models import DbSnapshot, DicionarioZstd, SyncCabeca
+import snapshot_store
+
+try:
+    import zstandard
+except ImportError:  # opcional
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD_DICT = "zstd+dict"
+
+SYNC_ZSTD = os.getenv("SYNC_ZSTD", "1") == "1"
+
+# Nível da recompactação em segundo plano (mais alto = menor e mais lento).
+ZSTD_NIVEL = int(os.getenv("SYNC_ZSTD_NIVEL", "12"))
+
+# Por quanto tempo lembrar qual é o dicionário atual (o /status consulta).
+_ATUAL_TTL_SEG = 60
+
+_dicionarios = {}      # versão -> zstandard.ZstdCompressionDict
+_atual = (None, 0.0)   # (versão atual, quando foi lida)
+
+
+def zstd_ligado() -> bool:
+    return SYNC_ZSTD and zstandard is not None
+
+
+# ---------------------------------------------------------------
+# DICIONÁRIOS
+# ---------------------------------------------------------------
+def dicionario(versao):
+    """O dicionário (objeto do zstandard) de uma versão, ou None se não
+    existir. Como nunca mudam, ficam em memória depois da 1ª leitura."""
+    if versao is None or not zstd_ligado():
+        return None
+    d = _dicionarios.get(versao)
+    if d is None:
+        db = SessionLocal()
+        try:
+            dados = (
+                db.query(DicionarioZstd.dados)
+                .filter(DicionarioZstd.versao == versao)
+                .scalar()
+            )
+        finally:
+            db.close()
+        if dados is None:
+            return None
+        d = zstandard.ZstdCompressionDict(bytes(dados))
+        _dicionarios[versao] = d
+    return d
+
+
+def versao_atual():
+    """Versão do dicionário mais novo (o usado nas recompactações), ou
+    None se não há nenhum ou o zstd está desligado."""
+    global _atual
+    if not zstd_ligado():
+        return None
+    versao, lido_em = _atual
+    if time.monotonic() - lido_em > _ATUAL_TTL_SEG:
+        db = SessionLocal()
+        try:
+            versao = db.query(func.max(DicionarioZstd.versao)).scalar()
+        finally:
+            db.close()
+        _atual = (versao, time.monotonic())
+    return versao
+
+
+def salvar_dicionario(db, dados: bytes, amostras: int) -> int:
+    """Grava um dicionário novo (vira o atual). Devolve a versão criada."""
+    global _atual
+    ultima = db.query(func.max(DicionarioZstd.versao)).scalar() or 0
+    novo = DicionarioZstd(
+        versao=ultima + 1, dados=dados, tamanho=len(dados), amostras=amostras
+    )
+    db.add(novo)
+    db.commit()
+    _atual = (None, 0.0)
+    return novo.versao
+
+
+# ---------------------------------------------------------------
+# COMPACTAR / DESCOMPACTAR
+# ---------------------------------------------------------------
+# O decompressobj do zstd não tem limite de saída: a entrada vai em
+# fatias pequenas para um pedaço descompactado nunca ficar enorme
+# (bomba de compressão) antes da cota ser conferida.
+_ZSTD_FATIA = 4096
+
+
+class _DescompactadorZstd:
+    """Mesma interface do snapshot_store.DescompactadorGzip."""
+
+    def __init__(self, d):
+        self._dctx = zstandard.ZstdDecompressor(dict_data=d)
+        self._obj = None
+
+    def alimentar(self, bloco: bytes):
+        try:
+            pos = 0
+            while pos < len(bloco):
+                if self._obj is None:
+                    self._obj = self._dctx.decompressobj()
+                fatia = bloco[pos:pos + _ZSTD_FATIA]
+                pos += len(fatia)
+                yield self._obj.decompress(fatia)
+                if self._obj.eof:
+                    # Fim de um frame; pode haver outro em seguida.
+                    resto = self._obj.unused_data
+                    self._obj = None
+                    if resto:
+                        bloco, pos = resto + bloco[pos:], 0
+        except zstandard.ZstdError as e:
+            raise ValueError(f"zstd inválido: {e}")
+
+    @property
+    def completo(self) -> bool:
+        return self._obj is None
+
+
+def aceita(codificacao: str, versao_dict=None) -> bool:
+    """O servidor sabe ler/gravar essa codificação (e esse dicionário)?"""
+    if codificacao == GZIP:
+        return True
+    return codificacao == ZSTD_DICT and dicionario(versao_dict) is not None
+
+
+def descompactador(codificacao: str, versao_dict=None):
+    """Descompactador incremental (para snapshot_store.HashDoBanco)."""
+    if codificacao == ZSTD_DICT:
+        return _DescompactadorZstd(dicionario(versao_dict))
+    return snapshot_store.DescompactadorGzip()
+
+
+def descompactar(arquivo, codificacao: str, versao_dict=None):
+    """Abre o conteúdo (o banco SQLite) de um arquivo compactado, para
+    ler em sequência. Fechar o leitor NÃO fecha o 'arquivo'."""
+    if codificacao == ZSTD_DICT:
+        dctx = zstandard.ZstdDecompressor(dict_data=dicionario(versao_dict))
+        return dctx.stream_reader(arquivo, read_across_frames=True, closefd=False)
+    return gzip.GzipFile(fileobj=arquivo, mode="rb")
+
+
+def compactador(codificacao: str, versao_dict=None, nivel: int = None):
+    """Objeto com compress(bytes) / flush() na codificação pedida."""
+    if codificacao == ZSTD_DICT:
+        cctx = zstandard.ZstdCompressor(
+            level=nivel or ZSTD_NIVEL, dict_data=dicionario(versao_dict)
+        )
+        return cctx.compressobj()
+    return zlib.compressobj(nivel or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def converter(arquivo, de, para):
+    """Gera o arquivo convertido de uma codificação para outra, em pedaços.
+    'de' e 'para' são pares (codificacao, versao_dict)."""
+    comp = compactador(*para)
+    with descompactar(arquivo, *de) as banco:
+        for bloco in snapshot_store.ler_em_blocos(banco):
+            dados = comp.compress(bloco)
+            if dados:
+                yield dados
+    yield comp.flush()
+
+
+def _nomes(aceitas: str) -> set:
+    return {a.split(";")[0].strip().lower() for a in (aceitas or "").split(",")}
+
+
+def negociar(aceitas: str, dicts: str, guardada: tuple) -> tuple:
+    """Escolhe em que codificação mandar a cópia para o app.
+    aceitas = X-DB-Accept-Encoding, dicts = X-DB-Dicts, guardada =
+    (codificacao, versao_dict) de como a cópia está no disco.
+    Prefere mandar como está (sem converter); senão, gzip."""
+    nomes = _nomes(aceitas) | {GZIP}
+    tem = set()
+    for v in (dicts or "").split(","):
+        v = v.strip()
+        if v.isdigit():
+            tem.add(int(v))
+    codificacao, versao_dict = guardada
+    if codificacao == ZSTD_DICT and (ZSTD_DICT not in nomes or versao_dict not in tem):
+        return (GZIP, None)
+    return guardada
+
+
+def aceita_zstd(aceitas: str) -> bool:
+    """O app disse que entende zstd+dict (X-DB-Accept-Encoding)?"""
+    return ZSTD_DICT in _nomes(aceitas)
+
+
+# ---------------------------------------------------------------
+# RECOMPACTAÇÃO EM SEGUNDO PLANO
+# ---------------------------------------------------------------
+def recomprimir_versao(snapshot_id: int):
+    """Grava a cópia em zstd+dict com o dicionário atual: ao lado do
+    arquivo se ele é gzip (zstd_ref), no lugar dele se já é zstd. Confere
+    o conteúdo (db_sha256) antes; só guarda se ficar menor que o arquivo.
+    Se a cópia mudou/foi podada no meio, desiste."""
+    alvo = versao_atual()
+    if alvo is None:
+        return
+    db = SessionLocal()
+    try:
+        snap = db.get(DbSnapshot, snapshot_id)
+        if not snap or not snap.blob_ref:
+            return
+        origem = (snap.codificacao or GZIP, snap.dicionario)
+        if origem == (ZSTD_DICT, alvo) or snap.zstd_dicionario == alvo \
+                or not aceita(*origem):
+            return
+        ao_lado = origem[0] == GZIP
+
+        store = snapshot_store.get_store()
+        escrita = store.nova_escrita(snap.user_id, codificacao=ZSTD_DICT)
+        hash_banco = hashlib.sha256()
+        comp = compactador(ZSTD_DICT, alvo)
+        antiga, tamanho_antes = snap.blob_ref, snap.tamanho_bytes or 0
+        lateral_antiga = snap.zstd_ref
+        try:
+            with store.abrir(antiga) as f, descompactar(f, *origem) as banco:
+                for bloco in snapshot_store.ler_em_blocos(banco):
+                    hash_banco.update(bloco)
+                    dados = comp.compress(bloco)
+                    if dados:
+                        escrita.escrever(dados)
+                escrita.escrever(comp.flush())
+            if snap.db_sha256 and hash_banco.hexdigest() != snap.db_sha256:
+                raise ValueError("conteúdo descompactado não confere")
+            if escrita.tamanho >= tamanho_antes:
+                escrita.descartar()
+                return
+            nova = escrita.concluir()
+        except Exception as e:
+            escrita.descartar()
+            print(f"[compressao] ERRO ao recompactar snapshot={snapshot_id}:", e)
+            return
+
+        if ao_lado:
+            res = db.execute(
+                update(DbSnapshot)
+                .where(
+                    DbSnapshot.id == snapshot_id,
+                    DbSnapshot.blob_ref == antiga,
+                    DbSnapshot.zstd_ref == lateral_antiga if lateral_antiga
+                    else DbSnapshot.zstd_ref.is_(None),
+                )
+                .values(zstd_ref=nova, zstd_dicionario=alvo, zstd_tamanho=escrita.tamanho)
+                .execution_options(synchronize_session=False)
+            )
+            if res.rowcount != 1:
+                db.rollback()
+                store.apagar(nova)
+                return
+            db.commit()
+            if lateral_antiga:
+                store.apagar(lateral_antiga)
+            print(f"[compressao] snapshot={snapshot_id} + {ZSTD_DICT} ao lado "
+                  f"(dict {alvo}): {tamanho_antes} -> {escrita.tamanho} bytes")
+            return
+
+        valores = dict(
+            sha256=escrita.sha256,
+            tamanho_bytes=escrita.tamanho,
+            db_sha256=hash_banco.hexdigest(),
+        )
+        res = db.execute(
+            update(DbSnapshot)
+            .where(DbSnapshot.id == snapshot_id, DbSnapshot.blob_ref == antiga)
+            .values(blob_ref=nova, codificacao=ZSTD_DICT, dicionario=alvo, **valores)
+            .execution_options(synchronize_session=False)
+        )
+        if res.rowcount != 1:
+            db.rollback()
+            store.apagar(nova)
+            return
+        db.execute(
+            update(SyncCabeca)
+            .where(SyncCabeca.snapshot_id == snapshot_id)
+            .values(**valores)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        store.apagar(antiga)
+        print(f"[compressao] snapshot={snapshot_id} {origem[0]} -> {ZSTD_DICT} "
+              f"(dict {alvo}): {tamanho_antes} -> {escrita.tamanho} bytes")
+    finally:
+        db.close()
+
+
+def recomprimir_pendentes(limite: int = None) -> int:
+    """Recompacta as cópias ATUAIS que ainda não têm arquivo (ou cópia ao
+    lado) no dicionário atual (ex.: depois de treinar um dicionário novo).
+    Devolve quantas tentou."""
+    alvo = versao_atual()
+    if alvo is None:
+        return 0
+    db = SessionLocal()
+    try:
+        q = (
+            db.query(DbSnapshot.id)
+            .join(SyncCabeca, SyncCabeca.snapshot_id == DbSnapshot.id)
+            .filter(
+                DbSnapshot.blob_ref.isnot(None),
+                or_(
+                    DbSnapshot.codificacao.is_(None),
+                    DbSnapshot.codificacao != ZSTD_DICT,
+                    DbSnapshot.dicionario != alvo,
+                ),
+                or_(
+                    DbSnapshot.zstd_dicionario.is_(None),
+                    DbSnapshot.zstd_dicionario != alvo,
+                ),
+            )
+            .order_by(DbSnapshot.id)
+        )
+        if limite:
+            q = q.limit(limite)
+        ids = [i for (i,) in q.all()]
+    finally:
+        db.close()
+    for snapshot_id in ids:
+        recomprimir_versao(snapshot_id)
+    return len(ids)
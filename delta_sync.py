@@ -0,0 +1,148 @@
+# ===============================================================
+# FASE 2 — SINCRONIZAÇÃO POR DIFERENÇA (delta de blocos)
+# ---------------------------------------------------------------
+# Entre uma versão e outra, o banco SQLite do cliente muda só em
+# algumas páginas. Em vez de mandar o arquivo inteiro, os dois
+# lados comparam o banco DESCOMPACTADO em blocos de tamanho fixo:
+#
+#   MANIFESTO = lista com o SHA-256 (hex) de cada bloco do banco.
+#   DELTA     = só os blocos que mudaram/faltam, no formato:
+#
+#     gzip( "AGDL1" + tamanho_bloco (u32)
+#           + [indice (u32) + tamanho (u32) + bytes] ...   (ordem crescente)
+#           + 0xFFFFFFFF (u32) + tamanho_total_do_banco (u64) )
+#
+#   (inteiros em big-endian.) Bloco que NÃO vem no delta = igual
+#   ao da versão base. O tamanho total vai no fim porque só é
+#   conhecido depois de ler o banco inteiro.
+#
+# Com a versão base + o delta, o servidor remonta a versão nova
+# sem receber o arquivo completo (e o cliente faz o mesmo no
+# download). Tudo em streaming: nunca há um banco inteiro na memória.
+#
+# As funções daqui recebem o banco JÁ DESCOMPACTADO (a cópia pode estar
+# em gzip ou zstd — ver compressao.descompactar). A versão remontada
+# sai em gzip.
+# ===============================================================
+import gzip
+import hashlib
+import struct
+import zlib
+
+MAGICO = b"AGDL1"
+FIM = 0xFFFFFFFF
+
+BLOCO_PADRAO = 64 * 1024
+BLOCOS_PERMITIDOS = (4096, 8192, 16384, 32768, 65536, 131072, 262144, 524288, 1048576)
+
+
+class DeltaInvalido(ValueError):
+    pass
+
+
+def _novo_gzip():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _ler_exato(f, n):
+    dados = f.read(n)
+    if len(dados) != n:
+        raise DeltaInvalido("delta truncado")
+    return dados
+
+
+def blocos_do_banco(banco, tamanho_bloco):
+    """Gera os blocos do banco (arquivo já descompactado)."""
+    while True:
+        bloco = banco.read(tamanho_bloco)
+        if not bloco:
+            return
+        yield bloco
+
+
+def manifesto(banco, tamanho_bloco=BLOCO_PADRAO) -> dict:
+    """Hash de cada bloco do banco (o que o outro lado compara com o seu)."""
+    hashes = []
+    tamanho = 0
+    for bloco in blocos_do_banco(banco, tamanho_bloco):
+        hashes.append(hashlib.sha256(bloco).hexdigest())
+        tamanho += len(bloco)
+    return {"block_size": tamanho_bloco, "tamanho": tamanho, "hashes": hashes}
+
+
+def gerar_delta(banco, hashes_outro_lado, tamanho_bloco):
+    """Gera (em pedaços já compactados) o delta com os blocos deste banco
+    que o outro lado NÃO tem, segundo o manifesto dele."""
+    comp = _novo_gzip()
+    tamanho = 0
+    yield comp.compress(MAGICO + struct.pack(">I", tamanho_bloco))
+    for i, bloco in enumerate(blocos_do_banco(banco, tamanho_bloco)):
+        tamanho += len(bloco)
+        if i < len(hashes_outro_lado) and hashes_outro_lado[i] == hashlib.sha256(bloco).hexdigest():
+            continue
+        saida = comp.compress(struct.pack(">II", i, len(bloco)) + bloco)
+        if saida:
+            yield saida
+    yield comp.compress(struct.pack(">IQ", FIM, tamanho)) + comp.flush()
+
+
+def aplicar_delta(base_banco, delta_arquivo, escrever, hash_banco=None) -> int:
+    """Remonta o banco novo = base + delta e entrega o resultado JÁ EM GZIP,
+    em pedaços, para a função escrever(bytes). Devolve o tamanho do banco
+    novo (descompactado). Levanta DeltaInvalido se o delta não fechar.
+    Se vier hash_banco (hashlib), ele recebe o banco novo descompactado."""
+    delta = gzip.GzipFile(fileobj=delta_arquivo, mode="rb")
+    try:
+        if _ler_exato(delta, len(MAGICO)) != MAGICO:
+            raise DeltaInvalido("formato de delta desconhecido")
+        (tamanho_bloco,) = struct.unpack(">I", _ler_exato(delta, 4))
+        if tamanho_bloco not in BLOCOS_PERMITIDOS:
+            raise DeltaInvalido("tamanho de bloco inválido")
+
+        base = blocos_do_banco(base_banco, tamanho_bloco)
+        comp = _novo_gzip()
+        proximo = 0   # próximo índice de bloco a sair no banco novo
+        escrito = 0
+
+        def sair(bloco):
+            nonlocal escrito
+            escrito += len(bloco)
+            if hash_banco is not None:
+                hash_banco.update(bloco)
+            dados = comp.compress(bloco)
+            if dados:
+                escrever(dados)
+
+        def bloco_da_base():
+            try:
+                return next(base)
+            except StopIteration:
+                raise DeltaInvalido("delta pede um bloco que a versão base não tem")
+
+        while True:
+            (indice,) = struct.unpack(">I", _ler_exato(delta, 4))
+            if indice == FIM:
+                (total,) = struct.unpack(">Q", _ler_exato(delta, 8))
+                break
+            (n,) = struct.unpack(">I", _ler_exato(delta, 4))
+            if indice < proximo or n > tamanho_bloco:
+                raise DeltaInvalido("blocos fora de ordem")
+            while proximo < indice:          # blocos iguais: vêm da base
+                sair(bloco_da_base())
+                proximo += 1
+            next(base, None)                 # o bloco da base é substituído
+            sair(_ler_exato(delta, n))
+            proximo += 1
+
+        # Resto do banco (sem mudanças) vem da base, cortado no tamanho total.
+        while escrito < total:
+            bloco = bloco_da_base()
+            sair(bloco[: total - escrito])
+        if escrito != total:
+            raise DeltaInvalido("tamanho final não confere")
+        escrever(comp.flush())
+        return total
+    except (OSError, EOFError, struct.error, zlib.error) as e:
+        raise DeltaInvalido(f"delta corrompido: {e}")
+    finally:
+        delta.close()
@@ -0,0 +1,238 @@
+# ===============================================================
+# ESCRITAS EM LOTE (write-behind)
+# ---------------------------------------------------------------
+# Contadores e "visto por último" não precisam ir para o banco na
+# mesma hora. Um BufferDeEscrita junta as atualizações em memória,
+# POR CHAVE (o mesmo aparelho 30 vezes vira 1 linha com n = 30), e
+# grava tudo de uma vez — a cada 'intervalo' segundos ou assim que
+# junta 'max_itens' chaves. Quem chama não espera o banco.
+#
+# Para usar: herde, diga como juntar dois valores da mesma chave
+# (juntar) e como gravar um lote (gravar, de preferência com um
+# UPSERT só via executemany). Ao encerrar o processo, o que ficou
+# pendente é gravado (atexit).
+#
+# RESERVA (opcional): com 'reserva' = caminho de um arquivo, o que não
+# deu para gravar ao encerrar (banco fora do ar no deploy) vai para esse
+# arquivo, uma linha JSON por chave, e volta para a fila quando o
+# processo sobe de novo. Quem usa implementa para_json / de_json.
+#
+# Se o lote falhar:
+#   - IntegrityError (ex.: a conta foi excluída no meio) -> grava um
+#     por um e descarta só o que continuar falhando;
+#   - qualquer outro erro (banco fora do ar) -> devolve tudo para a
+#     fila e tenta de novo na próxima rodada.
+# ===============================================================
+import atexit
+import json
+import os
+import threading
+
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal, engine
+
+_buffers = []
+
+
+def upsert(tabela, chaves: list, atualizar):
+    """INSERT ... ON CONFLICT (chaves) DO UPDATE, no Postgres ou no SQLite.
+    'atualizar' recebe as colunas 'excluded' (a linha que tentou entrar)
+    e devolve o dicionário do SET."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(tabela)
+    return stmt.on_conflict_do_update(index_elements=chaves, set_=atualizar(stmt.excluded))
+
+
+class BufferDeEscrita:
+    nome = "buffer"
+
+    def __init__(self, intervalo: float, max_itens: int, reserva: str = None):
+        self.intervalo = intervalo
+        self.max_itens = max_itens
+        self.reserva = reserva
+        self._itens = {}
+        self._trava = threading.Lock()
+        self._trava_gravacao = threading.Lock()   # um lote por vez
+        self._acordar = threading.Event()
+        self._thread = None
+        self.gravados = 0
+        self.lotes = 0
+        self.falhas = 0
+        self.descartados = 0
+        self.recuperados = 0
+        _buffers.append(self)
+        if reserva:
+            self.recuperar_reserva()
+
+    # -- a implementar -------------------------------------------
+    def juntar(self, atual, novo):
+        """Valor combinado de duas atualizações da MESMA chave."""
+        raise NotImplementedError
+
+    def gravar(self, db, itens: dict):
+        """Grava o lote {chave: valor} (sem commit; a base faz)."""
+        raise NotImplementedError
+
+    def para_json(self, chave, valor) -> dict:
+        """Uma linha da reserva (só com 'reserva')."""
+        raise NotImplementedError
+
+    def de_json(self, linha: dict):
+        """(chave, valor) de volta a partir de uma linha da reserva."""
+        raise NotImplementedError
+
+    # -- uso -----------------------------------------------------
+    def adicionar(self, chave, valor):
+        with self._trava:
+            atual = self._itens.get(chave)
+            self._itens[chave] = valor if atual is None else self.juntar(atual, valor)
+            cheio = len(self._itens) >= self.max_itens
+        self._garantir_thread()
+        if cheio:
+            self._acordar.set()
+
+    def esquecer(self, condicao):
+        """Tira da fila as chaves em que condicao(chave) é verdadeira."""
+        with self._trava:
+            for chave in [c for c in self._itens if condicao(c)]:
+                del self._itens[chave]
+
+    def pendentes(self) -> int:
+        with self._trava:
+            return len(self._itens)
+
+    def estatisticas(self) -> dict:
+        return {
+            "pendentes": self.pendentes(),
+            "gravados": self.gravados,
+            "lotes": self.lotes,
+            "falhas": self.falhas,
+            "descartados": self.descartados,
+            "recuperados": self.recuperados,
+        }
+
+    def descarregar(self) -> int:
+        """Grava AGORA o que está pendente. Devolve quantas chaves gravou."""
+        with self._trava_gravacao:
+            with self._trava:
+                itens, self._itens = self._itens, {}
+            if not itens:
+                return 0
+            db = SessionLocal()
+            try:
+                self.gravar(db, itens)
+                db.commit()
+                gravados = len(itens)
+            except IntegrityError:
+                db.rollback()
+                gravados = self._um_a_um(db, itens)
+            except Exception as e:
+                db.rollback()
+                self.falhas += 1
+                self._devolver(itens)
+                print(f"[lote:{self.nome}] falha ao gravar {len(itens)} item(ns), "
+                      f"tento de novo depois:", e)
+                return 0
+            finally:
+                db.close()
+            self.gravados += gravados
+            self.lotes += 1
+            return gravados
+
+    def guardar_reserva(self) -> int:
+        """Passa o que está pendente para o arquivo de reserva (acrescenta).
+        Devolve quantas chaves guardou."""
+        with self._trava:
+            itens, self._itens = self._itens, {}
+        if not itens:
+            return 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.reserva)), exist_ok=True)
+        with open(self.reserva, "a", encoding="utf-8") as f:
+            for chave, valor in itens.items():
+                f.write(json.dumps(self.para_json(chave, valor), ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return len(itens)
+
+    def recuperar_reserva(self) -> int:
+        """Põe de volta na fila o que está no arquivo de reserva. Com vários
+        workers subindo juntos, só um pega o arquivo (os.replace)."""
+        tomado = f"{self.reserva}.{os.getpid()}"
+        try:
+            os.replace(self.reserva, tomado)
+        except FileNotFoundError:
+            return 0
+        n = 0
+        with open(tomado, encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    chave, valor = self.de_json(json.loads(linha))
+                except (ValueError, KeyError, TypeError):
+                    continue   # linha cortada (queda no meio da escrita)
+                self.adicionar(chave, valor)
+                n += 1
+        os.remove(tomado)
+        self.recuperados += n
+        if n:
+            print(f"[lote:{self.nome}] {n} item(ns) recuperado(s) da reserva.")
+        return n
+
+    # -- interno -------------------------------------------------
+    def _um_a_um(self, db, itens: dict) -> int:
+        gravados = 0
+        for chave, valor in itens.items():
+            try:
+                self.gravar(db, {chave: valor})
+                db.commit()
+                gravados += 1
+            except IntegrityError as e:
+                db.rollback()
+                self.descartados += 1
+                print(f"[lote:{self.nome}] descartado {chave!r}:", e.orig)
+        return gravados
+
+    def _devolver(self, itens: dict):
+        with self._trava:
+            for chave, valor in itens.items():
+                novo = self._itens.get(chave)
+                self._itens[chave] = valor if novo is None else self.juntar(valor, novo)
+
+    def _garantir_thread(self):
+        if self._thread is not None:
+            return
+        with self._trava:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._rodar, name=f"lote-{self.nome}", daemon=True
+                )
+                self._thread.start()
+
+    def _rodar(self):
+        while True:
+            self._acordar.wait(self.intervalo)
+            self._acordar.clear()
+            try:
+                self.descarregar()
+            except Exception as e:
+                print(f"[lote:{self.nome}] erro inesperado:", e)
+
+
+@atexit.register
+def descarregar_todos():
+    """Grava o que ficou pendente em todos os buffers (ao encerrar). O que
+    não foi para o banco vai para a reserva, se o buffer tiver uma."""
+    for b in _buffers:
+        try:
+            b.descarregar()
+        except Exception as e:
+            print(f"[lote:{b.nome}] não gravou ao encerrar:", e)
+        if b.reserva and b.pendentes():
+            try:
+                print(f"[lote:{b.nome}] {b.guardar_reserva()} item(ns) "
+                      f"guardado(s) em {b.reserva}.")
+            except Exception as e:
+                print(f"[lote:{b.nome}] não guardou a reserva:", e)
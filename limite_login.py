@@ -0,0 +1,255 @@
+# ===============================================================
+# LIMITE DE TENTATIVAS DE LOGIN (token bucket por IP e por e-mail)
+# ---------------------------------------------------------------
+# Cada tentativa em /api/login e /admin/login gasta uma ficha de TRÊS
+# baldes:
+#   ip:<ip>                -> LOGIN_IP_*
+#   email:<e-mail>|<rede>  -> LOGIN_EMAIL_*, o e-mail digitado NAQUELA
+#                             REDE (/24 no IPv4, /64 no IPv6): quem erra
+#                             a senha de propósito de outro lugar não
+#                             tranca o dono da conta
+#   email:<e-mail>         -> LOGIN_CONTA_*, o e-mail de qualquer rede:
+#                             bem mais folgado, mas um ataque espalhado
+#                             por muitas redes contra UMA conta continua
+#                             limitado
+# Cada balde enche sozinho, aos
+# poucos (LOGIN_*_POR_MIN fichas por minuto, até LOGIN_*_MAX) — uma
+# janela deslizante, sem "virada de minuto" para o atacante aproveitar.
+# Balde vazio = 429 com Retry-After, ANTES de ir ao banco e ao bcrypt:
+# uma rodada de credential stuffing não come a CPU do servidor.
+# Login certo zera só o balde do e-mail naquela rede (quem erra a senha
+# e acerta não fica preso); o da conta continua enchendo no seu ritmo.
+#
+# IP DO CLIENTE (ip_do_cliente, o ÚNICO lugar que lê X-Forwarded-For):
+# cada proxy na frente do servidor acrescenta um item no FIM do
+# cabeçalho; o que vem antes é do cliente e pode ser inventado. Com
+# PROXIES_CONFIAVEIS=N (Railway: 1), o IP é o N-ésimo item a partir do
+# fim; 0 = não há proxy, vale o IP da conexão.
+#
+# Os baldes ficam na memória do processo (até LOGIN_LIMITE_CHAVES; os
+# mais antigos saem primeiro). Com vários workers, cada um tem os seus
+# — LOGIN_LIMITE_COMPARTILHADO=1 guarda os baldes no banco (tabela
+# limites_login), um SELECT ... FOR UPDATE por tentativa: bem mais
+# barato que um bcrypt.
+#
+# Contadores em estatisticas() (aparecem em /admin/metricas).
+# ===============================================================
+import ipaddress
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal
+from models import LimiteLogin
+
+LOGIN_LIMITE = os.getenv("LOGIN_LIMITE", "1") == "1"
+LOGIN_IP_MAX = float(os.getenv("LOGIN_IP_MAX", "20"))
+LOGIN_IP_POR_MIN = float(os.getenv("LOGIN_IP_POR_MIN", "10"))
+LOGIN_EMAIL_MAX = float(os.getenv("LOGIN_EMAIL_MAX", "5"))
+LOGIN_EMAIL_POR_MIN = float(os.getenv("LOGIN_EMAIL_POR_MIN", "1"))
+LOGIN_CONTA_MAX = float(os.getenv("LOGIN_CONTA_MAX", "50"))
+LOGIN_CONTA_POR_MIN = float(os.getenv("LOGIN_CONTA_POR_MIN", "10"))
+LOGIN_LIMITE_CHAVES = int(os.getenv("LOGIN_LIMITE_CHAVES", "100000"))
+LOGIN_LIMITE_COMPARTILHADO = os.getenv("LOGIN_LIMITE_COMPARTILHADO", "0") == "1"
+PROXIES_CONFIAVEIS = int(os.getenv("PROXIES_CONFIAVEIS", "1"))
+
+# Tamanho da "rede" do balde do e-mail (uma casa/empresa fica numa só).
+_REDE_V4 = 24
+_REDE_V6 = 64
+
+# Baldes parados há mais que isso já estariam cheios: podem sair do banco.
+_LIMPAR_APOS_SEG = 3600
+_LIMPAR_A_CADA = 1000
+
+
+def ip_do_cliente(request) -> str:
+    """IP de quem chamou, pela regra de PROXIES_CONFIAVEIS (ver o
+    cabeçalho). Usado no limite de login, no aceite dos termos e na
+    assinatura."""
+    xff = request.headers.get("x-forwarded-for")
+    if xff and PROXIES_CONFIAVEIS > 0:
+        itens = [i.strip() for i in xff.split(",") if i.strip()]
+        if itens:
+            return itens[-min(PROXIES_CONFIAVEIS, len(itens))]
+    return request.client.host if request.client else ""
+
+
+def _rede(ip: str) -> str:
+    """A rede do IP (/24 ou /64), para o balde do e-mail."""
+    try:
+        end = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefixo = _REDE_V4 if end.version == 4 else _REDE_V6
+    return str(ipaddress.ip_network(f"{end}/{prefixo}", strict=False))
+
+
+def _chave_conta(email: str) -> str:
+    return f"email:{(email or '').strip().lower()}"
+
+
+def _chave_email(ip: str, email: str) -> str:
+    return f"{_chave_conta(email)}|{_rede(ip)}"
+
+
+def _encher(fichas: float, desde: float, agora: float, capacidade: float, por_seg: float):
+    """Fichas depois do reabastecimento e a espera (seg) se não há ficha."""
+    fichas = min(capacidade, fichas + max(0.0, agora - desde) * por_seg)
+    if fichas >= 1:
+        return fichas - 1, 0.0
+    return fichas, (1 - fichas) / por_seg if por_seg else 60.0
+
+
+class BaldesEmMemoria:
+    nome = "memoria"
+
+    def __init__(self, max_chaves: int):
+        self.max_chaves = max_chaves
+        self._baldes = OrderedDict()   # chave -> (fichas, quando)
+        self._trava = threading.Lock()
+
+    def consumir(self, chave: str, capacidade: float, por_seg: float) -> float:
+        agora = time.monotonic()
+        with self._trava:
+            fichas, desde = self._baldes.get(chave, (capacidade, agora))
+            fichas, espera = _encher(fichas, desde, agora, capacidade, por_seg)
+            self._baldes[chave] = (fichas, agora)
+            self._baldes.move_to_end(chave)
+            while len(self._baldes) > self.max_chaves:
+                self._baldes.popitem(last=False)
+        return espera
+
+    def zerar(self, chave: str):
+        with self._trava:
+            self._baldes.pop(chave, None)
+
+    def __len__(self):
+        return len(self._baldes)
+
+
+class BaldesNoBanco:
+    """Os mesmos baldes, na tabela limites_login: valem para todos os
+    workers. A linha fica travada (FOR UPDATE) só durante a conta."""
+    nome = "banco"
+
+    def __init__(self):
+        self._chamadas = 0
+
+    def consumir(self, chave: str, capacidade: float, por_seg: float) -> float:
+        self._chamadas += 1
+        if self._chamadas % _LIMPAR_A_CADA == 0:
+            self._limpar()
+        agora = time.time()
+        db = SessionLocal()
+        try:
+            for _ in range(2):
+                balde = db.query(LimiteLogin).filter(
+                    LimiteLogin.chave == chave
+                ).with_for_update().first()
+                if balde is None:
+                    fichas, espera = _encher(capacidade, agora, agora, capacidade, por_seg)
+                    db.add(LimiteLogin(chave=chave, fichas=fichas, atualizado_em=agora))
+                else:
+                    fichas, espera = _encher(
+                        balde.fichas, balde.atualizado_em, agora, capacidade, por_seg
+                    )
+                    balde.fichas, balde.atualizado_em = fichas, agora
+                try:
+                    db.commit()
+                    return espera
+                except IntegrityError:
+                    db.rollback()   # outro worker criou a linha agora: de novo
+            return 0.0
+        finally:
+            db.close()
+
+    def zerar(self, chave: str):
+        db = SessionLocal()
+        try:
+            db.query(LimiteLogin).filter(LimiteLogin.chave == chave).delete()
+            db.commit()
+        finally:
+            db.close()
+
+    def _limpar(self):
+        db = SessionLocal()
+        try:
+            db.query(LimiteLogin).filter(
+                LimiteLogin.atualizado_em < time.time() - _LIMPAR_APOS_SEG
+            ).delete(synchronize_session=False)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print("[login] erro ao limpar limites_login:", e)
+        finally:
+            db.close()
+
+
+class LimitadorDeLogin:
+    def __init__(self, baldes):
+        self.baldes = baldes
+        self._trava = threading.Lock()
+        self.tentativas = 0
+        self.recusadas_ip = 0
+        self.recusadas_email = 0
+        self.recusadas_conta = 0
+
+    def conferir(self, ip: str, email: str) -> float:
+        """Gasta uma ficha do IP, uma do e-mail naquela rede e uma da conta
+        (ver o cabeçalho). Devolve 0 se pode tentar, senão quantos
+        segundos esperar."""
+        if not LOGIN_LIMITE:
+            return 0.0
+        espera_ip = self.baldes.consumir(f"ip:{ip}", LOGIN_IP_MAX, LOGIN_IP_POR_MIN / 60)
+        espera_email = 0.0
+        if not espera_ip:
+            espera_email = self.baldes.consumir(
+                _chave_email(ip, email), LOGIN_EMAIL_MAX, LOGIN_EMAIL_POR_MIN / 60,
+            )
+        espera_conta = 0.0
+        if not espera_ip and not espera_email:
+            espera_conta = self.baldes.consumir(
+                _chave_conta(email), LOGIN_CONTA_MAX, LOGIN_CONTA_POR_MIN / 60,
+            )
+        with self._trava:
+            self.tentativas += 1
+            if espera_ip:
+                self.recusadas_ip += 1
+            elif espera_email:
+                self.recusadas_email += 1
+            elif espera_conta:
+                self.recusadas_conta += 1
+        return max(espera_ip, espera_email, espera_conta)
+
+    async def conferir_async(self, ip: str, email: str) -> float:
+        # Na memória é um lock e umas contas: nem vale a ida ao threadpool.
+        if isinstance(self.baldes, BaldesEmMemoria):
+            return self.conferir(ip, email)
+        return await run_in_threadpool(self.conferir, ip, email)
+
+    def sucesso(self, ip: str, email: str):
+        """Login certo: o balde do e-mail naquela rede volta cheio (o da
+        conta, não: senão um acerto no meio do ataque o reabriria)."""
+        if LOGIN_LIMITE:
+            self.baldes.zerar(_chave_email(ip, email))
+
+    def estatisticas(self) -> dict:
+        with self._trava:
+            return {
+                "ligado": LOGIN_LIMITE,
+                "baldes": self.baldes.nome,
+                "chaves": len(self.baldes) if isinstance(self.baldes, BaldesEmMemoria) else None,
+                "tentativas": self.tentativas,
+                "recusadas_ip": self.recusadas_ip,
+                "recusadas_email": self.recusadas_email,
+                "recusadas_conta": self.recusadas_conta,
+            }
+
+
+limitador_de_login = LimitadorDeLogin(
+    BaldesNoBanco() if LOGIN_LIMITE_COMPARTILHADO else BaldesEmMemoria(LOGIN_LIMITE_CHAVES)
+)
@@ -1,14 +1,16 @@
+import math
 import os
 import sqlite3
 import secrets
 from datetime import datetime, timedelta, date
 
-from fastapi import FastAPI, Depends, HTTPException, Request, Form
+from fastapi import BackgroundTasks, FastAPI, Depends, HTTPException, Request, Form
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from sqlalchemy import inspect, text
+from sqlalchemy import exists, inspect, text
 from sqlalchemy.orm import Session
 
 from starlette.middleware.sessions import SessionMiddleware
@@ -16,15 +18,29 @@ from starlette.middleware.sessions import SessionMiddleware
 from admin.admin_web import router as admin_web_router
 from admin.admin_routes import router as admin_router
 from sync_routes import router as sync_router
+from changeset_routes import router as changeset_router
 
 from database import SessionLocal, engine
-from models import Base, Usuario, AceiteTermos, Plano, Assinatura
-from auth import verify_password, create_access_token, hash_password
+from models import Base, Usuario, AceiteTermos, AcessoEfetivo, Plano, Assinatura
+from fastapi.security import HTTPAuthorizationCredentials
+from auth import (
+    ACCESS_TOKEN_MINUTOS, ALGORITHM, RefreshInvalido, create_access_token,
+    create_short_access_token, criar_refresh_token, encerrar_sessao, girar_refresh_token,
+    hash_password, hash_password_async, precisa_refazer, revogar_tokens_do_usuario, security,
+    verify_password_async,
+)
 from termos_config import TERMOS_URL, POLITICA_URL, TERMOS_VERSAO, POLITICA_VERSAO
 from planos_config import PLANOS_PADRAO
 from asaas import config as asaas_config
 from asaas.asaas_client import AsaasError
+import agendador_acesso
 import assinatura_service
+import camadas
+import chaves_jwt
+from limite_login import ip_do_cliente, limitador_de_login
+import notificacoes
+import revogacao
+import telemetria_login
 
 
 # Endereço público do servidor (usado no link de confirmação de e-mail).
@@ -148,6 +164,195 @@ def migrar_colunas_assinaturas():
             print("[migracao]", sql)
 
 
+# ===============================================================
+# MIGRAÇÃO: CÓPIAS DO BANCO NO BLOB STORE ('db_snapshots')
+# ---------------------------------------------------------------
+#  - blob_ref / sha256: o arquivo passa a ficar no blob store
+#    (snapshot_store.py); a linha guarda só a referência.
+#  - db_sha256: hash do banco descompactado (upload igual = nada muda).
+#  - codificacao / dicionario: gzip ou zstd+dict (compressao.py).
+#  - em_blocos: a cópia também está guardada em blocos deduplicados
+#    (chunk_store.py).
+#  - frio_ref: versão antiga movida para a camada fria (camadas.py).
+#  - zstd_ref / zstd_dicionario / zstd_tamanho: cópia zstd+dict
+#    guardada ao lado do arquivo gzip (compressao.py).
+#  - índice único (user_id, version): a trava de versão do upload.
+#  - conteudo deixa de ser obrigatório (só as cópias antigas o têm).
+#    No SQLite não dá para mudar o NOT NULL — lá a tabela nasce
+#    certa pelo create_all (uso local/teste).
+# ===============================================================
+def migrar_colunas_snapshots():
+    insp = inspect(engine)
+    try:
+        existentes = {c["name"]: c for c in insp.get_columns("db_snapshots")}
+    except Exception:
+        return
+
+    novas = []
+    if "blob_ref" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN blob_ref VARCHAR")
+    if "sha256" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN sha256 VARCHAR(64)")
+    if "em_blocos" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN em_blocos INTEGER DEFAULT 0")
+    if "db_sha256" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN db_sha256 VARCHAR(64)")
+    if "codificacao" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN codificacao VARCHAR(16) DEFAULT 'gzip'")
+    if "dicionario" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN dicionario INTEGER")
+    if "frio_ref" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN frio_ref VARCHAR")
+    if "zstd_ref" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN zstd_ref VARCHAR")
+    if "zstd_dicionario" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN zstd_dicionario INTEGER")
+    if "zstd_tamanho" not in existentes:
+        novas.append("ALTER TABLE db_snapshots ADD COLUMN zstd_tamanho INTEGER")
+    if not existentes["conteudo"]["nullable"] and engine.dialect.name == "postgresql":
+        novas.append("ALTER TABLE db_snapshots ALTER COLUMN conteudo DROP NOT NULL")
+    if novas:
+        with engine.begin() as conn:
+            for sql in novas:
+                conn.execute(text(sql))
+                print("[migracao]", sql)
+
+    # Versão única por usuário (trava de versão feita pelo próprio banco).
+    indices = {i["name"] for i in insp.get_indexes("db_snapshots")}
+    if "uq_db_snapshots_user_version" not in indices:
+        sql = ("CREATE UNIQUE INDEX uq_db_snapshots_user_version "
+               "ON db_snapshots (user_id, version)")
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(sql))
+            print("[migracao]", sql)
+        except Exception as e:
+            # Só acontece se a corrida antiga deixou versões repetidas.
+            print("[migracao] AVISO: não deu para criar o índice único de versões:", e)
+
+
+# ===============================================================
+# MIGRAÇÃO: "CABEÇA" DO SYNC ('sync_cabeca')
+# ---------------------------------------------------------------
+# Preenche a linha-resumo da versão atual para quem já tinha cópias
+# antes da tabela existir. Idempotente: só insere quem ainda não tem.
+# ===============================================================
+def migrar_cabecas_sync():
+    existentes = {c["name"] for c in inspect(engine).get_columns("sync_cabeca")}
+    if "db_sha256" not in existentes:
+        sql = "ALTER TABLE sync_cabeca ADD COLUMN db_sha256 VARCHAR(64)"
+        with engine.begin() as conn:
+            conn.execute(text(sql))
+        print("[migracao]", sql)
+
+    with engine.begin() as conn:
+        res = conn.execute(text("""
+            INSERT INTO sync_cabeca
+                (user_id, version, snapshot_id, tamanho_bytes, sha256, db_sha256, device_id, criado_em)
+            SELECT s.user_id, s.version, s.id, s.tamanho_bytes, s.sha256, s.db_sha256, s.device_id, s.criado_em
+            FROM db_snapshots s
+            WHERE s.version = (SELECT MAX(x.version) FROM db_snapshots x WHERE x.user_id = s.user_id)
+              AND s.user_id NOT IN (SELECT c.user_id FROM sync_cabeca c)
+        """))
+        if res.rowcount:
+            print(f"[migracao] sync_cabeca preenchida para {res.rowcount} usuário(s).")
+
+
+# ===============================================================
+# MIGRAÇÃO: 'erro' em 'sync_changesets' (changeset que não aplica)
+# ===============================================================
+def migrar_colunas_changesets():
+    existentes = {c["name"] for c in inspect(engine).get_columns("sync_changesets")}
+    if "erro" not in existentes:
+        sql = "ALTER TABLE sync_changesets ADD COLUMN erro VARCHAR"
+        with engine.begin() as conn:
+            conn.execute(text(sql))
+        print("[migracao]", sql)
+
+
+# ===============================================================
+# MIGRAÇÃO: UMA LINHA POR (CONTA, APARELHO) em 'device_atividade'
+# ---------------------------------------------------------------
+# Os acessos passam a ser somados com UPSERT, que precisa de um
+# índice único (user_id, device_id). Linhas repetidas que a versão
+# antiga possa ter criado são juntadas (soma dos acessos) antes.
+# ===============================================================
+def migrar_device_atividade():
+    insp = inspect(engine)
+    try:
+        indices = {i["name"] for i in insp.get_indexes("device_atividade")}
+    except Exception:
+        return
+    if "uq_device_atividade_user_device" in indices:
+        return
+    with engine.begin() as conn:
+        repetidos = conn.execute(text("""
+            SELECT user_id, device_id, MIN(id), SUM(acessos), MIN(primeiro_em), MAX(ultimo_em)
+            FROM device_atividade
+            GROUP BY user_id, device_id
+            HAVING COUNT(*) > 1
+        """)).all()
+        for user_id, device_id, fica, acessos, primeiro, ultimo in repetidos:
+            conn.execute(
+                text("UPDATE device_atividade SET acessos = :a, primeiro_em = :p, "
+                     "ultimo_em = :u WHERE id = :id"),
+                {"a": acessos, "p": primeiro, "u": ultimo, "id": fica},
+            )
+            conn.execute(
+                text("DELETE FROM device_atividade WHERE user_id = :uid "
+                     "AND device_id = :d AND id <> :id"),
+                {"uid": user_id, "d": device_id, "id": fica},
+            )
+        if repetidos:
+            print(f"[migracao] device_atividade: {len(repetidos)} aparelho(s) repetido(s) juntado(s).")
+        sql = ("CREATE UNIQUE INDEX uq_device_atividade_user_device "
+               "ON device_atividade (user_id, device_id)")
+        conn.execute(text(sql))
+        print("[migracao]", sql)
+
+
+# ===============================================================
+# MIGRAÇÃO: COTAS DO SYNC ('usuarios.cota_mb' e 'planos.cota_mb')
+# ---------------------------------------------------------------
+# Tamanho máximo do banco (descompactado) que cada conta guarda na
+# nuvem. Vazio = cota do plano ou a padrão (SYNC_COTA_MB).
+# ===============================================================
+def migrar_cotas():
+    insp = inspect(engine)
+    novas = []
+    for tabela in ("usuarios", "planos"):
+        if "cota_mb" not in [c["name"] for c in insp.get_columns(tabela)]:
+            novas.append(f"ALTER TABLE {tabela} ADD COLUMN cota_mb INTEGER")
+    if not novas:
+        return
+    with engine.begin() as conn:
+        for sql in novas:
+            conn.execute(text(sql))
+            print("[migracao]", sql)
+
+
+# Acesso efetivo (models.AcessoEfetivo): calcula a linha das contas que
+# ainda não têm — na 1ª subida, todas. Depois só as novas que escaparam.
+def migrar_acesso_efetivo():
+    db = SessionLocal()
+    try:
+        faltando = [
+            user_id for (user_id,) in db.query(Usuario.id)
+            .outerjoin(AcessoEfetivo, AcessoEfetivo.user_id == Usuario.id)
+            .filter(AcessoEfetivo.user_id.is_(None))
+            .all()
+        ]
+        for user_id in faltando:
+            assinatura_service.recalcular_acesso(db, user_id, "migracao")
+        if faltando:
+            print(f"[migracao] acesso_efetivo calculado para {len(faltando)} conta(s).")
+    except Exception as e:
+        db.rollback()
+        print("[migracao] erro ao calcular acesso_efetivo:", e)
+    finally:
+        db.close()
+
+
 # ===============================================================
 # PASSO 1.3 — CONTAS NO BANCO PRINCIPAL (Postgres)
 # ---------------------------------------------------------------
@@ -261,8 +466,28 @@ def seed_planos():
 # Ordem importa: cria tabela -> adiciona colunas/grandfather -> garante contas -> planos.
 migrar_colunas_email()
 migrar_colunas_assinaturas()
+migrar_colunas_snapshots()
+migrar_cabecas_sync()
+migrar_colunas_changesets()
+migrar_device_atividade()
+migrar_cotas()
 seed_inicial()
 seed_planos()
+migrar_acesso_efetivo()
+
+# Tokens revogados ainda no prazo -> filtro em memória (get_current_user).
+revogacao.carregar()
+
+# Avisos entre workers (só liga com NOTIFY_POSTGRES=1 no Postgres):
+# versões novas do sync, contas alteradas e tokens revogados (caches do
+# get_current_user).
+notificacoes.iniciar_ponte(["sync", "usuarios", "tokens", "revogacao"])
+
+# Histórico antigo -> camada fria; cópias legadas -> fora do Postgres.
+camadas.iniciar()
+
+# Liberações manuais com prazo vencido -> recalcula o acesso efetivo.
+agendador_acesso.iniciar()
 
 # Diagnóstico seguro (NUNCA imprime a chave, só o tamanho dela).
 print(f"[asaas] configurado={asaas_config.configurado()} | ambiente={asaas_config.ASAAS_ENVIRONMENT} "
@@ -274,6 +499,7 @@ print(f"[asaas] configurado={asaas_config.configurado()} | ambiente={asaas_confi
 app.include_router(admin_web_router)
 app.include_router(admin_router)
 app.include_router(sync_router)
+app.include_router(changeset_router)
 
 # ===============================
 # DEPENDÊNCIA DB
@@ -318,21 +544,14 @@ def _pagina_link_usado() -> str:
 # ===============================================================
 # HELPERS DO ACEITE
 # ===============================================================
-def _client_ip(request: Request) -> str:
-    # Atrás do proxy do Railway, o IP real vem no cabeçalho X-Forwarded-For.
-    xff = request.headers.get("x-forwarded-for")
-    if xff:
-        return xff.split(",")[0].strip()
-    return request.client.host if request.client else ""
-
-
-def _aceite_atual_valido(db: Session, user_id: int) -> bool:
-    """True se o usuário já aceitou a versão ATUAL dos dois documentos."""
-    return db.query(AceiteTermos).filter(
+def _aceitou_versao_atual(user_id):
+    """EXISTS: o usuário já aceitou a versão ATUAL dos dois documentos.
+    'user_id' pode ser um valor ou a coluna Usuario.id (dentro de uma query)."""
+    return exists().where(
         AceiteTermos.user_id == user_id,
         AceiteTermos.termos_versao == TERMOS_VERSAO,
         AceiteTermos.politica_versao == POLITICA_VERSAO,
-    ).first() is not None
+    )
 
 
 def _pagina_aceite(token: str, email: str, erro: str = None) -> str:
@@ -428,7 +647,7 @@ def confirmar_post(
         email=user.email,
         termos_versao=TERMOS_VERSAO,
         politica_versao=POLITICA_VERSAO,
-        ip=_client_ip(request),
+        ip=ip_do_cliente(request),
         user_agent=(request.headers.get("user-agent") or "")[:500],
     ))
     db.commit()
@@ -636,7 +855,7 @@ def cartao_post(
     }
 
     try:
-        a = assinatura_service.criar_assinatura_completa(db, user, cartao, titular, _client_ip(request))
+        a = assinatura_service.criar_assinatura_completa(db, user, cartao, titular, ip_do_cliente(request))
     except (AsaasError, ValueError) as e:
         return HTMLResponse(_pagina_cartao(token, erro=str(e), aviso=_aviso_trial_html(db, user)), status_code=400)
     except Exception:
@@ -727,14 +946,28 @@ def definir_senha_get(token: str, db: Session = Depends(get_db)):
     ))
 
 
+def _gravar_senha(db, user, senha_hash, uso_unico=False):
+    user.senha_hash = senha_hash
+    if uso_unico:
+        # Link de uso ÚNICO: depois de trocar a senha, o token morre.
+        user.token_confirmacao = None
+        user.token_expira = None
+    user.atualizado_em = datetime.utcnow()
+    db.commit()
+    # Senha nova: sessões abertas com a senha antiga (tokens já emitidos) caem.
+    revogar_tokens_do_usuario(db, user.id)
+
+
+# As rotas que GRAVAM a senha são async: o bcrypt roda no pool dedicado
+# (auth.pool_de_senhas) e as queries, rápidas, no threadpool normal.
 @app.post("/definir-senha", response_class=HTMLResponse)
-def definir_senha_post(
+async def definir_senha_post(
     token: str = Form(...),
     senha: str = Form(...),
     senha2: str = Form(...),
     db: Session = Depends(get_db),
 ):
-    user = _validar_token_onboarding(db, token)
+    user = await run_in_threadpool(_validar_token_onboarding, db, token)
     if not user:
         return HTMLResponse(_pagina_link_usado(), status_code=400)
 
@@ -749,9 +982,8 @@ def definir_senha_post(
             erro=erro,
         ), status_code=400)
 
-    user.senha_hash = hash_password(senha.strip())
-    user.atualizado_em = datetime.utcnow()
-    db.commit()
+    senha_hash = await hash_password_async(senha.strip())
+    await run_in_threadpool(_gravar_senha, db, user, senha_hash)
 
     # Segue para a escolha do plano (MANTÉM o token vivo).
     return RedirectResponse(url=f"/assinar?token={token}", status_code=303)
@@ -772,13 +1004,13 @@ def nova_senha_get(token: str, db: Session = Depends(get_db)):
 
 
 @app.post("/nova-senha", response_class=HTMLResponse)
-def nova_senha_post(
+async def nova_senha_post(
     token: str = Form(...),
     senha: str = Form(...),
     senha2: str = Form(...),
     db: Session = Depends(get_db),
 ):
-    user = _validar_token_onboarding(db, token)
+    user = await run_in_threadpool(_validar_token_onboarding, db, token)
     if not user:
         return HTMLResponse(_pagina_link_usado(), status_code=400)
 
@@ -792,12 +1024,8 @@ def nova_senha_post(
             erro=erro,
         ), status_code=400)
 
-    user.senha_hash = hash_password(senha.strip())
-    # Link de uso ÚNICO: depois de trocar a senha, o token morre.
-    user.token_confirmacao = None
-    user.token_expira = None
-    user.atualizado_em = datetime.utcnow()
-    db.commit()
+    senha_hash = await hash_password_async(senha.strip())
+    await run_in_threadpool(_gravar_senha, db, user, senha_hash, True)
 
     return HTMLResponse(_pagina_html(
         "Senha alterada! ✅",
@@ -833,24 +1061,98 @@ class LoginRequest(BaseModel):
     email: str
     senha: str
     app_versao: str = ""   # versão do app desktop (apps antigos não mandam; fica vazio)
+    refresh: bool = False  # app que renova: token curto + refresh token (antigos: 7 dias)
 
 # ===============================
 # LOGIN DESKTOP
 # ===============================
+# async: o bcrypt vai para o pool dedicado (auth.pool_de_senhas), para uma
+# leva de logins não ocupar as threads do /api/sync e do webhook. O resto
+# roda no threadpool normal. Idas ao banco no caminho da resposta: UMA
+# (_carregar_login); a telemetria vai em lote (telemetria_login.py).
 @app.post("/api/login")
-def login(data: LoginRequest, db: Session = Depends(get_db)):
-    user = db.query(Usuario).filter(Usuario.email == data.email).first()
+async def login(
+    data: LoginRequest,
+    request: Request,
+    tarefas: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
+    # Limite de tentativas (limite_login.py): recusa barata, antes do bcrypt.
+    ip = ip_do_cliente(request)
+    espera = await limitador_de_login.conferir_async(ip, data.email)
+    if espera:
+        raise HTTPException(
+            status_code=429,
+            detail="Muitas tentativas de login. Aguarde um pouco e tente de novo.",
+            headers={"Retry-After": str(math.ceil(espera))},
+        )
 
-    if not user or not verify_password(data.senha, user.senha_hash):
+    user, efetivo, aceitou = await run_in_threadpool(_carregar_login, db, data.email)
+
+    if not user or not await verify_password_async(data.senha, user.senha_hash):
         raise HTTPException(status_code=401, detail="Usuário ou senha inválidos")
 
-    # 🔹 TELEMETRIA: registra o último acesso e a versão do app já aqui (com a
-    # senha correta), ANTES das checagens de bloqueio — assim você vê no painel
-    # quem está tentando usar (útil até p/ quem está com pagamento vencido).
-    user.ultimo_acesso = datetime.utcnow()
-    if data.app_versao:
-        user.app_versao = data.app_versao.strip()[:20]
-    db.commit()
+    # Senha feita com algoritmo/custo antigo (ver auth.py): refaz agora que
+    # temos a senha em claro. Gravada depois da resposta.
+    if precisa_refazer(user.senha_hash):
+        novo_hash = await hash_password_async(data.senha)
+        tarefas.add_task(_refazer_senha, user.id, user.senha_hash, novo_hash)
+
+    # 🔹 TELEMETRIA: último acesso e versão do app, com a senha correta e
+    # ANTES das checagens de bloqueio — assim você vê no painel quem está
+    # tentando usar (útil até p/ quem está com pagamento vencido).
+    telemetria_login.registrar(user.id, datetime.utcnow(), data.app_versao)
+    try:
+        return await run_in_threadpool(_concluir_login, db, user, efetivo, aceitou, data, ip)
+    except HTTPException as e:
+        # Recusa (e-mail, termos, assinatura): devolvida como resposta, e não
+        # levantada, para a senha refeita acima ainda ser gravada.
+        return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+
+
+def _carregar_login(db: Session, email: str):
+    """(usuário, acesso efetivo ou None, aceitou os termos atuais?) numa
+    query só — no Postgres do Railway cada ida ao banco custa ms."""
+    linha = (
+        db.query(Usuario, AcessoEfetivo, _aceitou_versao_atual(Usuario.id).label("aceitou"))
+        .outerjoin(AcessoEfetivo, AcessoEfetivo.user_id == Usuario.id)
+        .filter(Usuario.email == email)
+        .first()
+    )
+    return linha or (None, None, False)
+
+
+def _refazer_senha(user_id: int, hash_antigo: str, novo_hash: str):
+    """Grava a senha refeita, depois da resposta — só se ninguém trocou a
+    senha nesse meio tempo."""
+    db = SessionLocal()
+    try:
+        db.query(Usuario).filter(
+            Usuario.id == user_id, Usuario.senha_hash == hash_antigo
+        ).update({"senha_hash": novo_hash}, synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print("[login] erro ao gravar a senha refeita:", e)
+    finally:
+        db.close()
+
+
+_MSG_ACESSO = {
+    "bloqueado_admin": "Conta bloqueada. Fale com o suporte.",
+    "bloqueado_manual": "Acesso bloqueado pelo administrador. Fale com o suporte.",
+    "overdue": "Sua assinatura está vencida. Regularize o pagamento para continuar.",
+    "suspended": "Sua assinatura está suspensa. Fale com o suporte.",
+    "cancelled": "Sua assinatura foi cancelada. Fale com o suporte para reativar.",
+    "pending_payment": "Pagamento pendente. Conclua sua assinatura para liberar o acesso.",
+    "sem_assinatura": "Conta inativa. Fale com o suporte.",
+}
+_MSG_ACESSO_PADRAO = "Acesso indisponível. Fale com o suporte."
+
+
+def _concluir_login(db: Session, user: Usuario, efetivo, aceitou: bool,
+                    data: LoginRequest, ip: str) -> dict:
+    limitador_de_login.sucesso(ip, data.email)
 
     if not user.email_verificado:
         raise HTTPException(
@@ -859,7 +1161,7 @@ def login(data: LoginRequest, db: Session = Depends(get_db)):
         )
 
     # (Re)ACEITE DOS TERMOS por versão — só atua se a exigência estiver LIGADA.
-    if EXIGIR_ACEITE_LOGIN and not user.is_admin and not _aceite_atual_valido(db, user.id):
+    if EXIGIR_ACEITE_LOGIN and not user.is_admin and not aceitou:
         novo_token = secrets.token_urlsafe(32)
         user.token_confirmacao = novo_token
         user.token_expira = datetime.utcnow() + timedelta(days=3)
@@ -871,28 +1173,99 @@ def login(data: LoginRequest, db: Session = Depends(get_db)):
                     f"atualizados. Abra este link no navegador para aceitar: {link}")
         )
 
-    # ACESSO por assinatura (+ override manual do admin).
-    liberado, motivo = assinatura_service.acesso_liberado(db, user)
+    # ACESSO por assinatura (+ override manual do admin): a decisão já
+    # gravada em acesso_efetivo (veio junto no _carregar_login).
+    liberado, motivo = assinatura_service.acesso_vigente(db, user, efetivo)
     if not liberado:
-        _MSG = {
-            "bloqueado_admin": "Conta bloqueada. Fale com o suporte.",
-            "bloqueado_manual": "Acesso bloqueado pelo administrador. Fale com o suporte.",
-            "overdue": "Sua assinatura está vencida. Regularize o pagamento para continuar.",
-            "suspended": "Sua assinatura está suspensa. Fale com o suporte.",
-            "cancelled": "Sua assinatura foi cancelada. Fale com o suporte para reativar.",
-            "pending_payment": "Pagamento pendente. Conclua sua assinatura para liberar o acesso.",
-            "sem_assinatura": "Conta inativa. Fale com o suporte.",
-        }
-        raise HTTPException(status_code=403, detail=_MSG.get(motivo, "Acesso indisponível. Fale com o suporte."))
+        raise HTTPException(status_code=403, detail=_MSG_ACESSO.get(motivo, _MSG_ACESSO_PADRAO))
 
-    token = create_access_token({
+    claims = {
         "sub": user.email,
         "user_id": user.id,
         "status": user.status
-    })
+    }
+    if not data.refresh:
+        return {
+            "success": True,
+            "token": create_access_token(claims),
+            "status": user.status
+        }
+
+    refresh_token = criar_refresh_token(db, user.id)
+    db.commit()
+    return {
+        "success": True,
+        "token": create_short_access_token(claims),
+        "refresh_token": refresh_token,
+        "expira_em_seg": ACCESS_TOKEN_MINUTOS * 60,
+        "status": user.status
+    }
+
+
+# ===============================
+# RENOVAR TOKEN (app com refresh)
+# ===============================
+# Troca o refresh token por um par novo (o antigo não vale mais). A conta
+# é conferida de novo a cada troca: bloqueio ou assinatura vencida cortam
+# o app em até ACCESS_TOKEN_MINUTOS, sem consulta por requisição.
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+@app.post("/api/token/refresh")
+def renovar_token(data: RefreshRequest, db: Session = Depends(get_db)):
+    try:
+        user_id, refresh_token = girar_refresh_token(db, data.refresh_token)
+    except RefreshInvalido:
+        raise HTTPException(status_code=401, detail="Sessão expirada. Entre de novo.")
+
+    user = db.get(Usuario, user_id)
+    if not user or user.status != "ativo":
+        raise HTTPException(status_code=403, detail="Usuário bloqueado")
+    liberado, motivo = assinatura_service.acesso_vigente(db, user)
+    if not liberado:
+        raise HTTPException(status_code=403, detail=_MSG_ACESSO.get(motivo, _MSG_ACESSO_PADRAO))
 
     return {
         "success": True,
-        "token": token,
+        "token": create_short_access_token({
+            "sub": user.email,
+            "user_id": user.id,
+            "status": user.status
+        }),
+        "refresh_token": refresh_token,
+        "expira_em_seg": ACCESS_TOKEN_MINUTOS * 60,
         "status": user.status
     }
+
+
+# ===============================
+# SAIR (app)
+# ===============================
+# O token de acesso apresentado deixa de valer na hora (não espera o
+# 'exp'); com o refresh_token, a sessão daquele aparelho também acaba.
+class LogoutRequest(BaseModel):
+    refresh_token: str = ""
+
+
+@app.post("/api/logout")
+def logout(
+    data: LogoutRequest = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db),
+):
+    encerrar_sessao(db, credentials.credentials, data.refresh_token if data else None)
+    return {"success": True}
+
+
+# ===============================
+# CHAVES PÚBLICAS DOS TOKENS (JWKS)
+# ===============================
+# Com JWT_ALGORITMO=RS256, outros serviços e o app conferem os tokens
+# sozinhos com estas chaves (verificar_jwt.py). Com HS256, a lista vem vazia.
+@app.get("/.well-known/jwks.json")
+def jwks():
+    return JSONResponse(
+        chaves_jwt.jwks() if ALGORITHM == "RS256" else {"keys": []},
+        headers={"Cache-Control": "public, max-age=300"},
+    )
@@ -1,5 +1,6 @@
 # models.py
-from sqlalchemy import Column, Integer, String, DateTime, Date, LargeBinary, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, LargeBinary, ForeignKey, Float, Index
+from sqlalchemy.orm import deferred
 from datetime import datetime
 from database import Base
 
@@ -29,6 +30,10 @@ class Usuario(Base):
     app_versao = Column(String, nullable=True)       # versão do app desktop no último login
     ultimo_acesso = Column(DateTime, nullable=True)  # data/hora do último login
 
+    # 🔹 COTA DO SYNC: tamanho máximo do banco (descompactado) na nuvem, em MB.
+    # Vazio = a cota do plano (planos.cota_mb) ou a padrão (SYNC_COTA_MB).
+    cota_mb = Column(Integer, nullable=True)
+
 
 # ===============================================================
 # FASE 2 — CÓPIAS DO BANCO NA NUVEM (snapshots)
@@ -37,6 +42,12 @@ class Usuario(Base):
 # (compactada em gzip), guardada por usuário e por número de
 # versão. Mantemos um histórico das últimas cópias para poder
 # "voltar" a uma versão anterior se necessário.
+#
+# O arquivo em si fica no blob store (snapshot_store.py); aqui só
+# ficam os metadados e a referência (blob_ref). 'conteudo' só é
+# preenchido nas cópias ANTIGAS, gravadas antes do blob store (até a
+# migração de camadas tirá-las de lá). Versões antigas do histórico
+# podem estar na camada fria (frio_ref, camadas.py).
 # ===============================================================
 class DbSnapshot(Base):
     __tablename__ = "db_snapshots"
@@ -44,9 +55,121 @@ class DbSnapshot(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("usuarios.id"), index=True, nullable=False)
     version = Column(Integer, nullable=False)        # 1, 2, 3, ... por usuário
-    conteudo = Column(LargeBinary, nullable=False)   # o banco compactado (gzip)
+    conteudo = deferred(Column(LargeBinary, nullable=True))  # legado: o banco (gzip) dentro do banco; só carrega se pedir
+    blob_ref = Column(String, nullable=True)         # onde o arquivo está no blob store
+    sha256 = Column(String(64), nullable=True)       # hash do arquivo compactado (como foi recebido)
+    db_sha256 = Column(String(64), nullable=True)    # hash do banco DESCOMPACTADO (detecta upload igual)
     tamanho_bytes = Column(Integer)                  # tamanho da cópia
     device_id = Column(String, nullable=True)        # qual aparelho enviou
+    em_blocos = Column(Integer, default=0)           # 1 = conteúdo também guardado em blocos (chunk_store)
+    codificacao = Column(String(16), default="gzip") # como o arquivo está compactado: gzip | zstd+dict
+    dicionario = Column(Integer, nullable=True)      # versão do dicionário zstd (se zstd+dict)
+    frio_ref = Column(String, nullable=True)         # arquivo na camada fria (versões antigas)
+    zstd_ref = Column(String, nullable=True)         # cópia zstd+dict AO LADO do arquivo gzip (compressao.py)
+    zstd_dicionario = Column(Integer, nullable=True) # dicionário da cópia zstd_ref
+    zstd_tamanho = Column(Integer, nullable=True)    # tamanho da cópia zstd_ref
+    criado_em = Column(DateTime, default=datetime.utcnow)
+
+    # Cada versão existe uma vez só por usuário: dois uploads simultâneos
+    # da mesma versão -> o banco recusa o segundo (vira 409).
+    __table_args__ = (
+        Index("uq_db_snapshots_user_version", "user_id", "version", unique=True),
+    )
+
+
+# ===============================================================
+# FASE 2 — "CABEÇA" DO SYNC (1 linha por usuário)
+# ---------------------------------------------------------------
+# Resumo da versão ATUAL de cada usuário na nuvem. O /status é
+# consultado o tempo todo por todos os apps: lê só esta linha
+# (busca pela chave), sem tocar em db_snapshots nem em blob.
+# É atualizada junto com cada upload, na mesma transação.
+# ===============================================================
+class SyncCabeca(Base):
+    __tablename__ = "sync_cabeca"
+
+    user_id = Column(Integer, ForeignKey("usuarios.id"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    snapshot_id = Column(Integer, nullable=True)     # linha de db_snapshots da versão atual
+    tamanho_bytes = Column(Integer)
+    sha256 = Column(String(64), nullable=True)
+    db_sha256 = Column(String(64), nullable=True)    # hash do banco descompactado da versão atual
+    device_id = Column(String, nullable=True)
+    criado_em = Column(DateTime, nullable=True)      # quando a versão atual subiu
+
+
+# ===============================================================
+# FASE 2 — BLOCOS DEDUPLICADOS DAS CÓPIAS (chunk_store.py)
+# ---------------------------------------------------------------
+# Versões seguidas do banco de um cliente são ~95% iguais. Cada
+# cópia é cortada em blocos pelo CONTEÚDO e cada bloco é guardado
+# UMA vez só, pelo seu SHA-256 (no blob store, chave cas/...).
+#   BlocoConteudo  = um bloco único + quantas cópias o usam (refs)
+#   SnapshotBloco  = a lista ordenada de blocos de cada cópia
+# Bloco com refs = 0 não é usado por ninguém e é apagado (GC).
+# ===============================================================
+class BlocoConteudo(Base):
+    __tablename__ = "blocos_conteudo"
+
+    hash = Column(String(64), primary_key=True)      # SHA-256 do bloco (descompactado)
+    tamanho = Column(Integer)                        # bytes do bloco descompactado
+    tamanho_gz = Column(Integer)                     # bytes guardados (compactado)
+    refs = Column(Integer, default=0)                # quantas vezes é usado por cópias
+    criado_em = Column(DateTime, default=datetime.utcnow)
+
+
+class SnapshotBloco(Base):
+    __tablename__ = "snapshot_blocos"
+
+    snapshot_id = Column(Integer, ForeignKey("db_snapshots.id"), primary_key=True)
+    ordem = Column(Integer, primary_key=True)        # posição do bloco na cópia
+    hash = Column(String(64), ForeignKey("blocos_conteudo.hash"), index=True, nullable=False)
+
+
+# ===============================================================
+# FASE 2 — CHANGESETS (sync por linha, changeset_routes.py)
+# ---------------------------------------------------------------
+# Cada linha = um conjunto de alterações de linhas do banco do app
+# (insert/update/delete) que gerou UMA versão. As versões seguem a
+# mesma numeração das cópias inteiras (sync_cabeca). De tempos em
+# tempos a compactação aplica os changesets na última cópia e grava
+# uma cópia inteira nova em db_snapshots.
+# ===============================================================
+class SyncChangeset(Base):
+    __tablename__ = "sync_changesets"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("usuarios.id"), index=True, nullable=False)
+    version = Column(Integer, nullable=False)        # versão que este changeset gerou
+    base_version = Column(Integer, nullable=False)   # versão em que o app se baseou
+    conteudo = deferred(Column(LargeBinary, nullable=False))  # alterações (JSON em gzip)
+    chaves = deferred(Column(Text, nullable=True))   # linhas tocadas (JSON) p/ checar conflito
+    alteracoes = Column(Integer)                     # quantas alterações
+    tamanho_bytes = Column(Integer)
+    device_id = Column(String, nullable=True)
+    criado_em = Column(DateTime, default=datetime.utcnow)
+    erro = Column(String, nullable=True)             # não aplicou na compactação (não tenta de novo)
+
+    __table_args__ = (
+        Index("uq_sync_changesets_user_version", "user_id", "version", unique=True),
+    )
+
+
+# ===============================================================
+# FASE 2 — DICIONÁRIOS ZSTD DAS CÓPIAS (compressao.py)
+# ---------------------------------------------------------------
+# O esquema do banco AGRIVIA é o mesmo para todos os clientes: um
+# dicionário treinado em bancos de exemplo faz o zstd compactar
+# bem mais. Cada dicionário tem uma VERSÃO e nunca muda depois de
+# criado (o app guarda os que já baixou); o mais novo é o atual.
+# ===============================================================
+class DicionarioZstd(Base):
+    __tablename__ = "dicionarios_zstd"
+
+    versao = Column(Integer, primary_key=True)
+    dados = deferred(Column(LargeBinary, nullable=False))  # o dicionário em si (~100 KB)
+    tamanho = Column(Integer)
+    amostras = Column(Integer)                       # quantas amostras entraram no treino
     criado_em = Column(DateTime, default=datetime.utcnow)
 
 
@@ -68,6 +191,11 @@ class DeviceAtividade(Base):
     ultimo_em = Column(DateTime, default=datetime.utcnow)
     acessos = Column(Integer, default=1)
 
+    # Uma linha por (conta, aparelho): permite o UPSERT acessos = acessos + n.
+    __table_args__ = (
+        Index("uq_device_atividade_user_device", "user_id", "device_id", unique=True),
+    )
+
 
 # ===============================================================
 # JURÍDICO — TRILHA DE AUDITORIA DE ACEITE DOS TERMOS
@@ -107,6 +235,7 @@ class Plano(Base):
     ciclo = Column(String)                             # MONTHLY / SEMIANNUALLY / YEARLY
     valor = Column(Float)
     ativo = Column(Integer, default=1)
+    cota_mb = Column(Integer, nullable=True)           # cota do sync (banco descompactado, MB); vazio = padrão
     atualizado_em = Column(DateTime, default=datetime.utcnow)
 
 
@@ -147,6 +276,42 @@ class Assinatura(Base):
     cancelado_em = Column(DateTime, nullable=True)
 
 
+# ===============================================================
+# ACESSO EFETIVO (decisão materializada) + HISTÓRICO
+# ---------------------------------------------------------------
+# A decisão "pode usar o app?" (assinatura_service.decidir_acesso:
+# status do usuário + assinatura mais recente + override do admin)
+# fica gravada, uma linha por conta. É recalculada a cada mudança
+# (webhook, ações do admin, prazo do override vencendo) — o login só
+# lê esta linha. 'valido_ate' = até quando a decisão vale sozinha (o
+# fim de uma liberação manual com prazo); depois disso, recalcula.
+#
+# Toda MUDANÇA de decisão entra no histórico (auditoria): quando,
+# de onde veio (origem) e o motivo. O histórico fica mesmo depois
+# de a conta ser excluída.
+# ===============================================================
+class AcessoEfetivo(Base):
+    __tablename__ = "acesso_efetivo"
+
+    user_id = Column(Integer, ForeignKey("usuarios.id"), primary_key=True)
+    liberado = Column(Integer, nullable=False)      # 1 = pode usar
+    motivo = Column(String, nullable=False)         # ativo, overdue, bloqueado_manual, ...
+    valido_ate = Column(DateTime, nullable=True, index=True)
+    atualizado_em = Column(DateTime, default=datetime.utcnow)
+
+
+class AcessoHistorico(Base):
+    __tablename__ = "acesso_historico"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, index=True, nullable=False)
+    liberado = Column(Integer, nullable=False)
+    motivo = Column(String, nullable=False)
+    valido_ate = Column(DateTime, nullable=True)
+    origem = Column(String, nullable=True)          # webhook, admin, prazo, sincronizar, ...
+    criado_em = Column(DateTime, default=datetime.utcnow)
+
+
 # ===============================================================
 # ASSINATURAS (Asaas) — EVENTOS / WEBHOOK (idempotência + histórico)
 # ---------------------------------------------------------------
@@ -163,3 +328,48 @@ class AsaasEvento(Base):
     payload = Column(String, nullable=True)                     # JSON sanitizado (sem cartão)
     processado = Column(Integer, default=0)
     recebido_em = Column(DateTime, default=datetime.utcnow)
+
+
+# ===============================================================
+# TOKENS DE RENOVAÇÃO (refresh) E REVOGAÇÃO
+# ---------------------------------------------------------------
+# O app novo recebe um token de acesso CURTO (minutos) e um refresh
+# token que troca por um par novo em /api/token/refresh. Cada troca
+# GIRA o refresh: o usado fica marcado e o novo entra na mesma
+# 'familia'. Reusar um refresh já trocado (vazou?) revoga a família
+# inteira. Guardamos só o SHA-256 do refresh, nunca o token.
+# ===============================================================
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("usuarios.id"), index=True, nullable=False)
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+    familia = Column(String(32), index=True, nullable=False)
+    criado_em = Column(DateTime, default=datetime.utcnow)
+    expira_em = Column(DateTime, nullable=False)
+    usado_em = Column(DateTime, nullable=True)       # trocado por um novo (girou)
+    revogado_em = Column(DateTime, nullable=True)    # bloqueio, senha nova, reuso
+
+
+# Lista de revogação dos tokens de ACESSO (revogacao.py). 'chave' é:
+#   "jti:<id do token>"  -> aquele token
+#   "u:<user_id>"        -> todos os tokens da conta emitidos até 'revogado_em'
+# A linha pode sair depois de 'expira_em' (o token já venceu sozinho).
+class TokenRevogado(Base):
+    __tablename__ = "tokens_revogados"
+
+    chave = Column(String(64), primary_key=True)
+    user_id = Column(Integer, index=True, nullable=True)
+    revogado_em = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expira_em = Column(DateTime, nullable=False)
+
+
+# Baldes do limite de tentativas de login, quando compartilhados entre
+# workers (limite_login.py, LOGIN_LIMITE_COMPARTILHADO=1).
+class LimiteLogin(Base):
+    __tablename__ = "limites_login"
+
+    chave = Column(String, primary_key=True)       # "ip:1.2.3.4" | "email:fulano@x|1.2.3.0/24" | "email:fulano@x"
+    fichas = Column(Float, nullable=False)
+    atualizado_em = Column(Float, nullable=False)  # epoch (segundos)
@@ -0,0 +1,183 @@
+# ===============================================================
+# AVISOS ENTRE PARTES DO SERVIDOR (broker em memória + Postgres)
+# ---------------------------------------------------------------
+# Um "canal" (ex.: "sync") e uma "chave" (ex.: o user_id) identificam
+# o assunto. Quem publica não precisa saber quem está ouvindo:
+#
+#   publicar("sync", 42, {...})   -> acorda quem espera o usuário 42
+#   async with assinar("sync", 42) as fila: await fila.get()
+#   ouvir("usuarios", funcao)     -> funcao(chave, dados) a cada aviso
+#                                    (a chave chega sempre como texto)
+#
+# Com vários workers (processos), cada um tem o seu broker. A ponte
+# opcional com o Postgres (LISTEN/NOTIFY) leva o aviso de um worker
+# para os outros. Liga com NOTIFY_POSTGRES=1 (só vale no Postgres).
+# ===============================================================
+import asyncio
+import json
+import os
+import select
+import threading
+import uuid
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+
+from database import DATABASE_URL, engine
+
+NOTIFY_POSTGRES = os.getenv("NOTIFY_POSTGRES", "0") == "1"
+
+# Identifica ESTE processo: avisos que voltam da ponte com a nossa
+# própria origem são ignorados (já foram entregues localmente).
+_ORIGEM = uuid.uuid4().hex
+_PREFIXO_PG = "agrivia_"
+
+_trava = threading.Lock()
+_filas = {}       # (canal, chave) -> set de (loop, asyncio.Queue)
+_ouvintes = {}    # canal -> lista de funções (chave, dados)
+_ponte = None
+
+
+def _entregar(canal, chave, dados):
+    chave = str(chave)
+    with _trava:
+        filas = list(_filas.get((canal, chave), ()))
+        ouvintes = list(_ouvintes.get(canal, ()))
+    for loop, fila in filas:
+        # Quem publica pode estar numa thread (rota síncrona): entrega
+        # dentro do loop de quem está esperando.
+        try:
+            loop.call_soon_threadsafe(fila.put_nowait, dados)
+        except RuntimeError:
+            pass  # o loop de quem esperava já foi fechado
+    for funcao in ouvintes:
+        try:
+            funcao(chave, dados)
+        except Exception as e:
+            print(f"[avisos] erro no ouvinte de '{canal}':", e)
+
+
+def publicar(canal: str, chave, dados=None):
+    """Avisa todos que esperam (canal, chave) — neste processo e, com a
+    ponte ligada, nos outros workers também."""
+    _entregar(canal, chave, dados)
+    if _ponte is not None:
+        _ponte.enviar(canal, chave, dados)
+
+
+def ponte_ligada() -> bool:
+    """Os avisos chegam aos outros workers (ponte Postgres ligada)?"""
+    return _ponte is not None
+
+
+def ouvir(canal: str, funcao):
+    """Registra funcao(chave, dados), chamada a cada aviso do canal."""
+    with _trava:
+        _ouvintes.setdefault(canal, []).append(funcao)
+
+
+@asynccontextmanager
+async def assinar(canal: str, chave):
+    """Fila (asyncio.Queue) que recebe os avisos de (canal, chave)
+    enquanto o bloco 'async with' estiver aberto."""
+    item = (asyncio.get_running_loop(), asyncio.Queue())
+    k = (canal, str(chave))
+    with _trava:
+        _filas.setdefault(k, set()).add(item)
+    try:
+        yield item[1]
+    finally:
+        with _trava:
+            filas = _filas.get(k)
+            if filas is not None:
+                filas.discard(item)
+                if not filas:
+                    del _filas[k]
+
+
+def assinantes(canal: str = None) -> int:
+    """Quantas esperas abertas existem (para diagnóstico)."""
+    with _trava:
+        return sum(len(v) for (c, _), v in _filas.items() if canal in (None, c))
+
+
+# ---------------------------------------------------------------
+# PONTE COM O POSTGRES (LISTEN/NOTIFY)
+# ---------------------------------------------------------------
+class _PontePostgres:
+    def __init__(self):
+        self._canais = set()
+        self._trava = threading.Lock()
+        self._conn = None
+
+    def _conectar(self):
+        # Conexão PRÓPRIA (fora do pool): fica presa no LISTEN o tempo todo.
+        import psycopg2
+        conn = psycopg2.connect(DATABASE_URL)
+        conn.autocommit = True
+        return conn
+
+    def escutar(self, canal):
+        with self._trava:
+            self._canais.add(canal)
+            if self._conn is not None:
+                self._conn.cursor().execute(f"LISTEN {_PREFIXO_PG}{canal}")
+
+    def enviar(self, canal, chave, dados):
+        carga = json.dumps({"o": _ORIGEM, "k": str(chave), "d": dados}, default=str)
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text("SELECT pg_notify(:canal, :carga)"),
+                    {"canal": _PREFIXO_PG + canal, "carga": carga},
+                )
+        except Exception as e:
+            print("[avisos] falha ao enviar NOTIFY:", e)
+
+    def rodar(self):
+        while True:
+            try:
+                with self._trava:
+                    self._conn = self._conectar()
+                    cur = self._conn.cursor()
+                    for canal in self._canais:
+                        cur.execute(f"LISTEN {_PREFIXO_PG}{canal}")
+                while True:
+                    if select.select([self._conn], [], [], 30) == ([], [], []):
+                        continue
+                    self._conn.poll()
+                    while self._conn.notifies:
+                        n = self._conn.notifies.pop(0)
+                        self._receber(n.channel, n.payload)
+            except Exception as e:
+                print("[avisos] ponte Postgres caiu, reconectando:", e)
+                with self._trava:
+                    try:
+                        self._conn.close()
+                    except Exception:
+                        pass
+                    self._conn = None
+                threading.Event().wait(5)
+
+    def _receber(self, canal_pg, carga):
+        try:
+            msg = json.loads(carga)
+        except ValueError:
+            return
+        if msg.get("o") == _ORIGEM:
+            return
+        _entregar(canal_pg[len(_PREFIXO_PG):], msg.get("k"), msg.get("d"))
+
+
+def iniciar_ponte(canais):
+    """Liga a ponte LISTEN/NOTIFY (se NOTIFY_POSTGRES=1 e o banco for
+    Postgres) para os canais indicados. Chamado uma vez na subida."""
+    global _ponte
+    if not NOTIFY_POSTGRES or not DATABASE_URL.startswith("postgresql"):
+        return
+    if _ponte is None:
+        _ponte = _PontePostgres()
+        threading.Thread(target=_ponte.rodar, name="avisos-postgres", daemon=True).start()
+        print("[avisos] ponte Postgres LISTEN/NOTIFY ligada.")
+    for canal in canais:
+        _ponte.escutar(canal)
@@ -0,0 +1,227 @@
+# ===============================================================
+# REVOGAÇÃO DE TOKENS DE ACESSO (lista + filtro de Bloom)
+# ---------------------------------------------------------------
+# Um JWT vale até o 'exp' dele, sem perguntar ao banco. Para cortar
+# um token antes disso (conta bloqueada, senha nova, refresh vazado),
+# a chave dele entra na tabela tokens_revogados:
+#
+#   "jti:<id>"      -> só aquele token
+#   "u:<user_id>"   -> todos os tokens da conta emitidos ANTES de
+#                      'revogado_em' (inclui os tokens de 7 dias dos
+#                      apps antigos, que não renovam)
+#
+# get_current_user pergunta esta_revogado(payload) a cada requisição.
+# Na memória fica um filtro de Bloom com as chaves revogadas: o "não"
+# (quase sempre) sai em O(1), sem banco. Um "talvez" confere na tabela
+# uma vez e o resultado fica guardado (_confirmados).
+#
+# Cada revogação vai pelo canal "revogacao" de notificacoes.py: os
+# outros workers (com a ponte ligada) põem a chave no filtro deles na
+# hora. Sem a ponte (NOTIFY_POSTGRES=0, SQLite), cada worker relê da
+# tabela as revogações novas a cada REVOGACAO_SINC_SEG segundos — um
+# token revogado em outro worker cai em no máximo esse tempo. Com a
+# ponte, a releitura continua a cada minuto (aviso perdido numa
+# reconexão). A chave relida ou avisada substitui o que estava guardado
+# em _confirmados, inclusive um "não revogado" antigo.
+#
+# Na subida, carregar() monta o filtro a partir da tabela e apaga o que
+# venceu.
+# ===============================================================
+import calendar
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import SessionLocal
+from escrita_em_lote import upsert
+from models import RefreshToken, TokenRevogado
+import notificacoes
+
+TOKENS_REVOGADOS_BITS = int(os.getenv("TOKENS_REVOGADOS_BITS", str(1 << 20)))
+_FUNCOES = 7
+_CONFIRMADOS_MAX = 10000
+REVOGACAO_SINC_SEG = float(os.getenv("REVOGACAO_SINC_SEG", "5"))
+_SINC_COM_PONTE_SEG = 60
+# Releitura com folga: relógios dos workers e commits que demoram.
+_FOLGA = timedelta(seconds=5)
+
+
+class FiltroBloom:
+    """Conjunto aproximado: 'in' pode dar falso positivo, nunca falso
+    negativo. 1 Mi bits (128 KB) e 7 funções: ~1% de falso positivo
+    com 100 mil chaves."""
+
+    def __init__(self, bits: int, funcoes: int = _FUNCOES):
+        self.bits = bits
+        self.funcoes = funcoes
+        self._mapa = bytearray((bits + 7) // 8)
+        self.chaves = 0
+
+    def _posicoes(self, chave: str):
+        d = hashlib.blake2b(chave.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(d[:8], "little")
+        h2 = int.from_bytes(d[8:], "little") | 1
+        for i in range(self.funcoes):
+            yield (h1 + i * h2) % self.bits
+
+    def adicionar(self, chave: str):
+        if chave in self:
+            return
+        for p in self._posicoes(chave):
+            self._mapa[p >> 3] |= 1 << (p & 7)
+        self.chaves += 1
+
+    def __contains__(self, chave: str) -> bool:
+        return all(self._mapa[p >> 3] & (1 << (p & 7)) for p in self._posicoes(chave))
+
+
+_trava = threading.Lock()
+_filtro = FiltroBloom(TOKENS_REVOGADOS_BITS)
+_confirmados = {}     # chave -> revogado_em (timestamp) ou None (falso positivo)
+_consultas = 0
+_sinc_em = 0.0        # time.monotonic() da última releitura
+_visto_ate = None     # maior revogado_em já lido da tabela
+_sincronizacoes = 0
+
+
+def _timestamp(dt: datetime) -> float:
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def carregar():
+    """Monta o filtro com as revogações que ainda valem (e apaga as
+    vencidas). Chamado uma vez na subida."""
+    global _filtro, _sinc_em, _visto_ate
+    db = SessionLocal()
+    try:
+        agora = datetime.utcnow()
+        db.query(TokenRevogado).filter(TokenRevogado.expira_em < agora).delete(
+            synchronize_session=False
+        )
+        db.commit()
+        filtro = FiltroBloom(TOKENS_REVOGADOS_BITS)
+        visto_ate = None
+        for chave, quando in db.query(TokenRevogado.chave, TokenRevogado.revogado_em).all():
+            filtro.adicionar(chave)
+            visto_ate = max(visto_ate or quando, quando)
+    finally:
+        db.close()
+    with _trava:
+        _filtro = filtro
+        _confirmados.clear()
+        _sinc_em = time.monotonic()
+        _visto_ate = visto_ate
+    print(f"[revogacao] {filtro.chaves} chave(s) revogada(s) no filtro.")
+
+
+def _receber(chave, dados):
+    with _trava:
+        _filtro.adicionar(chave)
+        _confirmados[chave] = (dados or {}).get("revogado_em")
+
+
+notificacoes.ouvir("revogacao", _receber)
+
+
+def _sincronizar():
+    """Relê as revogações gravadas (por qualquer worker) desde a última vez."""
+    global _sinc_em, _visto_ate, _sincronizacoes
+    intervalo = _SINC_COM_PONTE_SEG if notificacoes.ponte_ligada() else REVOGACAO_SINC_SEG
+    agora = time.monotonic()
+    with _trava:
+        if agora - _sinc_em < intervalo:
+            return
+        _sinc_em = agora
+        desde = _visto_ate
+    db = SessionLocal()
+    try:
+        consulta = db.query(TokenRevogado.chave, TokenRevogado.revogado_em)
+        if desde is not None:
+            consulta = consulta.filter(TokenRevogado.revogado_em >= desde - _FOLGA)
+        linhas = consulta.all()
+    except Exception as e:
+        print("[revogacao] erro ao reler as revogações:", e)
+        return
+    finally:
+        db.close()
+    with _trava:
+        _sincronizacoes += 1
+        for chave, quando in linhas:
+            _filtro.adicionar(chave)
+            _confirmados[chave] = _timestamp(quando)
+            if _visto_ate is None or quando > _visto_ate:
+                _visto_ate = quando
+
+
+def _revogado_em(chave: str):
+    """Timestamp da revogação da chave, ou None se não está revogada."""
+    global _consultas
+    if chave not in _filtro:
+        return None
+    with _trava:
+        if chave in _confirmados:
+            return _confirmados[chave]
+    db = SessionLocal()
+    try:
+        linha = db.get(TokenRevogado, chave)
+        quando = _timestamp(linha.revogado_em) if linha else None
+    finally:
+        db.close()
+    with _trava:
+        _consultas += 1
+        if len(_confirmados) >= _CONFIRMADOS_MAX:
+            _confirmados.clear()
+        _confirmados[chave] = quando
+    return quando
+
+
+def esta_revogado(payload: dict) -> bool:
+    _sincronizar()
+    jti = payload.get("jti")
+    if jti and _revogado_em(f"jti:{jti}") is not None:
+        return True
+    quando = _revogado_em(f"u:{payload.get('user_id')}")
+    # Tokens sem 'iat' são de antes desta revogação existir.
+    return quando is not None and float(payload.get("iat") or 0) < quando
+
+
+def _gravar(db, chave: str, user_id, expira_em: datetime):
+    agora = datetime.utcnow()
+    db.execute(
+        upsert(TokenRevogado.__table__, ["chave"], lambda novo: {
+            "revogado_em": novo.revogado_em, "expira_em": novo.expira_em,
+        }).values(chave=chave, user_id=user_id, revogado_em=agora, expira_em=expira_em)
+    )
+    db.commit()
+    notificacoes.publicar("revogacao", chave, {"revogado_em": _timestamp(agora)})
+
+
+def revogar_token(db, payload: dict):
+    """Revoga UM token de acesso (pelo 'jti'), até ele vencer."""
+    if not payload.get("jti"):
+        return
+    expira_em = datetime.utcfromtimestamp(payload.get("exp") or 0)
+    _gravar(db, f"jti:{payload['jti']}", payload.get("user_id"), expira_em)
+
+
+def revogar_usuario(db, user_id: int, validade: timedelta):
+    """Revoga todos os tokens da conta emitidos até agora e os refresh
+    tokens dela. 'validade' = a vida do token mais longo emitido."""
+    db.query(RefreshToken).filter(
+        RefreshToken.user_id == user_id, RefreshToken.revogado_em.is_(None)
+    ).update({"revogado_em": datetime.utcnow()}, synchronize_session=False)
+    _gravar(db, f"u:{user_id}", user_id, datetime.utcnow() + validade)
+
+
+def estatisticas() -> dict:
+    with _trava:
+        return {
+            "chaves_no_filtro": _filtro.chaves,
+            "bits": _filtro.bits,
+            "confirmados": len(_confirmados),
+            "consultas_ao_banco": _consultas,
+            "sincronizacoes": _sincronizacoes,
+            "ponte": notificacoes.ponte_ligada(),
+        }
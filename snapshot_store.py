@@ -0,0 +1,369 @@
+# ===============================================================
+# FASE 2 — ONDE FICAM AS CÓPIAS DO BANCO (blob store)
+# ---------------------------------------------------------------
+# O conteúdo das cópias (gzip) NÃO fica mais dentro do Postgres:
+# vai para um "blob store" plugável e a tabela db_snapshots guarda
+# só os metadados + a referência (blob_ref) do arquivo.
+#
+# O upload é gravado EM BLOCOS: cada pedaço recebido é somado no
+# hash (SHA-256) e no tamanho e já escrito no destino. Assim a
+# memória usada por upload é constante (1 bloco), não importa se
+# o banco do cliente tem 5 MB ou 500 MB.
+#
+# Backends:
+#   local  -> pasta no disco (SNAPSHOT_DIR). No Railway, aponte
+#             para um VOLUME persistente (senão some no deploy).
+#   (objeto/S3 entra depois implementando a mesma interface.)
+#
+# CAMADA FRIA (opcional, camadas.py): as versões antigas do histórico
+# saem do armazenamento "quente" para um segundo store mais barato
+# (SNAPSHOT_FRIO_STORE / SNAPSHOT_FRIO_DIR). Mesma interface.
+# ===============================================================
+import hashlib
+import os
+import tempfile
+import uuid
+import zlib
+
+# Tamanho de cada bloco lido/escrito (1 MB).
+BLOCO_BYTES = 1024 * 1024
+
+# Limite de tamanho de UMA cópia compactada (padrão 1 GB).
+SNAPSHOT_MAX_BYTES = int(os.getenv("SNAPSHOT_MAX_MB", "1024")) * 1024 * 1024
+
+SNAPSHOT_STORE = os.getenv("SNAPSHOT_STORE", "local").strip().lower()
+SNAPSHOT_DIR = os.getenv(
+    "SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "snapshots"),
+)
+
+# Armazenamento frio das versões antigas ("" = desligado).
+SNAPSHOT_FRIO_STORE = os.getenv("SNAPSHOT_FRIO_STORE", "").strip().lower()
+SNAPSHOT_FRIO_DIR = os.getenv(
+    "SNAPSHOT_FRIO_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "frio"),
+)
+
+
+# Extensão do arquivo por codificação (compressao.py); sem entrada = ".gz".
+_EXTENSOES = {"zstd+dict": ".zst"}
+
+
+class BlobGrandeDemais(Exception):
+    """A gravação passou do limite de tamanho (SNAPSHOT_MAX_BYTES)."""
+
+
+def ler_em_blocos(arquivo, tamanho=BLOCO_BYTES):
+    """Gera o conteúdo de um arquivo aberto em pedaços de 'tamanho' bytes."""
+    while True:
+        bloco = arquivo.read(tamanho)
+        if not bloco:
+            return
+        yield bloco
+
+
+class DescompactadorGzip:
+    """Descompacta gzip aos pedaços (aceita vários membros seguidos).
+    alimentar() gera o conteúdo descompactado; completo diz se o último
+    membro terminou (senão o arquivo veio truncado)."""
+
+    def __init__(self):
+        self._d = None    # membro gzip em andamento
+
+    def alimentar(self, bloco: bytes):
+        try:
+            while bloco:
+                if self._d is None:
+                    self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                yield self._d.decompress(bloco, BLOCO_BYTES)
+                bloco = self._d.unconsumed_tail
+                if self._d.eof:
+                    # Fim de um membro gzip; pode haver outro em seguida.
+                    bloco = self._d.unused_data + bloco
+                    self._d = None
+        except zlib.error as e:
+            raise ValueError(f"gzip inválido: {e}")
+
+    @property
+    def completo(self) -> bool:
+        return self._d is None
+
+
+class BancoInvalido(ValueError):
+    """O conteúdo enviado não é um banco SQLite inteiro (vira 422)."""
+
+
+class CotaExcedida(Exception):
+    """O banco DESCOMPACTADO passou da cota da conta (vira 413)."""
+
+    def __init__(self, limite: int):
+        super().__init__(f"banco maior que a cota ({limite} bytes)")
+        self.limite = limite
+
+
+_MAGICA_SQLITE = b"SQLite format 3\x00"
+_CABECALHO_SQLITE = 100
+
+
+def _conferir_cabecalho(c: bytes) -> int:
+    """Confere os 100 bytes do cabeçalho do SQLite. Devolve o tamanho de página."""
+    if c[:16] != _MAGICA_SQLITE:
+        raise BancoInvalido("não é um banco SQLite")
+    pagina = int.from_bytes(c[16:18], "big")
+    if pagina == 1:
+        pagina = 65536
+    if pagina < 512 or pagina & (pagina - 1):
+        raise BancoInvalido(f"tamanho de página inválido ({pagina})")
+    if c[18] not in (1, 2) or c[19] not in (1, 2) or c[21:24] != b"\x40\x20\x20":
+        raise BancoInvalido("cabeçalho do SQLite corrompido")
+    return pagina
+
+
+class ConferenciaSqlite:
+    """Confere, enquanto o banco DESCOMPACTADO passa, que ele é um SQLite
+    inteiro: cabeçalho, tamanho de página, tamanho total múltiplo da
+    página e não menor que o declarado no cabeçalho — e que não passa
+    da cota ('limite', em bytes). Guarda só o cabeçalho, nunca o banco.
+    Mesma interface do hashlib (update / hexdigest), então serve onde
+    já se calcula o SHA-256 do banco; os erros saem na hora
+    (BancoInvalido / CotaExcedida), para o upload parar cedo."""
+
+    def __init__(self, limite=None):
+        self.limite = limite
+        self.tamanho = 0
+        self.pagina = None
+        self._cabecalho = b""
+        self._sha = hashlib.sha256()
+
+    def update(self, pedaco: bytes):
+        self.tamanho += len(pedaco)
+        if self.limite is not None and self.tamanho > self.limite:
+            raise CotaExcedida(self.limite)
+        if self.pagina is None:
+            self._cabecalho += pedaco[:_CABECALHO_SQLITE - len(self._cabecalho)]
+            n = min(len(self._cabecalho), 16)
+            if self._cabecalho[:n] != _MAGICA_SQLITE[:n]:
+                raise BancoInvalido("não é um banco SQLite")
+            if len(self._cabecalho) == _CABECALHO_SQLITE:
+                self.pagina = _conferir_cabecalho(self._cabecalho)
+        self._sha.update(pedaco)
+
+    def hexdigest(self) -> str:
+        """Confere o fim do banco e devolve o SHA-256 dele."""
+        if self.pagina is None:
+            raise BancoInvalido("arquivo menor que o cabeçalho do SQLite")
+        if self.tamanho % self.pagina:
+            raise BancoInvalido("tamanho não é múltiplo da página (truncado?)")
+        c = self._cabecalho
+        paginas = int.from_bytes(c[28:32], "big")
+        # O nº de páginas do cabeçalho só vale se "version-valid-for" bate
+        # com o contador de mudanças (regra do próprio SQLite).
+        if paginas and c[24:28] == c[92:96] and paginas * self.pagina > self.tamanho:
+            raise BancoInvalido("banco truncado (menor que o cabeçalho declara)")
+        return self._sha.hexdigest()
+
+
+class HashDoBanco:
+    """SHA-256 do banco DESCOMPACTADO, calculado enquanto o arquivo passa
+    (atualizar com os pedaços compactados, na ordem). É a "identidade"
+    do conteúdo: dois gzip do mesmo banco podem ter bytes diferentes
+    (data, nível de compressão), mas o banco dentro é o mesmo.
+    Outros formatos (zstd) entram pelo 'descompactador' (compressao.py).
+    Se o arquivo vier corrompido ou truncado, hexdigest() devolve None.
+
+    Com 'conferencia' (ConferenciaSqlite), o conteúdo também é conferido
+    e nada é tolerado: gzip/zstd corrompido, truncado ou banco inválido
+    levantam BancoInvalido (e a cota, CotaExcedida) no bloco em que
+    aparecem."""
+
+    def __init__(self, descompactador=None, conferencia=None):
+        self._sha = conferencia or hashlib.sha256()
+        self._d = descompactador or DescompactadorGzip()
+        self._conferir = conferencia is not None
+        self._ok = True
+
+    def atualizar(self, bloco: bytes):
+        if not self._ok:
+            return
+        try:
+            for pedaco in self._d.alimentar(bloco):
+                self._sha.update(pedaco)
+        except BancoInvalido:
+            raise
+        except ValueError as e:
+            if self._conferir:
+                raise BancoInvalido(str(e))
+            self._ok = False
+
+    def hexdigest(self):
+        if not self._ok or not self._d.completo:
+            if self._conferir:
+                raise BancoInvalido("arquivo compactado truncado")
+            return None
+        return self._sha.hexdigest()
+
+
+class EscritaBlob:
+    """Uma gravação em andamento. Vai recebendo blocos (escrever), calcula
+    tamanho e SHA-256 no caminho e só "publica" o blob no concluir().
+    Se algo der errado, descartar() apaga o que já foi escrito."""
+
+    def __init__(self, limite=None):
+        self.tamanho = 0
+        self.limite = limite
+        self._sha = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    def escrever(self, bloco: bytes):
+        self.tamanho += len(bloco)
+        if self.limite is not None and self.tamanho > self.limite:
+            raise BlobGrandeDemais()
+        self._sha.update(bloco)
+        self._gravar(bloco)
+
+    def _gravar(self, bloco: bytes):
+        raise NotImplementedError
+
+    def concluir(self) -> str:
+        """Finaliza e devolve a referência (blob_ref) do blob gravado."""
+        raise NotImplementedError
+
+    def descartar(self):
+        raise NotImplementedError
+
+
+class BlobStore:
+    """Interface dos backends de armazenamento das cópias."""
+
+    def nova_escrita(self, user_id: int, limite=None, codificacao: str = "gzip") -> EscritaBlob:
+        """Começa a gravar um blob novo. 'codificacao' (compressao.py) só
+        escolhe o nome (.gz / .zst), para quem olha o armazenamento."""
+        raise NotImplementedError
+
+    def gravar(self, chave: str, dados: bytes) -> str:
+        """Grava um objeto PEQUENO inteiro sob uma chave fixa (usado pelos
+        blocos deduplicados do chunk_store). Devolve a referência."""
+        raise NotImplementedError
+
+    def abrir(self, ref: str):
+        """Abre o blob para leitura (arquivo binário, lido em blocos)."""
+        raise NotImplementedError
+
+    def apagar(self, ref: str):
+        raise NotImplementedError
+
+    def caminho_local(self, ref: str):
+        """Caminho do arquivo no disco, se o backend tiver um (permite servir
+        o download direto do arquivo, via sendfile). None se não tiver."""
+        return None
+
+
+# ---------------------------------------------------------------
+# BACKEND LOCAL (pasta no disco)
+# ---------------------------------------------------------------
+class _EscritaLocal(EscritaBlob):
+    def __init__(self, raiz, chave, limite=None):
+        super().__init__(limite)
+        self._destino = os.path.join(raiz, chave)
+        self._chave = chave
+        os.makedirs(os.path.dirname(self._destino), exist_ok=True)
+        # Grava num temporário NA MESMA PASTA e só renomeia no fim:
+        # um upload interrompido nunca deixa um blob "pela metade".
+        fd, self._tmp = tempfile.mkstemp(
+            dir=os.path.dirname(self._destino), suffix=".parcial"
+        )
+        self._f = os.fdopen(fd, "wb")
+
+    def _gravar(self, bloco):
+        self._f.write(bloco)
+
+    def concluir(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self._tmp, self._destino)
+        return self._chave
+
+    def descartar(self):
+        try:
+            self._f.close()
+        finally:
+            if os.path.exists(self._tmp):
+                os.remove(self._tmp)
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, raiz):
+        self.raiz = raiz
+        os.makedirs(raiz, exist_ok=True)
+
+    def _caminho(self, ref):
+        caminho = os.path.normpath(os.path.join(self.raiz, ref))
+        if not caminho.startswith(os.path.normpath(self.raiz) + os.sep):
+            raise ValueError("blob_ref inválido")
+        return caminho
+
+    def nova_escrita(self, user_id, limite=None, codificacao="gzip"):
+        extensao = _EXTENSOES.get(codificacao, ".gz")
+        return _EscritaLocal(self.raiz, f"{user_id}/{uuid.uuid4().hex}{extensao}", limite)
+
+    def gravar(self, chave, dados):
+        destino = self._caminho(chave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destino), suffix=".parcial")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(dados)
+            os.replace(tmp, destino)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return chave
+
+    def abrir(self, ref):
+        return open(self._caminho(ref), "rb")
+
+    def apagar(self, ref):
+        try:
+            os.remove(self._caminho(ref))
+        except FileNotFoundError:
+            pass
+
+    def caminho_local(self, ref):
+        return self._caminho(ref)
+
+
+_store = None
+_store_frio = None
+
+
+def get_store() -> BlobStore:
+    """Backend configurado em SNAPSHOT_STORE (um só por processo)."""
+    global _store
+    if _store is None:
+        if SNAPSHOT_STORE == "local":
+            _store = LocalBlobStore(SNAPSHOT_DIR)
+        else:
+            raise RuntimeError(f"SNAPSHOT_STORE desconhecido: {SNAPSHOT_STORE}")
+    return _store
+
+
+def frio_ligado() -> bool:
+    return bool(SNAPSHOT_FRIO_STORE)
+
+
+def get_store_frio() -> BlobStore:
+    """Backend da camada fria (SNAPSHOT_FRIO_STORE). Quem lê uma cópia que
+    já está lá (frio_ref) usa este store mesmo que a migração tenha sido
+    desligada depois — por isso sem configuração cai na pasta padrão."""
+    global _store_frio
+    if _store_frio is None:
+        if SNAPSHOT_FRIO_STORE in ("", "local"):
+            _store_frio = LocalBlobStore(SNAPSHOT_FRIO_DIR)
+        else:
+            raise RuntimeError(f"SNAPSHOT_FRIO_STORE desconhecido: {SNAPSHOT_FRIO_STORE}")
+    return _store_frio
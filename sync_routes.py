@@ -11,175 +11,995 @@
 # for igual à versão atual dele. Se for diferente, devolve 409
 # (conflito) — sinal de que a nuvem tem dado mais novo e o cliente
 # precisa baixar antes de subir. Assim um PC antigo nunca
-# sobrescreve dados mais recentes.
+# sobrescreve dados mais recentes. Quem garante é o próprio banco
+# (compare-and-set na cabeça + versão única), então dois aparelhos
+# subindo ao mesmo tempo não passam os dois.
+#
+# O arquivo da cópia é lido/gravado EM BLOCOS no blob store
+# (snapshot_store.py) — nunca inteiro na memória do servidor. O
+# download sai direto do arquivo (sendfile, sem passar pelo Python).
+#
+# DOWNLOAD CONDICIONAL / RETOMÁVEL: cada cópia tem um ETag forte
+# (versão + hash). Com If-None-Match igual, o servidor responde 304
+# (o cliente já tem essa versão). Com Range, devolve só o pedaço
+# pedido (206) — uma conexão 3G que caiu continua de onde parou.
+#
+# UPLOAD CONFERIDO: o arquivo é descompactado aos pedaços e conferido
+# (cabeçalho do SQLite, tamanho de página, arquivo inteiro) e o banco
+# descompactado é medido contra a COTA da conta (usuarios.cota_mb >
+# planos.cota_mb > SYNC_COTA_MB). Arquivo inválido -> 422; passou da
+# cota -> 413 — no bloco em que aparece, antes de ir para o blob store.
+# LIMITE: o Starlette recebe o corpo multipart INTEIRO (num arquivo
+# temporário) antes de a rota rodar. A conferência evita GRAVAR a cópia,
+# não RECEBER o arquivo. O que dá para barrar antes é o tamanho
+# declarado: Content-Length acima de SNAPSHOT_MAX_MB -> 413 sem ler o
+# corpo (_RotaComLimite). Envio "chunked" (sem Content-Length) chega
+# inteiro e só então é recusado.
+#
+# UPLOAD IGUAL: cada versão guarda o hash do banco DESCOMPACTADO
+# (db_sha256, também no /status e no download). O app manda o hash
+# no cabeçalho X-DB-Sha256; se for igual ao da versão atual, a
+# resposta é "unchanged" — sem versão nova, sem blob, sem poda.
+#
+# COMPACTAÇÃO: gzip (padrão) ou zstd com dicionário treinado, combinada
+# por cabeçalhos X-DB-Encoding / X-DB-Accept-Encoding (compressao.py).
+# A cópia zstd recompactada fica AO LADO do arquivo gzip (zstd_ref):
+# cada app baixa a que entende, sem conversão no caminho.
+#
+# HISTÓRICO: a cópia mais recente fica como arquivo inteiro; as
+# anteriores ficam só em blocos deduplicados (chunk_store.py) e, com
+# o tempo, vão para a camada fria (camadas.py). O admin restaura
+# qualquer uma delas (restaurar_versao), esteja onde estiver.
+#
+# AVISO DE VERSÃO NOVA: GET /api/sync/watch?since=N responde assim
+# que outra máquina sobe uma versão > N (long-poll ou SSE), em vez de
+# cada app ficar consultando o /status (notificacoes.py).
+#
+# MODO CHANGESET (changeset_routes.py): só as linhas alteradas, com
+# mescla de edições que não se cruzam. O download e o delta entregam a
+# cópia sempre na versão da cabeça (copia_em_dia compacta antes).
+#
+# MODO DELTA (delta_sync.py), ao lado do upload/download completos:
+#   GET  /api/sync/delta/manifest -> hashes dos blocos da versão atual
+#   POST /api/sync/delta/download -> só os blocos que o cliente não tem
+#   POST /api/sync/delta/upload   -> só os blocos que mudaram; o servidor
+#                                    remonta a versão nova (mesma trava)
 # ===============================================================
+import asyncio
+import io
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from typing import List
 
-from fastapi import APIRouter, Depends, Form, UploadFile, File, HTTPException
-from fastapi.responses import Response
-from sqlalchemy import func
+from fastapi import APIRouter, BackgroundTasks, Depends, Form, Header, UploadFile, File, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from sqlalchemy import func, insert, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from database import get_db
-from models import DbSnapshot, DeviceAtividade, Usuario
-from auth import get_current_user
+from database import SessionLocal, get_db
+from models import DbSnapshot, DeviceAtividade, DicionarioZstd, SyncCabeca, SyncChangeset
+import auth
+from auth import UsuarioLogado, get_current_user
+import changeset_routes
+import chunk_store
+import compressao
+import delta_sync
+import escrita_em_lote
+import notificacoes
+import snapshot_store
+
+# Folga para os campos e separadores do multipart em volta do arquivo.
+_FOLGA_MULTIPART = 64 * 1024
+
+
+class _RotaComLimite(APIRoute):
+    """Recusa (413) o pedido cujo Content-Length já passa do tamanho máximo
+    de uma cópia ANTES de o corpo ser lido (o FastAPI lê o formulário
+    inteiro antes de chamar a rota)."""
+
+    def get_route_handler(self):
+        rota = super().get_route_handler()
 
-router = APIRouter(prefix="/api/sync", tags=["Sync"])
+        async def com_limite(request: Request):
+            tamanho = request.headers.get("content-length", "")
+            if tamanho.isdigit() and \
+                    int(tamanho) > snapshot_store.SNAPSHOT_MAX_BYTES + _FOLGA_MULTIPART:
+                raise HTTPException(status_code=413, detail="arquivo_grande_demais")
+            return await rota(request)
 
-# Quantas cópias antigas manter por usuário (para poder "voltar atrás").
-MAX_HISTORICO = 5
+        return com_limite
 
 
-def _versao_atual(db: Session, user_id: int) -> int:
-    """Maior número de versão que esse usuário já tem na nuvem (0 se nenhuma)."""
-    v = (
-        db.query(func.max(DbSnapshot.version))
+router = APIRouter(prefix="/api/sync", tags=["Sync"], route_class=_RotaComLimite)
+
+# Quantas cópias manter por usuário (para poder "voltar atrás"). Com o
+# histórico deduplicado em blocos, guardar mais versões custa pouco.
+MAX_HISTORICO = int(os.getenv("SYNC_MAX_HISTORICO", "5"))
+
+# Cota padrão do banco DESCOMPACTADO por conta, em MB (0 = sem cota).
+SYNC_COTA_MB = int(os.getenv("SYNC_COTA_MB", "4096"))
+
+
+def apagar_copias_do_usuario(db: Session, user_id: int) -> list:
+    """Apaga as linhas de TODAS as cópias do usuário (usado ao excluir a
+    conta) e solta os blocos delas. Não faz commit: devolve os arquivos
+    (blob_ref, zstd_ref, frio_ref) para o chamador apagar (apagar_blobs)
+    DEPOIS do commit."""
+    copias = (
+        db.query(DbSnapshot.id, DbSnapshot.blob_ref, DbSnapshot.zstd_ref, DbSnapshot.frio_ref)
         .filter(DbSnapshot.user_id == user_id)
-        .scalar()
+        .all()
     )
-    return int(v or 0)
+    chunk_store.liberar_blocos(db, [c.id for c in copias])
+    db.query(SyncCabeca).filter(SyncCabeca.user_id == user_id).delete()
+    db.query(SyncChangeset).filter(SyncChangeset.user_id == user_id).delete()
+    db.query(DbSnapshot).filter(DbSnapshot.user_id == user_id).delete()
+    return [(c.blob_ref, c.zstd_ref, c.frio_ref) for c in copias]
+
+
+def apagar_blobs(arquivos):
+    """Apaga os arquivos [(blob_ref, zstd_ref, frio_ref), ...] das cópias
+    que saíram."""
+    for blob_ref, zstd_ref, frio_ref in arquivos:
+        for ref in (blob_ref, zstd_ref):
+            if ref:
+                snapshot_store.get_store().apagar(ref)
+        if frio_ref:
+            snapshot_store.get_store_frio().apagar(frio_ref)
+
+
+class _AtividadeDispositivos(escrita_em_lote.BufferDeEscrita):
+    """Anota que um aparelho (device_id) usou uma conta. Usado para
+    DETECTAR contas em vários aparelhos (possível compartilhamento).
+    Os acessos são somados em memória e gravados em lote com UPSERT
+    (acessos = acessos + n): nada de commit por upload, e a contagem
+    fica certa mesmo com vários uploads/workers ao mesmo tempo."""
+    nome = "dispositivos"
+
+    def juntar(self, atual, novo):
+        # (acessos, primeiro_em, ultimo_em)
+        return (atual[0] + novo[0], min(atual[1], novo[1]), max(atual[2], novo[2]))
+
+    def gravar(self, db, itens):
+        tabela = DeviceAtividade.__table__
+        db.execute(
+            escrita_em_lote.upsert(
+                tabela,
+                [tabela.c.user_id, tabela.c.device_id],
+                lambda novo: {
+                    "acessos": tabela.c.acessos + novo.acessos,
+                    "ultimo_em": novo.ultimo_em,
+                },
+            ),
+            [
+                {"user_id": u, "device_id": d, "acessos": n,
+                 "primeiro_em": primeiro, "ultimo_em": ultimo}
+                for (u, d), (n, primeiro, ultimo) in itens.items()
+            ],
+        )
 
 
-def _registrar_dispositivo(db: Session, user_id: int, device_id: str):
-    """Anota que este aparelho (device_id) usou esta conta. Usado para
-    DETECTAR contas em vários aparelhos (possível compartilhamento)."""
+atividade_dispositivos = _AtividadeDispositivos(
+    intervalo=float(os.getenv("DISPOSITIVOS_GRAVAR_SEG", "5")),
+    max_itens=int(os.getenv("DISPOSITIVOS_GRAVAR_MAX", "500")),
+)
+
+
+def _registrar_dispositivo(user_id: int, device_id: str):
     if not device_id:
         return
     agora = datetime.utcnow()
-    reg = (
-        db.query(DeviceAtividade)
-        .filter(
-            DeviceAtividade.user_id == user_id,
-            DeviceAtividade.device_id == device_id,
+    atividade_dispositivos.adicionar((user_id, device_id), (1, agora, agora))
+
+
+def _conflito(db: Session, user_id: int, base_version: int) -> HTTPException:
+    """409 de TRAVA DE VERSÃO: a nuvem não está mais na versão em que o
+    cliente se baseou (outra máquina subiu antes)."""
+    cabeca = db.get(SyncCabeca, user_id)
+    return HTTPException(
+        status_code=409,
+        detail={
+            "erro": "conflito_versao",
+            "servidor": cabeca.version if cabeca else 0,
+            "cliente_base": base_version,
+            "mensagem": "A nuvem tem uma versão diferente. Baixe antes de subir.",
+        },
+    )
+
+
+def _sem_mudanca(cabeca, user_id: int, base_version: int, db_sha256: str,
+                 device_id: str):
+    """Se o banco enviado é IGUAL ao da versão atual (mesmo db_sha256 e o
+    cliente está nela), devolve a resposta "unchanged"; senão None.
+    'cabeca' é a linha de sync_cabeca que a rota já leu (uma vez)."""
+    if not db_sha256:
+        return None
+    if not cabeca or cabeca.version != base_version or cabeca.db_sha256 != db_sha256:
+        return None
+    _registrar_dispositivo(user_id, device_id)
+    return {"success": True, "version": cabeca.version, "unchanged": True}
+
+
+def _recompactar_depois(tarefas: BackgroundTasks, snap: DbSnapshot, aceitas: str):
+    """Se o app entende zstd+dict e a cópia não está no dicionário atual,
+    grava em segundo plano a cópia zstd (ao lado do gzip, que continua
+    servindo os apps antigos): o próximo download de quem aceita sai menor."""
+    atual = compressao.versao_atual()
+    if atual is None or not compressao.aceita_zstd(aceitas):
+        return
+    if (snap.codificacao, snap.dicionario) != (compressao.ZSTD_DICT, atual) \
+            and snap.zstd_dicionario != atual:
+        tarefas.add_task(compressao.recomprimir_versao, snap.id)
+
+
+def _cota(user: UsuarioLogado):
+    """Cota do banco descompactado da conta, em bytes (None = sem cota): a
+    da própria conta, senão a do plano da assinatura, senão SYNC_COTA_MB.
+    Vem do estado em cache do get_current_user: nenhuma query no upload."""
+    mb = user.cota_mb
+    if mb is None:
+        mb = user.cota_plano_mb
+    if mb is None:
+        mb = SYNC_COTA_MB
+    return mb * 1024 * 1024 if mb else None
+
+
+def _erro_conferencia(e: Exception) -> HTTPException:
+    """Resposta para um banco recusado pela ConferenciaSqlite."""
+    if isinstance(e, snapshot_store.CotaExcedida):
+        return HTTPException(
+            status_code=413,
+            detail={"erro": "cota_excedida", "cota_mb": e.limite // (1024 * 1024)},
         )
-        .first()
+    return HTTPException(status_code=422, detail=f"banco_invalido: {e}")
+
+
+def _nova_escrita(user_id: int, codificacao: str = compressao.GZIP):
+    """Escrita no blob store limitada ao tamanho máximo de uma cópia."""
+    return snapshot_store.get_store().nova_escrita(
+        user_id, limite=snapshot_store.SNAPSHOT_MAX_BYTES, codificacao=codificacao
     )
-    if reg:
-        reg.ultimo_em = agora
-        reg.acessos = (reg.acessos or 0) + 1
-    else:
-        db.add(DeviceAtividade(
-            user_id=user_id,
+
+
+def _salvar_nova_versao(db: Session, user_id: int, base_version: int, escrita,
+                        blob_ref: str, db_sha256: str, device_id: str,
+                        tarefas: BackgroundTasks,
+                        codificacao: tuple = (compressao.GZIP, None)) -> DbSnapshot:
+    """Registra a cópia recém-gravada no blob store como a versão
+    base_version + 1, poda o histórico e anota o aparelho.
+
+    A TRAVA DE VERSÃO é do próprio banco, numa transação só: a linha nova
+    em db_snapshots (índice único user_id+version) e a cabeça trocada com
+    compare-and-set (UPDATE ... WHERE version = base). Se outro upload
+    chegou antes, nada é gravado, o blob é apagado e sai 409.
+    Depois da resposta, a cópia é guardada em blocos (chunk_store)."""
+    nova_versao = base_version + 1
+    snap = DbSnapshot(
+        user_id=user_id,
+        version=nova_versao,
+        blob_ref=blob_ref,
+        sha256=escrita.sha256,
+        db_sha256=db_sha256,
+        tamanho_bytes=escrita.tamanho,
+        device_id=device_id,
+        codificacao=codificacao[0],
+        dicionario=codificacao[1],
+        criado_em=datetime.utcnow(),
+    )
+    try:
+        db.add(snap)
+        db.flush()
+        cabeca = dict(
+            version=nova_versao,
+            snapshot_id=snap.id,
+            tamanho_bytes=snap.tamanho_bytes,
+            sha256=snap.sha256,
+            db_sha256=db_sha256,
             device_id=device_id,
-            primeiro_em=agora,
-            ultimo_em=agora,
-            acessos=1,
-        ))
+            criado_em=snap.criado_em,
+        )
+        if base_version == 0:
+            # Primeira versão: a cabeça ainda não existe (chave repetida = conflito).
+            db.execute(insert(SyncCabeca).values(user_id=user_id, **cabeca))
+            trocou = True
+        else:
+            res = db.execute(
+                update(SyncCabeca)
+                .where(SyncCabeca.user_id == user_id, SyncCabeca.version == base_version)
+                .values(**cabeca)
+                .execution_options(synchronize_session=False)
+            )
+            trocou = res.rowcount == 1
+        if trocou:
+            db.commit()
+    except IntegrityError:
+        trocou = False
+    except Exception:
+        db.rollback()
+        snapshot_store.get_store().apagar(blob_ref)
+        raise
+    if not trocou:
+        db.rollback()
+        snapshot_store.get_store().apagar(blob_ref)
+        raise _conflito(db, user_id, base_version)
+    cabeca = SyncCabeca(user_id=user_id, **cabeca)
+
+    # Acorda quem está esperando versão nova deste usuário (/watch).
+    notificacoes.publicar("sync", user_id, _status(cabeca))
+
+    _podar_historico(db, user_id)
+
+    # Anti-compartilhamento: anota o aparelho que enviou.
+    _registrar_dispositivo(user_id, device_id)
+
+    tarefas.add_task(chunk_store.arquivar_versao, snap.id)
+    return snap
+
+
+def _podar_historico(db: Session, user_id: int):
+    """Mantém só as últimas MAX_HISTORICO cópias do usuário. Lê apenas
+    id e arquivos das que saem e apaga tudo com um DELETE só (sem carregar
+    nenhuma cópia na memória). Conta CÓPIAS, não números de versão: com
+    changesets (changeset_routes.py) as versões não são todas cópias."""
+    saem = (
+        db.query(DbSnapshot.id, DbSnapshot.blob_ref, DbSnapshot.zstd_ref, DbSnapshot.frio_ref)
+        .filter(DbSnapshot.user_id == user_id)
+        .order_by(DbSnapshot.version.desc())
+        .offset(MAX_HISTORICO)
+        .all()
+    )
+    if not saem:
+        return
+    ids = [s.id for s in saem]
+    chunk_store.liberar_blocos(db, ids)
+    db.query(DbSnapshot).filter(DbSnapshot.id.in_(ids)).delete(synchronize_session=False)
     db.commit()
+    apagar_blobs([(s.blob_ref, s.zstd_ref, s.frio_ref) for s in saem])
+    chunk_store.coletar_lixo(db)
 
 
-# ---------------------------------------------------------------
-# STATUS — qual a versão atual na nuvem
-# ---------------------------------------------------------------
-@router.get("/status")
-def status_sync(
-    db: Session = Depends(get_db),
-    user: Usuario = Depends(get_current_user),
-):
-    snap = (
+def _cabeca_e_copia(db: Session, user_id: int) -> tuple:
+    """(cabeça, cópia inteira atual) numa query só; (None, None) se não há
+    cópia. O conteúdo legado é 'deferred' no modelo, então nunca vem junto.
+    Com changesets (changeset_routes.py) a cabeça pode estar À FRENTE da
+    cópia: quem entrega ou usa a cópia passa por copia_em_dia()."""
+    linha = (
+        db.query(SyncCabeca, DbSnapshot)
+        .join(DbSnapshot, SyncCabeca.snapshot_id == DbSnapshot.id)
+        .filter(SyncCabeca.user_id == user_id)
+        .first()
+    )
+    return tuple(linha) if linha else (None, None)
+
+
+def _codificacao(snap: DbSnapshot) -> tuple:
+    """(codificacao, versao_dict) do arquivo que _abrir_copia() devolve.
+    Só o arquivo inteiro (quente ou frio) pode estar em zstd; blocos e
+    legado são gzip."""
+    if snap.blob_ref or (snap.frio_ref and not snap.em_blocos):
+        return (snap.codificacao or compressao.GZIP, snap.dicionario)
+    return (compressao.GZIP, None)
+
+
+def _abrir_copia(db: Session, snap: DbSnapshot):
+    """Abre o arquivo (compactado) da cópia para leitura, esteja onde estiver
+    (blob store, blocos, camada fria ou, no legado, dentro do banco)."""
+    if snap.blob_ref:
+        return snapshot_store.get_store().abrir(snap.blob_ref)
+    if snap.em_blocos:
+        return chunk_store.abrir_blocos(db, snap.id)
+    if snap.frio_ref:
+        return snapshot_store.get_store_frio().abrir(snap.frio_ref)
+    conteudo = (
+        db.query(DbSnapshot.conteudo).filter(DbSnapshot.id == snap.id).scalar()
+    )
+    return io.BytesIO(conteudo or b"")
+
+
+@contextmanager
+def _abrir_banco(db: Session, snap: DbSnapshot):
+    """Abre a cópia JÁ DESCOMPACTADA (o banco SQLite), para ler em sequência."""
+    with _abrir_copia(db, snap) as f, \
+            compressao.descompactar(f, *_codificacao(snap)) as banco:
+        yield banco
+
+
+def restaurar_versao(db: Session, user_id: int, version: int,
+                     tarefas: BackgroundTasks) -> DbSnapshot:
+    """Volta o usuário para uma versão do histórico (ação do admin). O
+    conteúdo dela vira uma versão NOVA (a atual + 1) — os aparelhos baixam
+    como qualquer outra mudança. A cópia é lida de onde estiver (inclusive
+    a camada fria) e volta para o armazenamento quente."""
+    antiga = (
         db.query(DbSnapshot)
-        .filter(DbSnapshot.user_id == user.id)
-        .order_by(DbSnapshot.version.desc())
+        .filter(DbSnapshot.user_id == user_id, DbSnapshot.version == version)
         .first()
     )
-    if not snap:
+    if not antiga:
+        raise HTTPException(status_code=404, detail="Versão não encontrada no histórico")
+    cabeca = db.get(SyncCabeca, user_id)
+    codificacao = _codificacao(antiga)
+    if not compressao.aceita(*codificacao):
+        raise HTTPException(status_code=409, detail="Dicionário da cópia indisponível")
+
+    escrita = _nova_escrita(user_id, codificacao[0])
+    hash_banco = snapshot_store.HashDoBanco(compressao.descompactador(*codificacao))
+    try:
+        with _abrir_copia(db, antiga) as f:
+            for bloco in snapshot_store.ler_em_blocos(f):
+                hash_banco.atualizar(bloco)
+                escrita.escrever(bloco)
+        blob_ref = escrita.concluir()
+    except BaseException:
+        escrita.descartar()
+        raise
+    db_sha256 = hash_banco.hexdigest()
+    if antiga.db_sha256 and db_sha256 != antiga.db_sha256:
+        snapshot_store.get_store().apagar(blob_ref)
+        raise HTTPException(status_code=500, detail="Cópia do histórico corrompida")
+
+    snap = _salvar_nova_versao(db, user_id, cabeca.version if cabeca else 0,
+                               escrita, blob_ref, db_sha256, None, tarefas,
+                               codificacao=codificacao)
+    print(f"[sync] restaurada user={user_id} versao={version} -> {snap.version}")
+    return snap
+
+
+def _status(cabeca) -> dict:
+    """Resposta do /status (e dos avisos do /watch) a partir da cabeça."""
+    if not cabeca or not cabeca.version:
         return {
             "current_version": 0,
             "last_at": None,
             "tamanho_bytes": 0,
+            "db_sha256": None,
             "device_id": None,
+            "dicionario_atual": compressao.versao_atual(),
         }
     return {
-        "current_version": snap.version,
-        "last_at": snap.criado_em.isoformat() if snap.criado_em else None,
-        "tamanho_bytes": snap.tamanho_bytes or 0,
-        "device_id": snap.device_id,
+        "current_version": cabeca.version,
+        "last_at": cabeca.criado_em.isoformat() if cabeca.criado_em else None,
+        "tamanho_bytes": cabeca.tamanho_bytes or 0,
+        "db_sha256": cabeca.db_sha256,
+        "device_id": cabeca.device_id,
+        "dicionario_atual": compressao.versao_atual(),
     }
 
 
+# ---------------------------------------------------------------
+# STATUS — qual a versão atual na nuvem
+# ---------------------------------------------------------------
+@router.get("/status")
+def status_sync(
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    return _status(db.get(SyncCabeca, user.id))
+
+
+# ---------------------------------------------------------------
+# WATCH — espera uma versão mais nova que 'since'
+# ---------------------------------------------------------------
+_WATCH_MAX_SEG = 55          # long-poll: no máximo isso esperando
+_SSE_DURACAO_SEG = 300       # SSE: reconecta a cada 5 min
+_SSE_PING_SEG = 15           # SSE: comentário para manter a conexão viva
+
+
+@router.get("/watch")
+async def watch_sync(
+    request: Request,
+    since: int = 0,
+    timeout: int = 25,
+    modo: str = "poll",
+    # Mesma sessão do get_current_user (dependência em cache): é liberada
+    # antes de esperar, para não segurar conexão do pool durante a espera.
+    db: Session = Depends(auth.get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    user_id = user.id
+    db.close()
+
+    if modo == "sse":
+        return StreamingResponse(
+            _eventos_sse(request, user_id, since),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async with notificacoes.assinar("sync", user_id) as fila:
+        # Assina ANTES de ler a cabeça: uma versão que chegue entre a
+        # leitura e a espera não se perde.
+        atual = await run_in_threadpool(_ler_status, user_id)
+        if atual["current_version"] > since:
+            return {**atual, "changed": True}
+        try:
+            novo = await asyncio.wait_for(
+                _proxima_versao(fila, since), min(max(timeout, 1), _WATCH_MAX_SEG)
+            )
+            return {**novo, "changed": True}
+        except asyncio.TimeoutError:
+            return {**atual, "changed": False}
+
+
+def _ler_status(user_id: int) -> dict:
+    db = SessionLocal()
+    try:
+        return _status(db.get(SyncCabeca, user_id))
+    finally:
+        db.close()
+
+
+async def _proxima_versao(fila, since):
+    while True:
+        dados = await fila.get()
+        if dados and dados.get("current_version", 0) > since:
+            return dados
+
+
+async def _eventos_sse(request, user_id, since):
+    """Fluxo SSE: manda um evento 'version' sempre que há versão > since,
+    e um comentário de tempos em tempos para a conexão não cair."""
+    def evento(dados):
+        return f"event: version\ndata: {json.dumps(dados)}\n\n"
+
+    async with notificacoes.assinar("sync", user_id) as fila:
+        atual = await run_in_threadpool(_ler_status, user_id)
+        if atual["current_version"] > since:
+            since = atual["current_version"]
+            yield evento(atual)
+        relogio = asyncio.get_running_loop().time
+        fim = relogio() + _SSE_DURACAO_SEG
+        while relogio() < fim:
+            if await request.is_disconnected():
+                return
+            try:
+                dados = await asyncio.wait_for(_proxima_versao(fila, since), _SSE_PING_SEG)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            since = dados["current_version"]
+            yield evento(dados)
+
+
 # ---------------------------------------------------------------
 # UPLOAD — sobe a cópia do banco (com trava de versão)
 # ---------------------------------------------------------------
 @router.post("/upload")
 def upload_snapshot(
+    tarefas: BackgroundTasks,
     base_version: int = Form(...),
     device_id: str = Form(None),
     arquivo: UploadFile = File(...),
+    x_db_sha256: str = Header(None),
+    x_db_encoding: str = Header(compressao.GZIP),
+    x_db_dict: int = Header(None),
+    x_db_accept_encoding: str = Header(None),
     db: Session = Depends(get_db),
-    user: Usuario = Depends(get_current_user),
+    user: UsuarioLogado = Depends(get_current_user),
 ):
-    atual = _versao_atual(db, user.id)
+    # A trava de versão é conferida no fim, pelo banco (_salvar_nova_versao).
+    # A cabeça só é lida para o "upload igual" — no máximo UMA vez por pedido.
+    cabeca = None
 
-    # TRAVA DE VERSÃO: só aceita se o cliente está baseado na versão atual.
-    if base_version != atual:
-        raise HTTPException(
-            status_code=409,
-            detail={
-                "erro": "conflito_versao",
-                "servidor": atual,
-                "cliente_base": base_version,
-                "mensagem": "A nuvem tem uma versão diferente. Baixe antes de subir.",
-            },
-        )
+    # Banco igual ao da nuvem (hash no cabeçalho): nem olha o arquivo.
+    hash_cliente = (x_db_sha256 or "").strip().lower()
+    if hash_cliente:
+        cabeca = db.get(SyncCabeca, user.id)
+        igual = _sem_mudanca(cabeca, user.id, base_version, hash_cliente, device_id)
+        if igual:
+            print(f"[sync] upload igual user={user.id} versao={igual['version']}")
+            return igual
 
-    conteudo = arquivo.file.read()
-    if not conteudo:
-        raise HTTPException(status_code=400, detail="arquivo_vazio")
+    codificacao = (x_db_encoding.strip().lower(), x_db_dict)
+    if codificacao[0] != compressao.ZSTD_DICT:
+        codificacao = (compressao.GZIP, None)
+    elif not compressao.aceita(*codificacao):
+        # zstd desligado aqui ou dicionário que o servidor não conhece.
+        raise HTTPException(status_code=415, detail="codificacao_nao_suportada")
 
-    nova_versao = atual + 1
-    snap = DbSnapshot(
-        user_id=user.id,
-        version=nova_versao,
-        conteudo=conteudo,
-        tamanho_bytes=len(conteudo),
-        device_id=device_id,
+    # Grava o arquivo no blob store EM BLOCOS (memória constante), somando
+    # tamanho e hash no caminho. Cada bloco é conferido ANTES de ir para o
+    # disco: arquivo que não é banco, ou que estoura a cota, para ali.
+    escrita = _nova_escrita(user.id, codificacao[0])
+    hash_banco = snapshot_store.HashDoBanco(
+        compressao.descompactador(*codificacao),
+        snapshot_store.ConferenciaSqlite(_cota(user)),
     )
-    db.add(snap)
-    db.commit()
+    try:
+        for bloco in snapshot_store.ler_em_blocos(arquivo.file):
+            hash_banco.atualizar(bloco)
+            escrita.escrever(bloco)
+        if not escrita.tamanho:
+            raise HTTPException(status_code=400, detail="arquivo_vazio")
+        db_sha256 = hash_banco.hexdigest()
+        # App antigo (sem cabeçalho) subindo o mesmo banco: descarta também.
+        if cabeca is None and not hash_cliente:
+            cabeca = db.get(SyncCabeca, user.id)
+        igual = _sem_mudanca(cabeca, user.id, base_version, db_sha256, device_id)
+        if igual:
+            escrita.descartar()
+            print(f"[sync] upload igual user={user.id} versao={igual['version']}")
+            return igual
+        blob_ref = escrita.concluir()
+    except snapshot_store.BlobGrandeDemais:
+        escrita.descartar()
+        raise HTTPException(status_code=413, detail="arquivo_grande_demais")
+    except (snapshot_store.BancoInvalido, snapshot_store.CotaExcedida) as e:
+        escrita.descartar()
+        print(f"[sync] upload recusado user={user.id}: {e}")
+        raise _erro_conferencia(e)
+    except BaseException:
+        escrita.descartar()
+        raise
 
-    # Mantém apenas as últimas MAX_HISTORICO cópias deste usuário.
-    antigas = (
-        db.query(DbSnapshot)
-        .filter(DbSnapshot.user_id == user.id)
-        .order_by(DbSnapshot.version.desc())
-        .offset(MAX_HISTORICO)
-        .all()
-    )
-    if antigas:
-        for a in antigas:
-            db.delete(a)
-        db.commit()
-
-    # Anti-compartilhamento: anota o aparelho que enviou.
-    _registrar_dispositivo(db, user.id, device_id)
+    snap = _salvar_nova_versao(db, user.id, base_version, escrita, blob_ref,
+                               db_sha256, device_id, tarefas, codificacao)
+    nova_versao = snap.version
+    _recompactar_depois(tarefas, snap, x_db_accept_encoding)
 
-    print(f"[sync] upload user={user.id} versao={nova_versao} tamanho={len(conteudo)} bytes")
+    print(f"[sync] upload user={user.id} versao={nova_versao} tamanho={escrita.tamanho} bytes "
+          f"({codificacao[0]})")
     return {"success": True, "version": nova_versao}
 
 
 # ---------------------------------------------------------------
 # DOWNLOAD — baixa a última cópia da nuvem
 # ---------------------------------------------------------------
+def _etag(snap: DbSnapshot, envio: tuple = (compressao.GZIP, None),
+          convertida: bool = False) -> str:
+    """ETag FORTE do que vai ser enviado: "v<versão>-<hash do banco>" mais
+    um sufixo quando os BYTES são outros (zstd, ou gzip convertido na
+    hora) — o If-Range só pode retomar sobre exatamente os mesmos bytes.
+    Cópias antigas (sem hash) usam o id da linha, que também é imutável."""
+    ident = (snap.db_sha256 or snap.sha256 or "")[:32] or snap.id
+    sufixo = ""
+    if envio[0] == compressao.ZSTD_DICT:
+        sufixo = f"-zd{envio[1]}"
+    elif convertida:
+        sufixo = "-gz"
+    return f'"v{snap.version}-{ident}{sufixo}"'
+
+
+def _sem_sufixo(etag: str) -> str:
+    return '"' + "-".join(etag.strip().strip('"').split("-")[:2]) + '"'
+
+
+def _etag_bate(if_none_match: str, etag: str) -> bool:
+    """If-None-Match: o app já tem ESTA versão (em qualquer codificação)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return _sem_sufixo(etag) in [_sem_sufixo(t) for t in if_none_match.split(",")]
+
+
+def _intervalo(range_header: str, tamanho: int):
+    """Interpreta um cabeçalho Range de UM intervalo ('bytes=a-b', 'bytes=a-'
+    ou 'bytes=-n'). Devolve (inicio, fim_inclusivo) ou None para mandar o
+    arquivo inteiro. Fora do tamanho -> 416."""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    ini_txt, _, fim_txt = range_header[6:].strip().partition("-")
+    try:
+        if ini_txt:
+            inicio = int(ini_txt)
+            fim = int(fim_txt) if fim_txt else tamanho - 1
+        else:
+            inicio = max(tamanho - int(fim_txt), 0)
+            fim = tamanho - 1
+    except ValueError:
+        return None
+    fim = min(fim, tamanho - 1)
+    if inicio >= tamanho or inicio > fim:
+        raise HTTPException(
+            status_code=416,
+            detail="intervalo_invalido",
+            headers={"Content-Range": f"bytes */{tamanho}"},
+        )
+    return inicio, fim
+
+
 @router.get("/download")
 def download_snapshot(
+    request: Request,
+    tarefas: BackgroundTasks,
     db: Session = Depends(get_db),
-    user: Usuario = Depends(get_current_user),
+    user: UsuarioLogado = Depends(get_current_user),
 ):
-    snap = (
-        db.query(DbSnapshot)
-        .filter(DbSnapshot.user_id == user.id)
-        .order_by(DbSnapshot.version.desc())
-        .first()
+    snap = changeset_routes.copia_em_dia(db, user.id, tarefas)[1]
+    if not snap:
+        raise HTTPException(status_code=404, detail="sem_copia")
+
+    guardada = _codificacao(snap)
+    aceitas = request.headers.get("x-db-accept-encoding")
+    dicts = request.headers.get("x-db-dicts")
+    envio = compressao.negociar(aceitas, dicts, guardada)
+    convertida = envio != guardada
+    ref, tamanho = snap.blob_ref, snap.tamanho_bytes or 0
+    if snap.blob_ref and snap.zstd_ref and envio[0] != compressao.ZSTD_DICT:
+        # Cópia zstd gravada ao lado do gzip: vai ela, se o app aceita.
+        ao_lado = (compressao.ZSTD_DICT, snap.zstd_dicionario)
+        if compressao.negociar(aceitas, dicts, ao_lado) == ao_lado:
+            envio, convertida = ao_lado, False
+            ref, tamanho = snap.zstd_ref, snap.zstd_tamanho or 0
+    etag = _etag(snap, envio, convertida)
+    zstd = envio[0] == compressao.ZSTD_DICT
+    headers = {
+        "X-DB-Version": str(snap.version),
+        "X-DB-Encoding": envio[0],
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": "attachment; filename=agrivia_nuvem.db."
+                               + ("zst" if zstd else "gz"),
+    }
+    if zstd:
+        headers["X-DB-Dict"] = str(envio[1])
+    if snap.db_sha256:
+        headers["X-DB-Sha256"] = snap.db_sha256
+
+    # O cliente já tem esta versão -> nada para baixar.
+    if _etag_bate(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    print(f"[sync] download user={user.id} versao={snap.version} ({envio[0]})")
+
+    if convertida:
+        # Guardada numa codificação que o app não entende (ex.: app antigo
+        # e cópia em zstd): converte no caminho. Sem tamanho fixo, sem Range.
+        headers.pop("Accept-Ranges")
+        f = _abrir_copia(db, snap)
+        return StreamingResponse(
+            _converter_e_fechar(f, guardada, envio),
+            media_type="application/octet-stream",
+            headers=headers,
+        )
+
+    if snap.blob_ref:
+        store = snapshot_store.get_store()
+        caminho = store.caminho_local(ref)
+        if caminho:
+            # Arquivo no disco: o servidor manda direto do arquivo (sendfile),
+            # sem copiar o conteúdo para a memória do Python. O FileResponse
+            # já trata Range/If-Range usando o nosso ETag.
+            return FileResponse(
+                caminho,
+                media_type="application/octet-stream",
+                headers=headers,
+            )
+    elif snap.em_blocos:
+        # Só existe em blocos: o .gz remontado não tem o tamanho original,
+        # então vai inteiro, sem Range.
+        headers.pop("Accept-Ranges")
+        return StreamingResponse(
+            _ler_e_fechar(chunk_store.abrir_blocos(db, snap.id)),
+            media_type="application/octet-stream",
+            headers=headers,
+        )
+
+    intervalo = None
+    if_range = request.headers.get("if-range")
+    if not if_range or if_range == etag:
+        intervalo = _intervalo(request.headers.get("range"), tamanho)
+    inicio, fim = intervalo or (0, tamanho - 1)
+
+    if snap.blob_ref:
+        corpo = _ler_e_fechar(store.abrir(ref), inicio, fim)
+    elif snap.frio_ref:
+        frio = snapshot_store.get_store_frio()
+        corpo = _ler_e_fechar(frio.abrir(snap.frio_ref), inicio, fim)
+    else:
+        # Cópia antiga (de antes do blob store): lê do banco em pedaços.
+        corpo = _ler_do_banco(snap.id, inicio, fim)
+
+    headers["Content-Length"] = str(fim - inicio + 1)
+    if intervalo:
+        headers["Content-Range"] = f"bytes {inicio}-{fim}/{tamanho}"
+    return StreamingResponse(
+        corpo,
+        status_code=206 if intervalo else 200,
+        media_type="application/octet-stream",
+        headers=headers,
     )
+
+
+def _ler_e_fechar(f, inicio: int = 0, fim: int = None):
+    """Lê do arquivo só o trecho [inicio, fim] (em blocos) e fecha no fim."""
+    with f:
+        if fim is None:
+            yield from snapshot_store.ler_em_blocos(f)
+            return
+        f.seek(inicio)
+        falta = fim - inicio + 1
+        while falta > 0:
+            bloco = f.read(min(snapshot_store.BLOCO_BYTES, falta))
+            if not bloco:
+                return
+            falta -= len(bloco)
+            yield bloco
+
+
+def _converter_e_fechar(f, de: tuple, para: tuple):
+    with f:
+        yield from compressao.converter(f, de, para)
+
+
+def _ler_do_banco(snapshot_id: int, inicio: int, fim: int):
+    """Lê a coluna 'conteudo' (legado) em fatias de BLOCO_BYTES, uma query
+    por fatia — o banco nunca manda o blob inteiro de uma vez. Usa sessão
+    própria porque roda DEPOIS que a rota já devolveu a resposta."""
+    db = SessionLocal()
+    try:
+        pos = inicio
+        while pos <= fim:
+            n = min(snapshot_store.BLOCO_BYTES, fim - pos + 1)
+            fatia = (
+                db.query(func.substr(DbSnapshot.conteudo, pos + 1, n))
+                .filter(DbSnapshot.id == snapshot_id)
+                .scalar()
+            )
+            if not fatia:
+                return
+            pos += len(fatia)
+            yield bytes(fatia)
+    finally:
+        db.close()
+
+
+# ---------------------------------------------------------------
+# DELTA — sobe/baixa só os blocos que mudaram
+# ---------------------------------------------------------------
+# Manifestos recentes em memória: calcular exige descompactar a cópia
+# inteira, e o mesmo manifesto costuma ser pedido várias vezes seguidas.
+_MANIFESTOS_CACHE = OrderedDict()
+_MANIFESTOS_MAX = 32
+
+
+def _manifesto(db: Session, snap: DbSnapshot, block_size: int) -> dict:
+    chave = (snap.id, snap.sha256, block_size)
+    m = _MANIFESTOS_CACHE.get(chave)
+    if m is None:
+        with _abrir_banco(db, snap) as banco:
+            m = delta_sync.manifesto(banco, block_size)
+        _MANIFESTOS_CACHE[chave] = m
+        while len(_MANIFESTOS_CACHE) > _MANIFESTOS_MAX:
+            _MANIFESTOS_CACHE.popitem(last=False)
+    else:
+        _MANIFESTOS_CACHE.move_to_end(chave)
+    return m
+
+
+def _checar_bloco(block_size: int):
+    if block_size not in delta_sync.BLOCOS_PERMITIDOS:
+        raise HTTPException(status_code=400, detail="block_size_invalido")
+
+
+class ManifestoCliente(BaseModel):
+    block_size: int = delta_sync.BLOCO_PADRAO
+    hashes: List[str] = []
+
+
+@router.get("/delta/manifest")
+def delta_manifesto(
+    tarefas: BackgroundTasks,
+    block_size: int = delta_sync.BLOCO_PADRAO,
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    _checar_bloco(block_size)
+    snap = changeset_routes.copia_em_dia(db, user.id, tarefas)[1]
     if not snap:
         raise HTTPException(status_code=404, detail="sem_copia")
+    return {"version": snap.version, **_manifesto(db, snap, block_size)}
 
-    print(f"[sync] download user={user.id} versao={snap.version}")
+
+@router.post("/delta/download")
+def delta_download(
+    manifesto: ManifestoCliente,
+    tarefas: BackgroundTasks,
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    _checar_bloco(manifesto.block_size)
+    snap = changeset_routes.copia_em_dia(db, user.id, tarefas)[1]
+    if not snap:
+        raise HTTPException(status_code=404, detail="sem_copia")
+
+    print(f"[sync] delta download user={user.id} versao={snap.version}")
+    def corpo():
+        # Sessão própria: o gerador roda depois que a rota já respondeu.
+        sessao = SessionLocal()
+        try:
+            with _abrir_banco(sessao, snap) as banco:
+                yield from delta_sync.gerar_delta(banco, manifesto.hashes, manifesto.block_size)
+        finally:
+            sessao.close()
+
+    return StreamingResponse(
+        corpo(),
+        media_type="application/octet-stream",
+        headers={"X-DB-Version": str(snap.version), "ETag": _etag(snap)},
+    )
+
+
+@router.post("/delta/upload")
+def delta_upload(
+    tarefas: BackgroundTasks,
+    base_version: int = Form(...),
+    device_id: str = Form(None),
+    delta: UploadFile = File(...),
+    x_db_accept_encoding: str = Header(None),
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    cabeca, base = changeset_routes.copia_em_dia(db, user.id, tarefas)
+    if not base:
+        # Sem versão na nuvem não há base para o delta: use o upload completo.
+        raise HTTPException(status_code=400, detail="sem_copia_base")
+    if cabeca.version != base_version:
+        # O delta só vale sobre a versão em que o cliente se baseou.
+        raise _conflito(db, user.id, base_version)
+
+    escrita = _nova_escrita(user.id)
+    hash_banco = snapshot_store.ConferenciaSqlite(_cota(user))
+    try:
+        with _abrir_banco(db, base) as banco:
+            delta_sync.aplicar_delta(banco, delta.file, escrita.escrever, hash_banco)
+        # Delta que não muda nada: fica na versão atual.
+        igual = _sem_mudanca(cabeca, user.id, base_version, hash_banco.hexdigest(), device_id)
+        if igual:
+            escrita.descartar()
+            print(f"[sync] delta upload igual user={user.id} versao={igual['version']}")
+            return igual
+        blob_ref = escrita.concluir()
+    except delta_sync.DeltaInvalido as e:
+        escrita.descartar()
+        raise HTTPException(status_code=422, detail=f"delta_invalido: {e}")
+    except snapshot_store.BlobGrandeDemais:
+        escrita.descartar()
+        raise HTTPException(status_code=413, detail="arquivo_grande_demais")
+    except (snapshot_store.BancoInvalido, snapshot_store.CotaExcedida) as e:
+        escrita.descartar()
+        print(f"[sync] delta upload recusado user={user.id}: {e}")
+        raise _erro_conferencia(e)
+    except BaseException:
+        escrita.descartar()
+        raise
+
+    snap = _salvar_nova_versao(db, user.id, base_version, escrita, blob_ref,
+                               hash_banco.hexdigest(), device_id, tarefas)
+    nova_versao = snap.version
+    _recompactar_depois(tarefas, snap, x_db_accept_encoding)
+
+    print(f"[sync] delta upload user={user.id} versao={nova_versao} "
+          f"delta={delta.size or 0} bytes -> copia={escrita.tamanho} bytes")
+    return {"success": True, "version": nova_versao}
+
+
+# ---------------------------------------------------------------
+# DICIONÁRIOS ZSTD — o app baixa uma vez cada versão (nunca mudam)
+# ---------------------------------------------------------------
+@router.get("/dicionarios/{versao}")
+def baixar_dicionario(
+    versao: int,
+    db: Session = Depends(get_db),
+    user: UsuarioLogado = Depends(get_current_user),
+):
+    dados = (
+        db.query(DicionarioZstd.dados)
+        .filter(DicionarioZstd.versao == versao)
+        .scalar()
+    )
+    if dados is None:
+        raise HTTPException(status_code=404, detail="dicionario_inexistente")
     return Response(
-        content=snap.conteudo,
+        bytes(dados),
         media_type="application/octet-stream",
-        headers={
-            "X-DB-Version": str(snap.version),
-            "Content-Disposition": "attachment; filename=agrivia_nuvem.db.gz",
-        },
+        headers={"Cache-Control": "private, max-age=31536000, immutable"},
     )
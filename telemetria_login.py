@@ -0,0 +1,71 @@
+# ===============================================================
+# TELEMETRIA DO LOGIN (último acesso e versão do app, em lote)
+# ---------------------------------------------------------------
+# Cada login certo anotava usuarios.ultimo_acesso / app_versao com um
+# UPDATE + commit próprio — uma transação de escrita por login, no
+# endpoint mais chamado. Agora a anotação fica em memória, uma por
+# conta (a mais recente vence), e sai num UPDATE só via executemany a
+# cada LOGIN_TELEMETRIA_SEG segundos (ou com LOGIN_TELEMETRIA_MAX
+# contas na fila). O painel ("sumidos", versões) fica atrasado no
+# máximo esses segundos.
+#
+# Ao encerrar, o pendente é gravado; se o banco não responde, vai para
+# LOGIN_TELEMETRIA_RESERVA (JSONL) e volta na próxima subida. No
+# Railway, aponte para um VOLUME ("" = sem reserva).
+# ===============================================================
+import os
+from datetime import datetime
+
+from sqlalchemy import String, bindparam, func
+
+import escrita_em_lote
+from models import Usuario
+
+LOGIN_TELEMETRIA_RESERVA = os.getenv(
+    "LOGIN_TELEMETRIA_RESERVA",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "lote", "login.jsonl"),
+)
+
+
+class _TelemetriaLogin(escrita_em_lote.BufferDeEscrita):
+    """user_id -> (quando, app_versao ou None)."""
+    nome = "login"
+
+    def juntar(self, atual, novo):
+        # A anotação mais recente vence; versão vazia não apaga a conhecida.
+        antigo, recente = (atual, novo) if atual[0] <= novo[0] else (novo, atual)
+        return (recente[0], recente[1] or antigo[1])
+
+    def gravar(self, db, itens):
+        # Conta excluída no meio: o UPDATE não acha a linha e segue.
+        tabela = Usuario.__table__
+        db.execute(
+            tabela.update()
+            .where(tabela.c.id == bindparam("b_id"))
+            .values(
+                ultimo_acesso=bindparam("b_quando"),
+                app_versao=func.coalesce(bindparam("b_versao", type_=String),
+                                         tabela.c.app_versao),
+            ),
+            [{"b_id": user_id, "b_quando": quando, "b_versao": versao}
+             for user_id, (quando, versao) in itens.items()],
+        )
+
+    def para_json(self, chave, valor):
+        return {"user_id": chave, "quando": valor[0].isoformat(), "app_versao": valor[1]}
+
+    def de_json(self, linha):
+        return linha["user_id"], (datetime.fromisoformat(linha["quando"]), linha["app_versao"])
+
+
+telemetria_login = _TelemetriaLogin(
+    intervalo=float(os.getenv("LOGIN_TELEMETRIA_SEG", "5")),
+    max_itens=int(os.getenv("LOGIN_TELEMETRIA_MAX", "500")),
+    reserva=LOGIN_TELEMETRIA_RESERVA or None,
+)
+
+
+def registrar(user_id: int, quando: datetime, app_versao: str):
+    """Anota o login (não espera o banco)."""
+    versao = (app_versao or "").strip()[:20] or None
+    telemetria_login.adicionar(user_id, (quando, versao))
@@ -0,0 +1,100 @@
+# ===============================================================
+# TREINO DO DICIONÁRIO ZSTD DAS CÓPIAS (compressao.py)
+# ---------------------------------------------------------------
+# Cria uma VERSÃO NOVA do dicionário a partir de bancos de exemplo
+# e ela passa a ser a atual. As versões antigas continuam valendo
+# para as cópias e apps que já as usam.
+#
+# COMO USAR (no servidor, com DATABASE_URL apontando para o banco):
+#   python treinar_dicionario.py banco1.db banco2.db ...
+#       -> treina com bancos SQLite (descompactados) do AGRIVIA
+#   python treinar_dicionario.py
+#       -> sem arquivos: usa as cópias atuais guardadas na nuvem
+#   python treinar_dicionario.py --recomprimir
+#       -> depois, recompacta as cópias atuais com o dicionário novo
+#          (apps antigos, que só entendem gzip, passam a receber a
+#          cópia convertida na hora — use quando a maioria já atualizou)
+# ===============================================================
+import sys
+
+import compressao
+import snapshot_store
+from database import SessionLocal
+from models import DbSnapshot, SyncCabeca
+
+TAMANHO_DICIONARIO = 112 * 1024
+
+# Amostras = páginas do SQLite (4 KB). Um tanto por banco, até o limite,
+# para o treino não depender de um cliente só.
+PAGINA = 4096
+PAGINAS_POR_BANCO = 2000
+MAX_AMOSTRAS = 50000
+
+# Quantas cópias da nuvem usar quando não se passa nenhum arquivo.
+COPIAS_DA_NUVEM = 30
+
+
+def _paginas(banco):
+    for i, pagina in enumerate(snapshot_store.ler_em_blocos(banco, PAGINA)):
+        if i >= PAGINAS_POR_BANCO:
+            return
+        yield pagina
+
+
+def _amostras_de_arquivos(caminhos):
+    amostras = []
+    for caminho in caminhos:
+        with open(caminho, "rb") as f:
+            amostras.extend(_paginas(f))
+    return amostras
+
+
+def _amostras_da_nuvem():
+    amostras = []
+    store = snapshot_store.get_store()
+    db = SessionLocal()
+    try:
+        copias = (
+            db.query(DbSnapshot)
+            .join(SyncCabeca, SyncCabeca.snapshot_id == DbSnapshot.id)
+            .filter(DbSnapshot.blob_ref.isnot(None))
+            .order_by(DbSnapshot.criado_em.desc())
+            .limit(COPIAS_DA_NUVEM)
+            .all()
+        )
+        for snap in copias:
+            codificacao = (snap.codificacao or compressao.GZIP, snap.dicionario)
+            with store.abrir(snap.blob_ref) as f, \
+                    compressao.descompactar(f, *codificacao) as banco:
+                amostras.extend(_paginas(banco))
+    finally:
+        db.close()
+    return amostras
+
+
+def treinar(caminhos) -> int:
+    if not compressao.zstd_ligado():
+        print("❌ zstd indisponível (instale 'zstandard' e deixe SYNC_ZSTD=1).")
+        return 0
+    amostras = _amostras_de_arquivos(caminhos) if caminhos else _amostras_da_nuvem()
+    amostras = amostras[:MAX_AMOSTRAS]
+    if len(amostras) < 100:
+        print(f"❌ Poucas amostras ({len(amostras)}). Passe mais bancos de exemplo.")
+        return 0
+
+    d = compressao.zstandard.train_dictionary(TAMANHO_DICIONARIO, amostras)
+    db = SessionLocal()
+    try:
+        versao = compressao.salvar_dicionario(db, d.as_bytes(), len(amostras))
+    finally:
+        db.close()
+    print(f"✅ Dicionário versão {versao} criado ({len(d.as_bytes())} bytes, "
+          f"{len(amostras)} amostras).")
+    return versao
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != "--recomprimir"]
+    if treinar(args) and "--recomprimir" in sys.argv[1:]:
+        n = compressao.recomprimir_pendentes()
+        print(f"✅ {n} cópia(s) enviadas para recompactação.")
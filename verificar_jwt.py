@@ -0,0 +1,66 @@
+# ===============================================================
+# CONFERIR TOKENS DO AGRIVIA SEM CHAMAR O SERVIDOR (RS256 / JWKS)
+# ---------------------------------------------------------------
+# Para OUTROS serviços (e ferramentas) que recebem o token do app:
+# baixa as chaves públicas de /.well-known/jwks.json, guarda por
+# 'ttl' segundos e confere assinatura + validade localmente. Só
+# depende do python-jose — copie este arquivo para o outro serviço.
+#
+#   from verificar_jwt import VerificadorJWT
+#   verificador = VerificadorJWT("https://api.agrivia.com.br")
+#   claims = verificador.conferir(token)    # JWTError se não vale
+#   claims["user_id"]
+#
+# Um 'kid' desconhecido (chave nova depois de uma rotação) faz baixar
+# o JWKS de novo, no máximo uma vez a cada 'intervalo_minimo' segundos.
+#
+# ATENÇÃO: isto confere a ASSINATURA e o 'exp'. Revogações (conta
+# bloqueada, senha trocada) só o servidor sabe: para decisões que não
+# podem esperar o token vencer, pergunte ao servidor. Os tokens curtos
+# (ACCESS_TOKEN_MINUTOS) limitam essa janela a poucos minutos.
+# ===============================================================
+import json
+import threading
+import time
+import urllib.request
+
+from jose import JWTError, jwk, jwt
+
+
+class VerificadorJWT:
+    def __init__(self, base_url: str, ttl: float = 3600, intervalo_minimo: float = 30,
+                 timeout: float = 10):
+        self.url = base_url.rstrip("/") + "/.well-known/jwks.json"
+        self.ttl = ttl
+        self.intervalo_minimo = intervalo_minimo
+        self.timeout = timeout
+        self._chaves = {}
+        self._baixado_em = 0.0
+        self._trava = threading.Lock()
+
+    def _baixar(self):
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as r:
+            dados = json.load(r)
+        self._chaves = {
+            k["kid"]: jwk.construct(k, k.get("alg", "RS256"))
+            for k in dados.get("keys", [])
+            if k.get("kid")
+        }
+        self._baixado_em = time.monotonic()
+
+    def _chave(self, kid: str):
+        with self._trava:
+            idade = time.monotonic() - self._baixado_em
+            if idade > self.ttl or (kid not in self._chaves and idade > self.intervalo_minimo):
+                self._baixar()
+            return self._chaves.get(kid)
+
+    def conferir(self, token: str) -> dict:
+        """Claims do token, se a assinatura e a validade conferem."""
+        cabecalho = jwt.get_unverified_header(token)
+        if cabecalho.get("alg") != "RS256":
+            raise JWTError("só tokens RS256 podem ser conferidos fora do servidor")
+        chave = self._chave(cabecalho.get("kid"))
+        if chave is None:
+            raise JWTError("kid desconhecido")
+        return jwt.decode(token, chave, algorithms=["RS256"])